@@ -439,6 +439,30 @@ def test_linear_transfer_first_order_taylor_map(test_context):
                       dtk_particle.delta, rtol=1e-14, atol=1e-14)
 
 
+@for_all_test_contexts
+def test_first_order_taylor_map_advance_s(test_context):
+    line = xt.Line(elements=[
+        xt.Drift(length=1.),
+        xt.FirstOrderTaylorMap(length=2.5, advance_s=1),
+        xt.Drift(length=0.5)])
+    line.build_tracker(_context=test_context)
+
+    s_elements = line.get_s_position()
+    for ele_stop in [1, 2]:
+        particles = xp.Particles(p0c=1e9, x=[0, 1e-3], _context=test_context)
+        line.track(particles, ele_stop=ele_stop)
+        xo.assert_allclose(
+            test_context.nparray_from_context_array(particles.s),
+            s_elements[ele_stop], rtol=0, atol=1e-15)
+
+    # By default the map does not change s
+    fmap = xt.FirstOrderTaylorMap(length=2.5, _context=test_context)
+    particles = xp.Particles(p0c=1e9, x=[0, 1e-3], _context=test_context)
+    fmap.track(particles)
+    xo.assert_allclose(test_context.nparray_from_context_array(particles.s),
+                       0, rtol=0, atol=0)
+
+
 @for_all_test_contexts
 def test_cavity(test_context):
     cav = xt.Cavity(_context=test_context, frequency=0, lag=90, voltage=30)
@@ -0,0 +1,154 @@
+# copyright ################################# #
+# This file is part of the Xtrack Package.    #
+# Copyright (c) CERN, 2024.                   #
+# ########################################### #
+import numpy as np
+
+import xobjects as xo
+import xtrack as xt
+from xobjects.test_helpers import for_all_test_contexts
+
+
+def _make_line(k1l, k2l):
+    line = xt.Line(
+        elements=[xt.Drift(length=2.), xt.Multipole(knl=[0, k1l, k2l]),
+                  xt.Drift(length=2.), xt.Multipole(knl=[0, -k1l]),
+                  xt.LimitRect(min_x=-0.02, max_x=0.02,
+                               min_y=-0.02, max_y=0.02)])
+    line.particle_ref = xt.Particles(p0c=1e9)
+    return line
+
+
+@for_all_test_contexts
+def test_ensemble_tracker(test_context):
+
+    seeds = [(0.1, 0.), (0.11, 1.), (0.09, -3.)]
+    lines = [_make_line(k1l, k2l) for k1l, k2l in seeds]
+
+    ens = xt.EnsembleTracker(lines, _context=test_context)
+
+    p0 = xt.Particles(p0c=1e9, x=[1e-3, -2e-3, 5e-3, 1.5e-2],
+                      px=[0, 1e-4, -1e-4, 0], particle_id=[3, 2, 1, 0],
+                      _context=test_context)
+    p_ens = ens.track(p0, num_turns=20)
+
+    assert len(p_ens) == len(seeds)
+    for (k1l, k2l), pe in zip(seeds, p_ens):
+        line_ref = _make_line(k1l, k2l)
+        line_ref.build_tracker(_context=test_context)
+        p_ref = p0.copy()
+        line_ref.track(p_ref, num_turns=20)
+
+        p_ref.move(_context=xo.context_default)
+        pe.move(_context=xo.context_default)
+        p_ref.sort(interleave_lost_particles=True)
+        pe.sort(interleave_lost_particles=True)
+
+        xo.assert_allclose(pe.particle_id, p_ref.particle_id, rtol=0, atol=0)
+        xo.assert_allclose(pe.state, p_ref.state, rtol=0, atol=0)
+        xo.assert_allclose(pe.at_turn, p_ref.at_turn, rtol=0, atol=0)
+        xo.assert_allclose(pe.at_element, p_ref.at_element, rtol=0, atol=0)
+        xo.assert_allclose(pe.x, p_ref.x, rtol=0, atol=1e-14)
+        xo.assert_allclose(pe.px, p_ref.px, rtol=0, atol=1e-14)
+        xo.assert_allclose(pe.zeta, p_ref.zeta, rtol=0, atol=1e-14)
+
+    # Different seeds give different results
+    assert not np.allclose(p_ens[0].x, p_ens[1].x, rtol=0, atol=1e-12)
+
+
+def _make_ring():
+    n = 8
+    elements = {}
+    element_names = []
+    for ii in range(n):
+        for nn, ee in [
+                (f'qf{ii}', xt.Quadrupole(length=0.3, k1=0.3)),
+                (f'd1_{ii}', xt.Drift(length=1.0)),
+                (f'mcorr{ii}', xt.Multipole(knl=[0, -0.09, 0.05], ksl=[0, 0])),
+                (f'd2_{ii}', xt.Drift(length=1.0)),
+                (f'mb{ii}', xt.Bend(length=1.0, k0=2 * np.pi / n,
+                                    h=2 * np.pi / n)),
+                (f'cav{ii}', xt.Cavity(voltage=(1e6 if ii == 0 else 0),
+                                       frequency=400e6)),
+                (f'd3_{ii}', xt.Drift(length=1.0))]:
+            elements[nn] = ee
+            element_names.append(nn)
+    line = xt.Line(elements=elements, element_names=element_names)
+    line.particle_ref = xt.Particles(mass0=xt.PROTON_MASS_EV, q0=1, p0c=1e9)
+    return line
+
+
+def test_twiss_ensemble():
+
+    line = _make_ring()
+    names = [f'mcorr{ii}' for ii in range(8)]
+
+    rng = np.random.default_rng(seed=1)
+    num_seeds = 4
+    k0l = 2e-5 * rng.standard_normal((num_seeds, len(names)))
+    k1l = -0.09 + 1e-3 * rng.standard_normal((num_seeds, len(names)))
+
+    for method in ['6d', '4d']:
+        tw_ens = xt.twiss_ensemble(line, num_seeds=num_seeds,
+                                   seed_setter={('knl', 0): (names, k0l),
+                                                ('knl', 1): (names, k1l)},
+                                   method=method)
+
+        assert len(tw_ens) == num_seeds
+        assert tw_ens.betx.shape == (num_seeds, len(tw_ens.name))
+        assert tw_ens.qx.shape == (num_seeds,)
+
+        for iseed in range(num_seeds):
+            line_seed = line.copy()
+            for ii, nn in enumerate(names):
+                line_seed[nn].knl[0] = k0l[iseed, ii]
+                line_seed[nn].knl[1] = k1l[iseed, ii]
+            line_seed.build_tracker()
+            tw = line_seed.twiss(method=method)
+
+            for cc in ['x', 'px', 'y', 'py', 'delta']:
+                xo.assert_allclose(tw_ens[cc][iseed], tw[cc],
+                                   atol=1e-11, rtol=0)
+            for cc in ['betx', 'bety', 'dx', 'mux']:
+                xo.assert_allclose(tw_ens[cc][iseed], tw[cc],
+                                   atol=1e-7, rtol=1e-7)
+            xo.assert_allclose(tw_ens.qx[iseed], tw.qx, atol=1e-9, rtol=0)
+
+        # Summary statistics
+        xo.assert_allclose(tw_ens.mean().betx, np.mean(tw_ens.betx, axis=0),
+                           atol=0, rtol=1e-15)
+        xo.assert_allclose(tw_ens.std().qx, np.std(tw_ens.qx),
+                           atol=0, rtol=1e-15)
+        assert np.all(tw_ens.std().x > 0)
+        xo.assert_allclose(tw_ens.scalars.qy, tw_ens.qy, atol=0, rtol=0)
+
+    # Closed orbit search of all variants together
+    lines = [line.copy() for _ in range(3)]
+    for ii, ll in enumerate(lines):
+        ll['mcorr0'].knl[0] = 1e-5 * ii
+    ens = xt.EnsembleTracker(lines, compile=False)
+    p_co, co_search_R_matrices = ens.find_closed_orbit(
+                                        _return_co_search_R_matrix=True)
+    for ll, pp, RR_co in zip(lines, p_co, co_search_R_matrices):
+        assert pp._fsolve_info['converged']
+        p_ref = ll.find_closed_orbit()
+        for nn in ['x', 'px', 'y', 'py', 'zeta', 'delta']:
+            xo.assert_allclose(getattr(pp, nn), getattr(p_ref, nn),
+                               atol=1e-11, rtol=0)
+        RR = ll.compute_one_turn_matrix_finite_differences(pp)['R_matrix']
+        xo.assert_allclose(RR_co['R_matrix'], RR,
+                           atol=1e-9, rtol=0)
+
+    # Variants provided as lines, with a seed setter acting on the line
+    def seed_setter(line, iseed):
+        line['qf0'].k1 = 0.3 + 1e-3 * iseed
+
+    lines = []
+    for iseed in range(3):
+        ll = line.copy()
+        seed_setter(ll, iseed)
+        lines.append(ll)
+    tw_lines = xt.twiss_ensemble(lines)
+    tw_setter = xt.twiss_ensemble(line, seed_setter=seed_setter, num_seeds=3)
+    xo.assert_allclose(tw_lines.betx, tw_setter.betx, atol=0, rtol=1e-12)
+    assert np.all(np.diff(tw_lines.qx) != 0)
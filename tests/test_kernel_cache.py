@@ -0,0 +1,140 @@
+# copyright ################################# #
+# This file is part of the Xtrack Package.    #
+# Copyright (c) CERN, 2024.                   #
+# ########################################### #
+import threading
+
+import numpy as np
+import xobjects as xo
+import xtrack as xt
+from xtrack import kernel_cache
+
+
+def _make_line():
+    line = xt.Line(
+        elements=[xt.Drift(length=1.), xt.Multipole(knl=[0, 0.1]),
+                  xt.Drift(length=1.), xt.Multipole(knl=[0, -0.1])])
+    line.particle_ref = xt.Particles(p0c=1e9)
+    return line
+
+
+def test_kernel_cache(tmp_path, mocker, temp_context_default_func):
+
+    xt.enable_kernel_cache(tmp_path, max_entries=1)
+    try:
+        line = _make_line()
+        line.build_tracker(use_prebuilt_kernels=False)
+
+        so_files = list(tmp_path.glob('xtrack_track_kernel_*.so'))
+        assert len(so_files) == 1
+
+        p = line.build_particles(x=[1e-3, 2e-3])
+        line.track(p, num_turns=3)
+
+        # A new tracker for an equivalent line must not trigger compilation
+        spy = mocker.spy(xo.ContextCpu, 'compile_kernel')
+        line2 = _make_line()
+        line2.build_tracker(use_prebuilt_kernels=False)
+        assert spy.call_count == 0
+
+        p2 = line2.build_particles(x=[1e-3, 2e-3])
+        line2.track(p2, num_turns=3)
+        xo.assert_allclose(p2.x, p.x, rtol=0, atol=1e-15)
+        xo.assert_allclose(p2.px, p.px, rtol=0, atol=1e-15)
+
+        # A different configuration gives a different kernel, the least
+        # recently used one is evicted
+        line2.config.XTRACK_MULTIPOLE_NO_SYNRAD = False
+        line2.config.XTRACK_GLOBAL_XY_LIMIT = 1.
+        line2.tracker.get_track_kernel_and_data_for_present_config()
+        assert spy.call_count == 1
+        so_files_new = list(tmp_path.glob('xtrack_track_kernel_*.so'))
+        assert len(so_files_new) == 1
+        assert so_files_new[0] != so_files[0]
+    finally:
+        xt.disable_kernel_cache()
+
+    assert kernel_cache.get_kernel_cache_directory() is None
+
+
+def test_kernel_cache_eviction_during_load(tmp_path, mocker,
+                                           temp_context_default_func):
+
+    xt.enable_kernel_cache(tmp_path)
+    try:
+        line = _make_line()
+        line.build_tracker(use_prebuilt_kernels=False)
+        so_files = list(tmp_path.glob('xtrack_track_kernel_*.so'))
+        assert len(so_files) == 1
+
+        # Hold the loading of the cached kernel until an eviction of the
+        # whole cache has run
+        load_started = threading.Event()
+        evicted = threading.Event()
+        kernels_from_file = xo.ContextCpu.kernels_from_file
+
+        def held_kernels_from_file(self, *args, **kwargs):
+            load_started.set()
+            assert evicted.wait(timeout=60)
+            return kernels_from_file(self, *args, **kwargs)
+
+        mocker.patch.object(xo.ContextCpu, 'kernels_from_file',
+                            held_kernels_from_file)
+        spy = mocker.spy(xo.ContextCpu, 'compile_kernel')
+
+        line2 = _make_line()
+        thread = threading.Thread(
+            target=line2.build_tracker,
+            kwargs={'use_prebuilt_kernels': False})
+        thread.start()
+        try:
+            assert load_started.wait(timeout=60)
+            kernel_cache.evict_kernel_cache(max_entries=0)
+            # The entry being loaded is not removed
+            assert list(tmp_path.glob('xtrack_track_kernel_*.so')) == so_files
+        finally:
+            evicted.set()
+            thread.join()
+
+        assert spy.call_count == 0
+        p = line.build_particles(x=[1e-3, 2e-3])
+        p2 = line2.build_particles(x=[1e-3, 2e-3])
+        line.track(p, num_turns=3)
+        line2.track(p2, num_turns=3)
+        xo.assert_allclose(p2.x, p.x, rtol=0, atol=1e-15)
+
+        # Once the load is done, the entry can be evicted
+        kernel_cache.evict_kernel_cache(max_entries=0)
+        assert list(tmp_path.glob('xtrack_track_kernel_*.so')) == []
+    finally:
+        xt.disable_kernel_cache()
+
+
+def test_kernel_cache_key_sources(tmp_path):
+
+    header = tmp_path / 'extra_header.h'
+    header.write_text('#define XT_TEST_VALUE 1\n')
+
+    def key(element_classes):
+        return kernel_cache.kernel_cache_key(
+            element_classes=element_classes, hashable_config=(),
+            local_particle_src='', context=xo.ContextCpu(),
+            extra_headers=[header])
+
+    key0 = key([xt.Drift, xt.Multipole])
+    assert key([xt.Drift, xt.Multipole]) == key0
+
+    # Content of the extra headers
+    header.write_text('#define XT_TEST_VALUE 2\n')
+    key1 = key([xt.Drift, xt.Multipole])
+    assert key1 != key0
+
+    # Content of the element sources
+    original_sources = list(xt.Multipole._XoStruct._extra_c_sources)
+    try:
+        xt.Multipole._XoStruct._extra_c_sources = original_sources + [
+            '/* modified source */']
+        assert key([xt.Drift, xt.Multipole]) != key1
+    finally:
+        xt.Multipole._XoStruct._extra_c_sources = original_sources
+    assert key([xt.Drift, xt.Multipole]) == key1
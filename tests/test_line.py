@@ -640,6 +640,86 @@ def test_optimize_multipoles(test_context):
         else:
             assert type(test_line.element_dict[nn]) is xt.Multipole
 
+def test_fuse_linear_elements():
+    elements = {
+        'd1': xt.Drift(length=1),
+        'qf': xt.Multipole(knl=[0, 0.1]),
+        'd2': xt.Drift(length=2),
+        'qd': xt.SimpleThinQuadrupole(knl=[0, -0.1]),
+        'sk': xt.Multipole(knl=[0], ksl=[0, 0.01]),
+        'm1': xt.Marker(),
+        'd3': xt.Drift(length=1),
+        'sx': xt.Multipole(knl=[0, 0.1, 1.]),
+        'd4': xt.Drift(length=1),
+        'rot': xt.SRotation(angle=10.),
+        'd5': xt.Drift(length=1.5),
+    }
+    line = xt.Line(elements=elements, element_names=list(elements.keys()))
+    line.particle_ref = xt.Particles(p0c=1e9, mass0=xt.PROTON_MASS_EV)
+
+    line_ref = line.copy()
+    line_ref.build_tracker()
+
+    # Drifts are not fused by default, as their chromatic terms are dropped
+    line_thin = line_ref.copy()
+    line_thin.fuse_linear_elements()
+    assert line_thin.element_names == [
+        'd1', 'qf', 'd2', 'qd_to_sk_fused', 'm1', 'd3', 'sx', 'd4', 'rot',
+        'd5']
+
+    line.fuse_linear_elements(fuse_drifts=True)
+
+    assert line.element_names == [
+        'd1_to_sk_fused', 'm1', 'd3', 'sx', 'd4_to_d5_fused']
+    assert isinstance(line['d1_to_sk_fused'], xt.FirstOrderTaylorMap)
+    assert line['d1_to_sk_fused'].length == 3
+    xo.assert_allclose(line.get_length(), line_ref.get_length(),
+                       rtol=0, atol=1e-15)
+
+    line.build_tracker()
+    p_ref = line.build_particles(x=[-1e-4, 0, 2e-4], px=[1e-6, 0, -1e-6],
+                                 y=[0, 1e-4, 3e-4], py=[-2e-6, 1e-6, 0])
+    p_fused = p_ref.copy()
+    line_ref.track(p_ref)
+    line.track(p_fused)
+
+    for nn in ['x', 'px', 'y', 'py', 'delta', 's']:
+        xo.assert_allclose(getattr(p_fused, nn), getattr(p_ref, nn),
+                           rtol=0, atol=1e-11)
+    # Path lengthening is second order in px, py
+    xo.assert_allclose(p_fused.zeta, p_ref.zeta, rtol=0, atol=1e-8)
+
+    # Fusion is rejected if the tolerance is not met
+    line_chk = line_ref.copy()
+    line_chk.fuse_linear_elements(fuse_drifts=True, check_tolerance=1e-15,
+                                  keep='d5')
+    assert line_chk.element_names == list(line_ref.element_names)
+
+    line_chk = line_ref.copy()
+    line_chk.fuse_linear_elements(fuse_drifts=True, check_tolerance=1e-6,
+                                  keep='d5')
+    assert line_chk.element_names == [
+        'd1_to_sk_fused', 'm1', 'd3', 'sx', 'd4_to_rot_fused', 'd5']
+
+
+def test_fuse_linear_elements_rejected_run_unchanged():
+    line = xt.Line(
+        elements={
+            'd1': xt.Drift(length=1),
+            'q1': xt.Multipole(knl=[0, 0.1]),
+            'd2': xt.Replica(parent_name='d1'),
+            'q2': xt.Replica(parent_name='q1'),
+        },
+        element_names=['d1', 'q1', 'd2', 'q2'])
+    line.particle_ref = xt.Particles(p0c=1e9, mass0=xt.PROTON_MASS_EV)
+
+    line.fuse_linear_elements(fuse_drifts=True, check_tolerance=1e-15)
+
+    assert line.element_names == ['d1', 'q1', 'd2', 'q2']
+    assert isinstance(line.element_dict['d2'], xt.Replica)
+    assert isinstance(line.element_dict['q2'], xt.Replica)
+
+
 def test_from_json_to_json(tmp_path):
 
     line = xt.Line(
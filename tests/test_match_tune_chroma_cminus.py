@@ -2,6 +2,9 @@ import json
 import pathlib
 import time
 
+import numpy as np
+import pytest
+
 import xobjects as xo
 import xpart as xp
 import xtrack as xt
@@ -277,3 +280,235 @@ def test_match_chroma_knob(test_context):
 
 
 
+
+def _fodo_ring_with_knobs():
+    n_cells = 16
+    angle = 2 * np.pi / n_cells / 2
+    cell = [
+        xt.Multipole(knl=[0, 0.], length=0.3),
+        xt.Drift(length=0.2),
+        xt.Multipole(knl=[0, 0, 0.]),
+        xt.Drift(length=1.5),
+        xt.Multipole(knl=[angle], hxl=[angle], length=2.),
+        xt.Drift(length=1.5),
+        xt.Multipole(knl=[0, 0.], length=0.3),
+        xt.Drift(length=0.2),
+        xt.Multipole(knl=[0, 0, 0.]),
+        xt.Drift(length=1.5),
+        xt.Multipole(knl=[angle], hxl=[angle], length=2.),
+        xt.Drift(length=1.5),
+    ]
+    names = ['qf', 'd1', 'sf', 'd2', 'mb1', 'd3',
+             'qd', 'd4', 'sd', 'd5', 'mb2', 'd6']
+    elements = {}
+    element_names = []
+    for ii in range(n_cells):
+        for nn, ee in zip(names, cell):
+            elements[f'{nn}.{ii}'] = ee.copy()
+            element_names.append(f'{nn}.{ii}')
+    line = xt.Line(elements=elements, element_names=element_names)
+    line.particle_ref = xt.Particles(p0c=10e9, mass0=xt.PROTON_MASS_EV)
+
+    line.vars['kqf'] = 0.1
+    line.vars['kqd'] = -0.1
+    line.vars['ksf'] = 0.
+    line.vars['ksd'] = 0.
+    line.vars['kq_trim'] = 0.
+    for ii in range(n_cells):
+        line.element_refs[f'qf.{ii}'].knl[1] = (
+                                    line.vars['kqf'] + line.vars['kq_trim'])
+        line.element_refs[f'qd.{ii}'].knl[1] = line.vars['kqd']
+        line.element_refs[f'sf.{ii}'].knl[2] = line.vars['ksf']
+        line.element_refs[f'sd.{ii}'].knl[2] = line.vars['ksd']
+    line.build_tracker()
+    return line
+
+def test_match_parallel_jacobian():
+
+    line = _fodo_ring_with_knobs()
+
+    vary = [xt.Vary('kqf', step=1e-7), xt.Vary('kqd', step=1e-7),
+            xt.Vary('ksf', step=1e-6), xt.Vary('ksd', step=1e-6)]
+    targets = [
+        xt.Target('qx', 3.31, tol=1e-6),
+        xt.Target(lambda tw: tw.qx - tw.qy, 0.12, tol=1e-6),
+        xt.Target('dqx', 2., tol=1e-3),
+        xt.Target('dqy', 3., tol=1e-3)]
+
+    knobs0 = {vv.name: line.vars[vv.name]._value for vv in vary}
+
+    opt_serial = line.match(method='4d', vary=vary, targets=targets)
+    knobs_serial = {vv.name: line.vars[vv.name]._value for vv in vary}
+    n_calls_serial = opt_serial._err.call_counter
+
+    for nn, vv in knobs0.items():
+        line.vars[nn] = vv
+
+    opt = line.match(method='4d', vary=vary, targets=targets,
+                     num_jacobian_workers=2)
+    assert isinstance(opt._err.get_jacobian, xt.match.ParallelJacobian)
+    assert opt._err.get_jacobian._pool is None # closed after solve
+    for nn, vv in knobs_serial.items():
+        xo.assert_allclose(line.vars[nn]._value, vv, rtol=1e-6, atol=1e-12)
+    assert opt._err.call_counter == n_calls_serial
+
+    tw = line.twiss(method='4d')
+    xo.assert_allclose(tw.qx, 3.31, atol=1e-6, rtol=0)
+    xo.assert_allclose(tw.qx - tw.qy, 0.12, atol=1e-6, rtol=0)
+
+    # Variables changed after the start of the workers are synchronized
+    opt = line.match(method='4d', vary=vary, targets=targets,
+                     num_jacobian_workers=2, solve=False)
+    mf = opt._err
+    x = mf._get_x()
+    jac_par = mf.get_jacobian(x)
+    line.vars['kq_trim'] = 2e-3
+    opt.disable(target=1)
+    jac_par_trim = mf.get_jacobian(x)
+    jac_serial_trim = type(mf).get_jacobian(mf, x)
+    mf.get_jacobian.close()
+
+    assert np.max(np.abs(jac_par_trim - jac_par)) > 1e-3
+    xo.assert_allclose(jac_par_trim, jac_serial_trim, rtol=1e-10, atol=1e-10)
+    assert np.all(jac_par_trim[1, :] == 0)
+
+def test_match_parallel_jacobian_without_fork(monkeypatch):
+
+    line = _fodo_ring_with_knobs()
+    opt = line.match(method='4d', solve=False,
+                     vary=[xt.Vary('kqf', step=1e-7)],
+                     targets=[xt.Target('qx', 3.31, tol=1e-6)])
+
+    monkeypatch.setattr(xt.match.multiprocessing, 'get_all_start_methods',
+                        lambda: ['spawn'])
+    with pytest.raises(RuntimeError, match='fork'):
+        xt.match.ParallelJacobian(opt._err, num_workers=2)
+
+def test_match_broyden_jacobian():
+
+    line = _fodo_ring_with_knobs()
+
+    vary = [xt.Vary('kqf', step=1e-7), xt.Vary('kqd', step=1e-7),
+            xt.Vary('ksf', step=1e-6), xt.Vary('ksd', step=1e-6)]
+    targets = [
+        xt.Target('qx', 1.53, tol=1e-6),
+        xt.Target('qy', 0.80, tol=1e-6),
+        xt.Target('dqx', 1., tol=1e-3),
+        xt.Target('dqy', 1., tol=1e-3)]
+
+    knobs0 = {vv.name: line.vars[vv.name]._value for vv in vary}
+
+    opt_fd = line.match(method='4d', vary=vary, targets=targets)
+    stats_fd = xt.match.match_stats(opt_fd)
+    assert 'num_broyden_updates' not in stats_fd
+    # One twiss in the preparation and one for the initial values
+    assert stats_fd['num_twiss_calls'] == stats_fd['num_merit_function_calls'] + 2
+
+    for nn, vv in knobs0.items():
+        line.vars[nn] = vv
+
+    opt = line.match(method='4d', vary=vary, targets=targets,
+                     jacobian_method='broyden')
+    stats = xt.match.match_stats(opt)
+
+    tw = line.twiss(method='4d')
+    xo.assert_allclose(tw.qx, 1.53, atol=1e-6, rtol=0)
+    xo.assert_allclose(tw.qy, 0.80, atol=1e-6, rtol=0)
+    xo.assert_allclose(tw.dqx, 1., atol=1e-3, rtol=0)
+    xo.assert_allclose(tw.dqy, 1., atol=1e-3, rtol=0)
+
+    assert stats['num_full_jacobians'] >= 1
+    assert stats['num_broyden_updates'] >= 1
+    assert stats['num_twiss_calls'] < stats_fd['num_twiss_calls']
+
+def test_match_analytical_jacobian():
+
+    line = _fodo_ring_with_knobs()
+    tw0 = line.twiss(method='4d')
+
+    vary = [xt.Vary('kqf', step=1e-7), xt.Vary('kqd', step=1e-7),
+            xt.Vary('kq_trim', step=1e-7), xt.Vary('ksf', step=1e-6)]
+    targets = [
+        xt.Target('betx', 10., at='sd.5'), xt.Target('bety', 10., at='qf.3'),
+        xt.Target('alfx', 0., at='sf.9'), xt.Target('alfy', 0., at='mb1.2'),
+        xt.Target('mux', 1., at='sd.12'), xt.Target('muy', 1., at='d1.4'),
+        xt.Target('dx', 1., at='qd.7'), xt.Target('dpx', 0., at='sf.3'),
+        xt.TargetRelPhaseAdvance('mux', 1., start='qf.2', end='qd.10')]
+
+    # Analytical Jacobian against finite differences (periodic and open)
+    for twiss_kwargs, tars in [
+            ({}, targets + [xt.Target('qx', 1.5), xt.Target('qy', 1.5)]),
+            ({'start': 'qf.0', 'end': '_end_point',
+              'init': tw0.get_twiss_init('qf.0')}, targets)]:
+        opt = line.match(method='4d', vary=vary, targets=tars, solve=False,
+                         jacobian_method='analytical', **twiss_kwargs)
+        merit_function = opt._err
+        x = merit_function._get_x()
+        f0 = merit_function(x)
+        jac = merit_function.get_jacobian(x, f0=f0)
+        jac_fd = xt.match._finite_difference_columns(
+                                    merit_function, x, f0, range(len(x)))
+        xo.assert_allclose(jac, jac_fd, rtol=0,
+                           atol=1e-4 * np.max(np.abs(jac_fd)))
+
+        stats = xt.match.match_stats(opt)
+        # The sextupole knob is handled with finite differences
+        assert stats['num_analytical_columns'] == 3
+        assert stats['num_finite_difference_columns'] == 1
+
+    # Matching
+    vary = [xt.Vary('kqf', step=1e-7), xt.Vary('kqd', step=1e-7)]
+    targets = [xt.Target('qx', 1.53, tol=1e-6),
+               xt.Target('qy', 0.80, tol=1e-6)]
+
+    knobs0 = {vv.name: line.vars[vv.name]._value for vv in vary}
+    opt_fd = line.match(method='4d', vary=vary, targets=targets)
+    stats_fd = xt.match.match_stats(opt_fd)
+
+    for nn, vv in knobs0.items():
+        line.vars[nn] = vv
+
+    opt = line.match(method='4d', vary=vary, targets=targets,
+                     jacobian_method='analytical')
+    stats = xt.match.match_stats(opt)
+
+    tw = line.twiss(method='4d')
+    xo.assert_allclose(tw.qx, 1.53, atol=1e-6, rtol=0)
+    xo.assert_allclose(tw.qy, 0.80, atol=1e-6, rtol=0)
+    assert stats['num_finite_difference_columns'] == 0
+    assert stats['num_twiss_calls'] < stats_fd['num_twiss_calls']
+
+    # Targets not covered by the analytical response (chromaticity) are
+    # handled with finite differences
+    opt = line.match(method='4d', vary=vary, solve=False,
+                     targets=targets + [xt.Target('dqx', 1., tol=1e-3)],
+                     jacobian_method='analytical')
+    merit_function = opt._err
+    merit_function.get_jacobian(merit_function._get_x())
+    stats = xt.match.match_stats(opt)
+    assert stats['num_analytical_columns'] == 0
+    assert stats['num_finite_difference_columns'] == 2
+
+def test_match_compiled_knobs():
+
+    line = _fodo_ring_with_knobs()
+
+    vary = [xt.Vary('kqf', step=1e-7), xt.Vary('kqd', step=1e-7)]
+    targets = [xt.Target('qx', 1.53, tol=1e-6),
+               xt.Target('qy', 0.80, tol=1e-6)]
+
+    opt = line.match(method='4d', vary=vary, targets=targets,
+                     compile_knobs=True)
+    assert isinstance(opt.vary[0].container, xt.CompiledKnobs)
+
+    tw = line.twiss(method='4d')
+    xo.assert_allclose(tw.qx, 1.53, atol=1e-6, rtol=0)
+    xo.assert_allclose(tw.qy, 0.80, atol=1e-6, rtol=0)
+
+    # The variables of the line are consistent with the elements
+    knl_qf = line['qf.0'].knl[1]
+    knl_qd = line['qd.0'].knl[1]
+    line.vars['kqf'] = line.vv['kqf']
+    line.vars['kqd'] = line.vv['kqd']
+    assert line['qf.0'].knl[1] == knl_qf
+    assert line['qd.0'].knl[1] == knl_qd
@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 
 import xtrack as xt
 from xobjects.test_helpers import for_all_test_contexts
@@ -135,3 +136,78 @@ def test_custom_setter_empty(test_context):
 
     values = qf_setter.get_values()
     assert not np.size(ctx2np(values))
+
+
+@for_all_test_contexts
+def test_compiled_knobs(test_context):
+    line = xt.Line(elements=dict(
+                qf1=xt.Multipole(knl=[0, 0.1]),
+                qf2=xt.Multipole(knl=[0, 0.2]),
+                qd1=xt.Quadrupole(k1=-0.1, length=1.),
+                dr=xt.Drift(length=1.)),
+            element_names=['qf1', 'dr', 'qf2', 'dr', 'qd1', 'dr'])
+
+    line.vars['kf'] = 0.1
+    line.vars['kd'] = -0.1
+    line.vars['trim'] = 0.
+    line.vars['kf_half'] = line.vars['kf'] / 2
+    line.element_refs['qf1'].knl[1] = line.vars['kf'] + line.vars['trim']
+    line.element_refs['qf2'].knl[1] = 2 * line.vars['kf_half'] + 0.1
+    line.element_refs['qd1'].k1 = line.vars['kd'] - 3 * line.vars['trim']
+
+    line.build_tracker(_context=test_context)
+
+    knobs = line.compile_knobs(['kf', 'kd', 'trim'])
+    assert set(knobs.keys()) == {'kf', 'kd', 'trim'}
+
+    knobs['kf'] = 0.3
+    assert np.isclose(line['qf1'].knl[1], 0.3, atol=1e-15, rtol=0)
+    assert np.isclose(line['qf2'].knl[1], 0.4, atol=1e-15, rtol=0)
+    assert np.isclose(line['qd1'].k1, -0.1, atol=1e-15, rtol=0)
+    assert knobs['kf'] == 0.3
+    assert line.vv['kf'] == 0.3
+    assert np.isclose(line.vv['kf_half'], 0.15, atol=1e-15, rtol=0)
+
+    knobs.update({'kd': -0.2, 'trim': 0.01})
+    assert np.isclose(line['qf1'].knl[1], 0.31, atol=1e-15, rtol=0)
+    assert np.isclose(line['qf2'].knl[1], 0.4, atol=1e-15, rtol=0)
+    assert np.isclose(line['qd1'].k1, -0.23, atol=1e-15, rtol=0)
+
+    # Same result through the dependency graph
+    line.vars['kf'] = 0.3
+    line.vars['kd'] = -0.2
+    line.vars['trim'] = 0.01
+    assert np.isclose(line['qf1'].knl[1], 0.31, atol=1e-15, rtol=0)
+    assert np.isclose(line['qf2'].knl[1], 0.4, atol=1e-15, rtol=0)
+    assert np.isclose(line['qd1'].k1, -0.23, atol=1e-15, rtol=0)
+
+    # Changes through non-compiled variables are preserved
+    knobs_kf = line.compile_knobs(['kf'])
+    line.vars['trim'] = 0.02
+    knobs_kf['kf'] = 0.4
+    assert np.isclose(line['qf1'].knl[1], 0.42, atol=1e-15, rtol=0)
+    assert np.isclose(line['qf2'].knl[1], 0.5, atol=1e-15, rtol=0)
+    assert np.isclose(line['qd1'].k1, -0.26, atol=1e-15, rtol=0)
+    assert np.isclose(line.vv['kf_half'], 0.2, atol=1e-15, rtol=0)
+
+    # The knob is updated also if changed through the graph
+    line.vars['kf'] = 0.5
+    assert knobs_kf['kf'] == 0.5
+    knobs_kf['kf'] = 0.6
+    assert np.isclose(line['qf1'].knl[1], 0.62, atol=1e-15, rtol=0)
+
+    # Buffer and graph agree
+    line.vars['kf'] = line.vv['kf']
+    line.vars['trim'] = line.vv['trim']
+    assert np.isclose(line['qf1'].knl[1], 0.62, atol=1e-15, rtol=0)
+    assert np.isclose(line['qf2'].knl[1], 0.7, atol=1e-15, rtol=0)
+
+    # Non-linear dependencies cannot be compiled
+    line.element_refs['qf2'].knl[1] = line.vars['kf'] * line.vars['kd']
+    with pytest.raises(ValueError):
+        line.compile_knobs(['kf', 'kd'])
+    line.element_refs['qf2'].knl[1] = line.vars['kf']**2
+    with pytest.raises(ValueError):
+        line.compile_knobs(['kf'])
+    with pytest.raises(ValueError):
+        line.compile_knobs(['kf_half'])
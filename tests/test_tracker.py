@@ -3,11 +3,13 @@
 # Copyright (c) CERN, 2021.                 #
 # ######################################### #
 import json
+import os
 import pathlib
 
 import numpy as np
 import pytest
 from cpymad.madx import Madx
+from scipy.constants import c as clight
 
 import xobjects as xo
 import xpart as xp
@@ -584,6 +586,423 @@ def test_tbt_monitor_with_progress(test_context, ele_start, ele_stop, expected_x
     xo.assert_allclose(recorded_x, expected_x, atol=1e-16)
 
 
+@for_all_test_contexts
+@pytest.mark.parametrize('ele_start,ele_stop', [(None, None), (2, 3)])
+def test_tracking_with_compaction_of_lost_particles(test_context, ele_start,
+                                                    ele_stop):
+    line = xt.Line(elements=[
+        xt.Drift(length=1.), xt.Multipole(knl=[0, 0.5, 3.]),
+        xt.Drift(length=1.), xt.Multipole(knl=[0, -0.5]),
+        xt.LimitEllipse(a=0.01, b=0.01)])
+    line.build_tracker(_context=test_context)
+
+    x0 = np.linspace(0, 1.2e-2, 50)
+    p_ref = xt.Particles(x=x0, p0c=1e9, _context=test_context)
+    p_comp = p_ref.copy()
+
+    if (not isinstance(test_context, xo.ContextCpu)
+            or test_context.openmp_enabled):
+        with pytest.raises(NotImplementedError):
+            line.track(p_comp, num_turns=20, compact_lost_particles=True)
+        return
+
+    line.track(p_ref, num_turns=20, turn_by_turn_monitor=True,
+               ele_start=ele_start, ele_stop=ele_stop)
+    mon_ref = line.record_last_track
+
+    line.track(p_comp, num_turns=20, turn_by_turn_monitor=True,
+               ele_start=ele_start, ele_stop=ele_stop,
+               compact_lost_particles=0.1, compaction_interval=3)
+    mon_comp = line.record_last_track
+
+    p_ref.move(_context=xo.context_default)
+    p_comp.move(_context=xo.context_default)
+    p_ref.sort(interleave_lost_particles=True)
+    p_comp.sort(interleave_lost_particles=True)
+
+    n_lost = np.sum(p_ref.state <= 0)
+    assert 0 < n_lost < len(x0)
+
+    for nn in ['particle_id', 'state', 'at_turn', 'at_element', 'x', 'px',
+               'zeta', 's']:
+        xo.assert_allclose(getattr(p_comp, nn), getattr(p_ref, nn),
+                           rtol=0, atol=1e-15)
+    xo.assert_allclose(mon_comp.x, mon_ref.x, rtol=0, atol=1e-15)
+    xo.assert_allclose(mon_comp.at_turn, mon_ref.at_turn, rtol=0, atol=0)
+
+
+@for_all_test_contexts
+@pytest.mark.parametrize('collective', [False, True],
+                         ids=['non-collective', 'collective'])
+def test_tracking_with_stop_condition(test_context, collective):
+    line = xt.Line(elements=[
+        xt.Drift(length=1.), xt.Multipole(knl=[0, 0.5, 3.]),
+        xt.Drift(length=1.), xt.Multipole(knl=[0, -0.5]),
+        xt.LimitEllipse(a=0.01, b=0.01)])
+    line.elements[2].iscollective = collective
+    line.build_tracker(_context=test_context)
+
+    # All particles are lost within a few turns
+    p = xt.Particles(x=np.linspace(8e-3, 1e-2, 10), p0c=1e9,
+                     _context=test_context)
+    line.track(p, num_turns=1000, turn_by_turn_monitor=True,
+               stop_condition='all_lost', stop_condition_interval=10)
+    p.move(_context=xo.context_default)
+    assert np.all(p.state <= 0)
+    assert np.max(p.at_turn) < 10
+    mon = line.record_last_track
+    assert mon.x.shape == (10, 10)
+
+    p_ref = xt.Particles(x=np.linspace(8e-3, 1e-2, 10), p0c=1e9,
+                         _context=test_context)
+    line.track(p_ref, num_turns=10, turn_by_turn_monitor=True)
+    xo.assert_allclose(mon.x, line.record_last_track.x, rtol=0, atol=1e-15)
+
+    # User defined condition
+    p = xt.Particles(x=np.linspace(0, 1e-3, 10), p0c=1e9,
+                     _context=test_context)
+    line.track(p, num_turns=1000, stop_condition_interval=7,
+               stop_condition=lambda pp: np.max(
+                   pp._context.nparray_from_context_array(pp.at_turn)) >= 20)
+    p.move(_context=xo.context_default)
+    assert np.all(p.state > 0)
+    assert np.all(p.at_turn == 21)
+
+
+@for_all_test_contexts
+@pytest.mark.parametrize('ele_start,ele_stop', [(None, None), (1, 4), (3, 2)])
+def test_tracking_with_specialized_kernel(test_context, ele_start, ele_stop):
+    line = xt.Line(elements=[
+        xt.Drift(length=1.), xt.Multipole(knl=[0, 0.5, 3.]),
+        xt.Drift(length=1.), xt.Multipole(knl=[0, -0.5]),
+        xt.LimitEllipse(a=0.01, b=0.01)])
+    line.build_tracker(_context=test_context)
+
+    x0 = np.linspace(0, 1.2e-2, 20)
+    p_ref = xt.Particles(x=x0, p0c=1e9, _context=test_context)
+    p_spec = p_ref.copy()
+
+    line.track(p_ref, num_turns=10, turn_by_turn_monitor=True,
+               ele_start=ele_start, ele_stop=ele_stop)
+    mon_ref = line.record_last_track
+
+    line.config.XTRACK_SPECIALIZED_KERNEL = True
+    line.track(p_spec, num_turns=10, turn_by_turn_monitor=True,
+               ele_start=ele_start, ele_stop=ele_stop)
+    mon_spec = line.record_last_track
+
+    p_ref.move(_context=xo.context_default)
+    p_spec.move(_context=xo.context_default)
+    p_ref.sort(interleave_lost_particles=True)
+    p_spec.sort(interleave_lost_particles=True)
+
+    for nn in ['particle_id', 'state', 'at_turn', 'at_element', 'x', 'px',
+               'zeta', 's']:
+        xo.assert_allclose(getattr(p_spec, nn), getattr(p_ref, nn),
+                           rtol=0, atol=1e-15)
+    xo.assert_allclose(mon_spec.x, mon_ref.x, rtol=0, atol=1e-15)
+
+    # Element by element monitor
+    p_ref = xt.Particles(x=x0[:5], p0c=1e9, _context=test_context)
+    p_spec = p_ref.copy()
+    line.config.XTRACK_SPECIALIZED_KERNEL = False
+    line.track(p_ref, num_turns=3, turn_by_turn_monitor='ONE_TURN_EBE')
+    mon_ref = line.record_last_track
+    line.config.XTRACK_SPECIALIZED_KERNEL = True
+    line.track(p_spec, num_turns=3, turn_by_turn_monitor='ONE_TURN_EBE')
+    xo.assert_allclose(line.record_last_track.x, mon_ref.x, rtol=0, atol=1e-15)
+
+
+def test_specialized_kernel_max_elements(monkeypatch):
+    line = xt.Line(elements=[
+        xt.Drift(length=1.), xt.Multipole(knl=[0, 0.5]),
+        xt.Drift(length=1.), xt.Multipole(knl=[0, -0.5])])
+    line.build_tracker()
+    line.config.XTRACK_SPECIALIZED_KERNEL = True
+    assert line.tracker._is_specialized_kernel()
+
+    # Longer lines fall back to the generic kernel
+    monkeypatch.setattr(xt.tracker, 'SPECIALIZED_KERNEL_MAX_ELEMENTS', 3)
+    assert not line.tracker._is_specialized_kernel()
+    kernel, _ = line.tracker.get_track_kernel_and_data_for_present_config()
+    assert kernel is line.tracker.track_kernel[
+        line.tracker._hashable_config()]
+
+    p = xt.Particles(x=[1e-3, 2e-3], p0c=1e9)
+    p_ref = p.copy()
+    line.track(p, num_turns=5)
+    line.config.XTRACK_SPECIALIZED_KERNEL = False
+    line.track(p_ref, num_turns=5)
+    xo.assert_allclose(p.x, p_ref.x, rtol=0, atol=1e-15)
+
+
+@pytest.mark.parametrize('specialized', [False, True])
+def test_element_profiling(specialized):
+    line = xt.Line(elements=[
+        xt.Drift(length=1.), xt.Multipole(knl=[0, 0.5, 3.]),
+        xt.Drift(length=1.), xt.Multipole(knl=[0, -0.5]),
+        xt.LimitEllipse(a=0.01, b=0.01)])
+    line.build_tracker()
+    line.config.XTRACK_SPECIALIZED_KERNEL = specialized
+    line.config.XTRACK_PROFILE_ELEMENTS = True
+
+    p = xt.Particles(x=np.linspace(0, 1.2e-2, 100), p0c=1e9)
+    line.track(p, num_turns=20)
+
+    tab = line.tracker.get_profile_table()
+    assert np.all(tab.name == np.array(line.element_names))
+    assert np.all(tab.time > 0)
+    # Particles lost in the aperture are counted at the aperture
+    assert np.all(tab.num_particles == np.sum(p.at_turn + (p.state <= 0)))
+    assert tab.num_particle_turns == np.sum(p.at_turn)
+    xo.assert_allclose(tab.total_time, np.sum(tab.time), rtol=1e-12, atol=0)
+    assert tab.particle_turns_per_second > 0
+
+    tab_cls = line.tracker.get_profile_table(by_class=True)
+    assert list(tab_cls.name) == ['Drift', 'LimitEllipse', 'Multipole']
+    assert tab_cls['num_particles', 'Drift'] == 2 * tab.num_particles[0]
+
+    # Counts accumulate over the tracking calls until reset
+    line.track(p, num_turns=1)
+    tab2 = line.tracker.get_profile_table()
+    assert np.all(tab2.num_particles > tab.num_particles)
+    line.tracker.reset_profile()
+    tab_reset = line.tracker.get_profile_table()
+    assert np.all(tab_reset.time == 0)
+    assert np.all(tab_reset.num_particles == 0)
+    assert tab_reset.num_particle_turns == 0
+
+    # The location of the record is not compiled into the kernel
+    num_kernels = len(line.tracker.track_kernel)
+    line.tracker._element_profile_record = None
+    p = xt.Particles(x=np.linspace(0, 1.2e-2, 100), p0c=1e9)
+    line.track(p, num_turns=20)
+    assert len(line.tracker.track_kernel) == num_kernels
+    tab3 = line.tracker.get_profile_table()
+    assert np.all(tab3.num_particles == tab.num_particles)
+
+
+@pytest.mark.parametrize('time_dependent', [False, True],
+                         ids=['static', 'time-dependent'])
+def test_checkpoint_and_resume(tmp_path, time_dependent):
+    line = xt.Line(
+        elements={
+            'arc': xt.LineSegmentMap(qx=0.27, qy=0.31, betx=1., bety=1.,
+                                     gauss_noise_ampl_px=1e-6,
+                                     gauss_noise_ampl_py=1e-6),
+            'kick': xt.Multipole(knl=[0, 0., 10.]),
+            'aper': xt.LimitEllipse(a=1e-2, b=1e-2)},
+        element_names=['arc', 'kick', 'aper'])
+    line.particle_ref = xt.Particles(p0c=1e9)
+    if time_dependent:
+        line.vars['k2'] = 1e6 * line.vars['t_turn_s']
+        line.element_refs['kick'].knl[2] = line.vars['k2']
+        line.enable_time_dependent_vars = True
+        line.dt_update_time_dependent_vars = 3e-7
+    line.build_tracker()
+
+    def get_particles():
+        p = line.build_particles(x=np.linspace(0, 1e-2, 20), y=1e-4)
+        p._init_random_number_generator(seeds=np.arange(20))
+        return p
+
+    p_ref = get_particles()
+    line.track(p_ref, num_turns=25, turn_by_turn_monitor=True)
+    mon_ref = line.record_last_track
+
+    p = get_particles()
+    line.track(p, num_turns=25, turn_by_turn_monitor=True,
+               checkpoint_every=5, checkpoint_path=tmp_path / 'chk',
+               checkpoint_keep=3)
+    assert sorted(ff.name for ff in (tmp_path / 'chk').iterdir()) == [
+        'checkpoint_0000000010.pkl', 'checkpoint_0000000015.pkl',
+        'checkpoint_0000000020.pkl']
+
+    # Restart after turn 10 as if the job had been interrupted
+    for nn in ['checkpoint_0000000015.pkl', 'checkpoint_0000000020.pkl']:
+        (tmp_path / 'chk' / nn).unlink()
+    line.vars['t_turn_s'] = 0
+    line._t_last_update_time_dependent_vars = None
+    p_res = line.resume_from_checkpoint(tmp_path / 'chk')
+    mon_res = line.record_last_track
+
+    for pp in [p, p_res]:
+        for nn in ['particle_id', 'state', 'at_turn', 'x', 'px', 'y', 'py',
+                   'zeta', 'delta', '_rng_s1', '_rng_s4']:
+            xo.assert_allclose(getattr(pp, nn), getattr(p_ref, nn),
+                               rtol=0, atol=0)
+    xo.assert_allclose(mon_res.x, mon_ref.x, rtol=0, atol=0)
+    xo.assert_allclose(mon_res.py, mon_ref.py, rtol=0, atol=0)
+    assert sorted(ff.name for ff in (tmp_path / 'chk').iterdir()) == [
+        'checkpoint_0000000010.pkl', 'checkpoint_0000000015.pkl',
+        'checkpoint_0000000020.pkl']
+
+
+def test_precomputed_time_dependent_vars():
+
+    def get_line():
+        line = xt.Line(
+            elements={
+                'arc': xt.LineSegmentMap(qx=0.27, qy=0.31, betx=1., bety=1.,
+                                         length=100.),
+                'kick': xt.Multipole(knl=[0, 0., 10.]),
+                'quad': xt.Multipole(knl=[0, 0.]),
+                'aper': xt.LimitEllipse(a=1e-2, b=1e-2)},
+            element_names=['arc', 'kick', 'quad', 'aper'])
+        line.particle_ref = xt.Particles(p0c=1e9)
+        line.functions['fun_k2'] = xt.FunctionPieceWiseLinear(
+                                                x=[0, 1e-4], y=[0, 1e3])
+        line.vars['k2'] = line.functions['fun_k2'](line.vars['t_turn_s'])
+        line.vars['k1'] = 1e-6 * line.vars['k2']
+        line.element_refs['kick'].knl[2] = line.vars['k2']
+        line.element_refs['quad'].knl[1] = line.vars['k1']
+        line.enable_time_dependent_vars = True
+        line.build_tracker()
+        return line
+
+    num_turns = 50
+
+    line_ref = get_line()
+    p_ref = line_ref.build_particles(x=np.linspace(0, 5e-3, 20), y=1e-4)
+    line_ref.track(p_ref, num_turns=num_turns, turn_by_turn_monitor=True)
+
+    line = get_line()
+    t_rev = line.get_length() / (line.particle_ref.beta0[0] * clight)
+    table = line.precompute_time_dependent_vars(
+                                        np.arange(num_turns + 1) * t_rev)
+    assert table.field_names == ['kick.knl[2]', 'quad.knl[1]']
+    assert table.var_names == ['k2', 'k1']
+    xo.assert_allclose(table.field_values[:, 0],
+                       np.arange(num_turns + 1) * t_rev * 1e7,
+                       rtol=1e-12, atol=0)
+    # Sampling does not change the line
+    assert line['kick'].knl[2] == 0
+
+    p = line.build_particles(x=np.linspace(0, 5e-3, 20), y=1e-4)
+    line.track(p, num_turns=num_turns, turn_by_turn_monitor=True)
+
+    # Sampled and turn times may differ by rounding errors
+    xo.assert_allclose(line.record_last_track.x, line_ref.record_last_track.x,
+                       rtol=1e-10, atol=1e-20)
+    for nn in ['k2', 'k1']:
+        xo.assert_allclose(line.vv[nn], line_ref.vv[nn], rtol=1e-12, atol=0)
+    xo.assert_allclose(line['kick'].knl[2], line_ref['kick'].knl[2],
+                       rtol=1e-12, atol=0)
+    xo.assert_allclose(line['quad'].knl[1], line_ref['quad'].knl[1],
+                       rtol=1e-12, atol=0)
+
+    # Back to the evaluation of the dependency graph
+    line.precompute_time_dependent_vars(None)
+    assert line.tracker._time_dependent_vars_table is None
+
+
+def test_parallel_tracker(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    line = xt.Line(elements=[
+        xt.Drift(length=1.), xt.Multipole(knl=[0, 0.5, 3.]),
+        xt.Drift(length=1.), xt.Multipole(knl=[0, -0.5]),
+        xt.LimitEllipse(a=1e-2, b=1e-2)])
+    line.particle_ref = xt.Particles(p0c=1e9)
+    line.build_tracker()
+
+    def get_particles():
+        p = line.build_particles(x=np.linspace(0, 1e-2, 21), y=1e-4,
+                                 _capacity=30)
+        p._init_random_number_generator(seeds=np.arange(30))
+        return p
+
+    p_ref = get_particles()
+    line.track(p_ref, num_turns=20, turn_by_turn_monitor=True)
+    mon_ref = line.record_last_track
+
+    p = get_particles()
+    with xt.ParallelTracker(line, num_workers=3) as ptracker:
+        ptracker.track(p, num_turns=20, turn_by_turn_monitor=True)
+        # The workers compile their kernels in a private directory
+        assert ptracker._pool.submit(os.getcwd).result() != str(tmp_path)
+    mon = ptracker.record_last_track
+    assert list(tmp_path.iterdir()) == []
+
+    assert np.sum(p.state <= 0) > 0
+    assert p._capacity == 30
+    p_ref.sort(interleave_lost_particles=True)
+    p.sort(interleave_lost_particles=True)
+    for nn in ['particle_id', 'state', 'at_turn', 'at_element', 'x', 'px',
+               'y', 'py', 'zeta', 'delta', '_rng_s1', '_rng_s4']:
+        xo.assert_allclose(getattr(p, nn), getattr(p_ref, nn),
+                           rtol=0, atol=0)
+    assert mon.x.shape == mon_ref.x.shape
+    xo.assert_allclose(mon.x, mon_ref.x, rtol=0, atol=0)
+    xo.assert_allclose(mon.px, mon_ref.px, rtol=0, atol=0)
+
+
+
+def test_track_async():
+    lines = [xt.Line(elements=[
+        xt.Drift(length=1.), xt.Multipole(knl=[0, kk, 3.]),
+        xt.Drift(length=1.), xt.Multipole(knl=[0, -kk]),
+        xt.LimitEllipse(a=1e-2, b=1e-2)]) for kk in [0.5, 0.6]]
+    for line in lines:
+        line.particle_ref = xt.Particles(p0c=1e9)
+        line.build_tracker()
+
+    def get_particles(line):
+        return line.build_particles(x=np.linspace(0, 1e-2, 21), y=1e-4)
+
+    p_ref = []
+    mon_ref = []
+    for line in lines:
+        p_ref.append(get_particles(line))
+        line.track(p_ref[-1], num_turns=50, turn_by_turn_monitor=True)
+        mon_ref.append(line.record_last_track)
+        # Shorter tracking in the main thread, to be superseded by the
+        # asynchronous one
+        line.track(get_particles(line), num_turns=10,
+                   turn_by_turn_monitor=True)
+        assert line.record_last_track.x.shape[1] == 10
+
+    # Track the two lines at the same time
+    p_async = [get_particles(line) for line in lines]
+    futures = [line.track_async(pp, num_turns=50, turn_by_turn_monitor=True)
+               for line, pp in zip(lines, p_async)]
+    for ff in futures:
+        ff.result()
+
+    for line, pp, p0, m0 in zip(lines, p_async, p_ref, mon_ref):
+        for nn in ['particle_id', 'state', 'at_turn', 'x', 'px', 'y']:
+            xo.assert_allclose(getattr(pp, nn), getattr(p0, nn),
+                               rtol=0, atol=0)
+        assert line.record_last_track.x.shape == m0.x.shape
+        xo.assert_allclose(line.record_last_track.x, m0.x, rtol=0, atol=0)
+
+    # Awaitable form
+    import asyncio
+
+    async def track_both(particles):
+        await asyncio.gather(*[
+            line.track_async(pp, num_turns=50, awaitable=True)
+            for line, pp in zip(lines, particles)])
+
+    p_aio = [get_particles(line) for line in lines]
+    asyncio.run(track_both(p_aio))
+    for pp, p0 in zip(p_aio, p_ref):
+        xo.assert_allclose(pp.x, p0.x, rtol=0, atol=0)
+        xo.assert_allclose(pp.state, p0.state, rtol=0, atol=0)
+
+
+def test_reorganize_with_rng_state():
+    p = xt.Particles(x=np.arange(10) * 1e-3, p0c=1e9)
+    p._init_random_number_generator()
+    rng_before = {nn: getattr(p, nn).copy()
+                  for nn in ['_rng_s1', '_rng_s2', '_rng_s3', '_rng_s4']}
+
+    p.state[[1, 4, 5]] = 0
+    p.reorganize(include_rng_state=True)
+
+    for nn, vv in rng_before.items():
+        xo.assert_allclose(getattr(p, nn), vv[p.particle_id], rtol=0, atol=0)
+
+
 @pytest.fixture
 def pimms_mad():
     pimms_path = test_data_folder / 'pimms/PIMMS.seq'
@@ -1,5 +1,6 @@
 import json
 import pathlib
+import sys
 from itertools import product
 
 import numpy as np
@@ -51,6 +52,544 @@ def test_twiss_4d_fodo_vs_beta_rel(test_context):
         xo.assert_allclose(tw.dqx, tw_4d_list[0].dqx, atol=1e-4, rtol=0)
         xo.assert_allclose(tw.dqy, tw_4d_list[0].dqy, atol=1e-4, rtol=0)
 
+def test_twiss_cache():
+    n = 6
+    fodo = [
+        xt.Multipole(length=0.2, knl=[0, +0.2], ksl=[0, 0]),
+        xt.Drift(length=1.0),
+        xt.Multipole(length=0.2, knl=[0, -0.2], ksl=[0, 0]),
+        xt.Drift(length=1.0),
+        xt.Multipole(length=1.0, knl=[2 * np.pi / n], hxl=[2 * np.pi / n]),
+        xt.Drift(length=1.0),
+    ]
+    line = xt.Line(elements=n * fodo)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.vars['kqf'] = 0.2
+    line.element_refs['e0'].knl[1] = line.vars['kqf']
+    line.build_tracker()
+
+    tw_ref = line.twiss(method='4d')
+
+    line.enable_twiss_cache(max_size=3)
+
+    def twiss_and_hit(**kwargs):
+        num_hits = line._twiss_cache.num_hits
+        tw = line.twiss(**kwargs)
+        return tw, line._twiss_cache.num_hits == num_hits + 1
+
+    tw1, hit = twiss_and_hit(method='4d')
+    assert not hit
+    tw, hit = twiss_and_hit(method='4d')
+    assert hit
+    assert tw is not tw1
+    xo.assert_allclose(tw.betx, tw_ref.betx, atol=0, rtol=1e-14)
+    with pytest.raises(ValueError):
+        tw1['betx'] = 0
+
+    # Changes to a returned table do not affect the cached one
+    tw1._data['qx'] = 0.
+    tw1['betx_new'] = 2 * tw1.betx
+    tw1.particle_on_co.x[:] = 1.
+    tw, hit = twiss_and_hit(method='4d')
+    assert hit
+    assert tw.qx == tw_ref.qx
+    assert 'betx_new' not in tw._col_names
+    assert tw.particle_on_co.x[0] == tw_ref.particle_on_co.x[0]
+
+    # Different arguments
+    tw_s, hit = twiss_and_hit(method='4d', start='e0', end='e5', betx=1,
+                              bety=1)
+    assert not hit
+    tw, hit = twiss_and_hit(method='4d', start='e0', end='e5', betx=1,
+                            bety=1)
+    assert hit
+
+    # Change of an independent variable
+    line.vars['kqf'] = 0.21
+    tw2, hit = twiss_and_hit(method='4d')
+    assert not hit
+    assert tw2.qx != tw_ref.qx
+    line.vars['kqf'] = 0.2
+    tw, hit = twiss_and_hit(method='4d')
+    assert hit
+    assert tw.qx == tw_ref.qx
+
+    # Write through element_refs and direct write to an element
+    line.element_refs['e2'].knl[1] = -0.21
+    tw3, hit = twiss_and_hit(method='4d')
+    assert not hit
+    assert tw3.qy != tw_ref.qy
+    line['e2'].knl[1] = -0.2
+    tw, hit = twiss_and_hit(method='4d')
+    assert hit
+    assert tw.qy == tw_ref.qy
+
+    # Least recently used tables are evicted
+    assert len(line._twiss_cache) == 3
+    _, hit = twiss_and_hit(method='4d', start='e0', end='e5', betx=1,
+                           bety=1)
+    assert not hit
+
+    # Calls with non-scalar arguments are not cached
+    p_co = tw_ref.particle_on_co
+    _, hit = twiss_and_hit(method='4d', particle_on_co=p_co)
+    assert not hit
+    _, hit = twiss_and_hit(method='4d', particle_on_co=p_co)
+    assert not hit
+    twiss_and_hit(method='4d', R_matrix=tw_ref.R_matrix)
+    _, hit = twiss_and_hit(method='4d', R_matrix=tw_ref.R_matrix.copy())
+    assert hit
+
+    line.disable_twiss_cache()
+    assert line.twiss(method='4d') is not line.twiss(method='4d')
+
+def test_twiss_matrix_engine():
+    n = 12
+    elements = []
+    for ii in range(n):
+        elements += [
+            xt.Quadrupole(length=0.3, k1=0.3, k1s=0.001),
+            xt.Drift(length=1.0),
+            xt.Multipole(knl=[0, -0.09, 0.05], ksl=[0, 0.001]),
+            xt.Drift(length=1.0),
+            xt.Bend(length=1.0, k0=2 * np.pi / n, h=2 * np.pi / n, k1=0.01,
+                    model='expanded', edge_entry_angle=0.05),
+            xt.Multipole(length=1.0, knl=[1e-4]),
+            xt.SRotation(angle=0.01),
+            xt.Cavity(voltage=(1e6 if ii == 0 else 0), frequency=400e6),
+            xt.Drift(length=1.0),
+        ]
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+
+    for method in ['4d', '6d']:
+        tw = line.twiss(method=method)
+        tw_mat = line.twiss(method=method, engine='matrix')
+
+        xo.assert_allclose(tw_mat.x, tw.x, atol=0, rtol=0)
+        for cc in ['betx', 'bety', 'mux', 'muy', 'dzeta']:
+            xo.assert_allclose(tw_mat[cc], tw[cc], atol=0, rtol=1e-8)
+        for cc in ['alfx', 'alfy', 'dx', 'dpx', 'dy', 'dpy', 'betx2', 'bety1']:
+            xo.assert_allclose(tw_mat[cc], tw[cc], atol=1e-7, rtol=0)
+        xo.assert_allclose(tw_mat.qx, tw.qx, atol=1e-10, rtol=0)
+        xo.assert_allclose(tw_mat.dqx, tw.dqx, atol=1e-7, rtol=0)
+
+    # Open twiss, element parameters are updated after a change
+    init = tw.get_twiss_init('e9')
+    tw_kwargs = dict(method='4d', start='e9', end='e80', init=init)
+    line.twiss(engine='matrix', **tw_kwargs)
+    line['e29'].knl[1] = -0.1
+    line['e31'].k0 = 0.5
+    tw = line.twiss(**tw_kwargs)
+    tw_mat = line.twiss(engine='matrix', **tw_kwargs)
+    for cc in ['betx', 'bety', 'mux', 'muy']:
+        xo.assert_allclose(tw_mat[cc], tw[cc], atol=0, rtol=1e-8)
+    for cc in ['alfx', 'alfy', 'dx', 'dpx']:
+        xo.assert_allclose(tw_mat[cc], tw[cc], atol=1e-7, rtol=0)
+
+def test_twiss_matrix_engine_shifts_and_tilts():
+    from xtrack.linear_maps import get_element_map_params
+
+    n = 12
+    elements = [xt.Cavity(voltage=1e6, frequency=400e6)]
+    for ii in range(n):
+        elements += [
+            xt.Quadrupole(length=0.3, k1=0.3,
+                          rot_s_rad=(0.05 if ii == 0 else 0)),
+            xt.Drift(length=1.0),
+            xt.Multipole(knl=[0, -0.09, 0.5], ksl=[0, 0.001],
+                         shift_x=(2e-3 if ii == 1 else 0)),
+            xt.Drift(length=1.0),
+            xt.Bend(length=1.0, k0=2 * np.pi / n, h=2 * np.pi / n,
+                    model='expanded', shift_y=(1e-3 if ii == 2 else 0),
+                    rot_s_rad=(0.02 if ii == 3 else 0)),
+            xt.Drift(length=1.0),
+        ]
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+
+    # Elements with shifts or tilts fall back to finite differences
+    params = get_element_map_params(line)
+    for ii in [1, 9, 17, 23]:
+        assert params[ii] == (None, None)
+    assert params[7][0] is not None
+
+    for method in ['4d', '6d']:
+        tw = line.twiss(method=method)
+        tw_mat = line.twiss(method=method, engine='matrix')
+
+        for cc in ['betx', 'bety', 'mux', 'muy']:
+            xo.assert_allclose(tw_mat[cc], tw[cc], atol=0, rtol=1e-7)
+        for cc in ['alfx', 'alfy', 'dx', 'dy', 'betx2', 'bety1']:
+            xo.assert_allclose(tw_mat[cc], tw[cc], atol=1e-6, rtol=0)
+        xo.assert_allclose(tw_mat.qx, tw.qx, atol=1e-7, rtol=0)
+        xo.assert_allclose(tw_mat.qy, tw.qy, atol=1e-7, rtol=0)
+
+def test_r_matrix_ebe_streaming():
+    n = 6
+    elements = []
+    for _ in range(n):
+        elements += [
+            xt.Multipole(length=0.2, knl=[0, +0.2], ksl=[0, 0.01]),
+            xt.Drift(length=1.0),
+            xt.Marker(),
+            xt.Multipole(length=0.2, knl=[0, -0.2], ksl=[0, 0]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=1.0, knl=[2 * np.pi / n], hxl=[2 * np.pi / n]),
+            xt.Drift(length=1.0),
+        ]
+    elements.append(xt.Cavity(frequency=400e6, voltage=1e6, lag=180))
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+
+    p_co = line.find_closed_orbit()
+    ref = line.compute_one_turn_matrix_finite_differences(p_co,
+                                                element_by_element=True)
+    assert ref['R_matrix_ebe'].shape == (len(line.element_names) + 1, 6, 6)
+
+    out = line.compute_one_turn_matrix_finite_differences(p_co,
+                        element_by_element=True, streaming=True, chunk_size=5)
+    xo.assert_allclose(out['R_matrix'], ref['R_matrix'], atol=1e-14, rtol=0)
+    xo.assert_allclose(out['R_matrix_ebe'], ref['R_matrix_ebe'],
+                       atol=1e-14, rtol=0)
+    xo.assert_allclose(out['R_matrix_ebe'][-1], ref['R_matrix'],
+                       atol=1e-14, rtol=0)
+
+    out = line.compute_one_turn_matrix_finite_differences(p_co,
+                        element_by_element=True, streaming=True, chunk_size=4,
+                        only_markers=True)
+    mask = np.array([isinstance(ee, xt.Marker) for ee in line.elements]
+                    + [True])
+    assert np.all(out['R_matrix_ebe_index'] == np.where(mask)[0])
+    xo.assert_allclose(out['R_matrix_ebe'], ref['R_matrix_ebe'][mask],
+                       atol=1e-14, rtol=0)
+
+    # Same selection without streaming
+    out = line.compute_one_turn_matrix_finite_differences(p_co,
+                        element_by_element=True, only_markers=True)
+    assert np.all(out['R_matrix_ebe_index'] == np.where(mask)[0])
+    xo.assert_allclose(out['R_matrix_ebe'], ref['R_matrix_ebe'][mask],
+                       atol=1e-14, rtol=0)
+
+    sel = ['_end_point', 'e9', 3]
+    out = line.compute_one_turn_matrix_finite_differences(p_co,
+                        element_by_element=True, streaming=True, chunk_size=7,
+                        at_elements=sel)
+    assert np.all(out['R_matrix_ebe_index'] == [len(line.element_names), 9, 3])
+    xo.assert_allclose(out['R_matrix_ebe'],
+                       ref['R_matrix_ebe'][[len(line.element_names), 9, 3]],
+                       atol=1e-14, rtol=0)
+
+def test_twiss_radiation_full_streaming(monkeypatch):
+    n = 24
+    elements = []
+    for _ in range(n):
+        elements += [
+            xt.Multipole(length=0.2, knl=[0, +0.4], ksl=[0, 0.01]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=0.2, knl=[0, -0.4]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=2.0, knl=[2 * np.pi / n], hxl=[2 * np.pi / n]),
+            xt.Drift(length=1.0),
+        ]
+    elements.append(xt.Cavity(frequency=400e6, voltage=1e6, lag=170))
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.ELECTRON_MASS_EV, q0=1,
+                                     p0c=1e9)
+    line.build_tracker()
+    line.configure_radiation(model='mean')
+
+    # The element-by-element R matrices are computed tracking the line in
+    # chunks
+    twiss_module = sys.modules['xtrack.twiss']
+    calls = []
+    track_streaming = twiss_module._track_r_matrix_ebe_streaming
+    def track_streaming_spy(*args, **kwargs):
+        calls.append(kwargs)
+        return track_streaming(*args, **kwargs)
+    monkeypatch.setattr(twiss_module, '_track_r_matrix_ebe_streaming',
+                        track_streaming_spy)
+
+    tw = line.twiss(eneloss_and_damping=True, radiation_method='full')
+    assert len(calls) > 0
+
+    # Same result as from the monitor of the full line
+    with xt.line._preserve_config(line):
+        line.config.XTRACK_SYNRAD_KICK_SAME_AS_FIRST = False
+        line.config.XTRACK_SYNRAD_SCALE_SAME_AS_FIRST = False
+        RR_ebe = line.compute_one_turn_matrix_finite_differences(
+            tw.particle_on_co, element_by_element=True)['R_matrix_ebe']
+    eq_emitts = twiss_module._compute_equilibrium_emittance_full(
+        px_co=tw.px, py_co=tw.py, ptau_co=tw.ptau, R_matrix_ebe=RR_ebe,
+        line=line, radiation_method='full')
+    for nn in ['eq_gemitt_x', 'eq_gemitt_y', 'eq_gemitt_zeta']:
+        assert tw[nn] > 0
+        xo.assert_allclose(tw[nn], eq_emitts[nn], atol=0, rtol=1e-10)
+
+    tw_kick = line.twiss(eneloss_and_damping=True,
+                         radiation_method='kick_as_co')
+    for nn in ['eq_gemitt_x', 'eq_gemitt_y', 'eq_gemitt_zeta']:
+        xo.assert_allclose(tw[nn], tw_kick[nn], atol=0, rtol=1e-3)
+
+def test_find_closed_orbit_newton():
+    n = 12
+    elements = []
+    for ii in range(n):
+        elements += [
+            xt.Quadrupole(length=0.3, k1=0.3, k1s=0.001),
+            xt.Drift(length=1.0),
+            xt.Multipole(knl=[1e-5, -0.09, 0.05], ksl=[2e-5, 0.001]),
+            xt.Drift(length=1.0),
+            xt.Bend(length=1.0, k0=2 * np.pi / n, h=2 * np.pi / n, k1=0.01,
+                    model='expanded', edge_entry_angle=0.05),
+            xt.Cavity(voltage=(1e6 if ii == 0 else 0), frequency=400e6),
+            xt.Drift(length=1.0),
+        ]
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+
+    p_ref = line.find_closed_orbit()
+    p_co = line.find_closed_orbit(co_search_method='newton')
+    info = p_co._fsolve_info
+    assert info['converged']
+    assert info['n_tracks'] == info['n_iterations'] + 1
+    for nn in ['x', 'px', 'y', 'py', 'zeta', 'delta']:
+        xo.assert_allclose(getattr(p_co, nn), getattr(p_ref, nn),
+                           atol=1e-11, rtol=0)
+
+    # The R matrix from the search is the one at the closed orbit
+    p_co_rr, RR_co = xt.twiss.find_closed_orbit_line(
+        line, co_search_method='newton', _return_co_search_R_matrix=True)
+    xo.assert_allclose(p_co_rr.x, p_co.x, atol=1e-15, rtol=0)
+    RR = line.compute_one_turn_matrix_finite_differences(p_co)['R_matrix']
+    xo.assert_allclose(RR_co['R_matrix'], RR, atol=1e-9, rtol=0)
+
+    # A closed orbit found before changing the optics does not bring along
+    # the old one-turn matrix
+    tw_before = line.twiss(co_search_method='newton')
+    k1_before = line['e0'].k1
+    line['e0'].k1 = 1.1 * k1_before
+    tw_after = line.twiss()
+    tw_old_co = line.twiss(particle_on_co=p_co)
+    assert np.abs(tw_after.qx - tw_before.qx) > 1e-3
+    xo.assert_allclose(tw_old_co.qx, tw_after.qx, atol=1e-6, rtol=0)
+    xo.assert_allclose(tw_old_co.betx, tw_after.betx, atol=0, rtol=1e-4)
+    line['e0'].k1 = k1_before
+
+    # 4d search with fixed delta
+    p_ref = line.find_closed_orbit(delta0=1e-3, zeta0=0)
+    p_co = line.find_closed_orbit(delta0=1e-3, zeta0=0,
+                                  co_search_method='newton')
+    assert p_co._fsolve_info['converged']
+    xo.assert_allclose(p_co.delta, 1e-3, atol=1e-15, rtol=0)
+    xo.assert_allclose(p_co.x, p_ref.x, atol=1e-11, rtol=0)
+
+    for method in ['6d', '4d']:
+        tw = line.twiss(method=method)
+        tw_newton = line.twiss(method=method, co_search_method='newton')
+        for cc in ['x', 'px', 'y', 'py', 'delta']:
+            xo.assert_allclose(tw_newton[cc], tw[cc], atol=1e-11, rtol=0)
+        for cc in ['betx', 'bety', 'dx', 'dy']:
+            xo.assert_allclose(tw_newton[cc], tw[cc], atol=1e-7, rtol=1e-7)
+        xo.assert_allclose(tw_newton.qx, tw.qx, atol=1e-9, rtol=0)
+        xo.assert_allclose(tw_newton.qs, tw.qs, atol=1e-9, rtol=0)
+
+def test_twiss_lazy_columns():
+    n = 6
+    elements = []
+    for _ in range(n):
+        elements += [
+            xt.Multipole(length=0.2, knl=[0, +0.2, 0.1], ksl=[0, 0]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=0.2, knl=[0, -0.2, -0.1], ksl=[0, 0]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=1.0, knl=[2 * np.pi / n], hxl=[2 * np.pi / n]),
+            xt.Drift(length=1.0),
+        ]
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+
+    tw_ref = line.twiss(method='4d', strengths=True)
+    tw = line.twiss(method='4d', strengths=True, lazy_columns=True)
+
+    assert 'ax_chrom' not in tw._data and 'k1l' not in tw._data
+    assert 'ax_chrom' in tw and 'dqx' in tw and 'k1l' in tw
+    xo.assert_allclose(tw.betx, tw_ref.betx, atol=0, rtol=1e-14)
+
+    # Only the chromatic group is computed
+    xo.assert_allclose(tw.dqx, tw_ref.dqx, atol=1e-10, rtol=0)
+    assert 'ax_chrom' in tw._data and 'k1l' not in tw._data
+    for cc in ['ax_chrom', 'bx_chrom', 'wy_chrom', 'ddx', 'dmux']:
+        xo.assert_allclose(tw[cc], tw_ref[cc], atol=1e-10, rtol=0)
+
+    # Operations on the full table compute all pending groups
+    tt = tw.rows['e1.*']
+    xo.assert_allclose(tt.k1l, tw_ref.rows['e1.*'].k1l, atol=0, rtol=0)
+    assert set(tw._col_names) == set(tw_ref._col_names)
+
+    # Line modified before the first access
+    tw = line.twiss(method='4d', strengths=True, lazy_columns=True)
+    line['e0'].knl[1] = 0.21
+    xo.assert_allclose(tw.betx, tw_ref.betx, atol=0, rtol=1e-14)
+    with pytest.raises(RuntimeError):
+        tw.k1l
+
+@pytest.mark.parametrize('method, k1sl', [('4d', 0.01), ('4d', 0), ('6d', 0.01)])
+def test_multiturn_twiss_single_track(method, k1sl):
+    n = 6
+    elements = []
+    for _ in range(n):
+        elements += [
+            xt.Multipole(length=0.2, knl=[1e-5, +0.2, 0.1], ksl=[0, k1sl]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=0.2, knl=[0, -0.2, -0.1], ksl=[0, 0]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=1.0, knl=[2 * np.pi / n], hxl=[2 * np.pi / n]),
+            xt.Drift(length=1.0),
+        ]
+    elements.append(xt.Cavity(voltage=3e6, frequency=100e6))
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+
+    num_turns = 4
+    tw_mt = line.twiss(method=method, num_turns=num_turns, strengths=True)
+
+    # Reference: chain of open twisses, one per turn
+    tw0 = line.twiss(method=method, strengths=True)
+    tws = [tw0]
+    for _ in range(num_turns - 1):
+        init = tws[-1].get_twiss_init(-1)
+        init.element_name = tw0.name[0]
+        tws.append(line.twiss(method=method, init=init, start=tw0.name[0],
+                              end=line.element_names[-1], strengths=True,
+                              compute_chromatic_properties=True))
+
+    num_elements = len(line.element_names)
+    circum = line.get_length()
+    assert len(tw_mt) == num_turns * (num_elements + 1) + 1
+    assert tw_mt.name[-1] == '_end_point'
+    for i_turn, tw_ref in enumerate(tws):
+        i_start = i_turn * (num_elements + 1)
+        assert tw_mt.name[i_start] == f'_turn_{i_turn}'
+        rows = slice(i_start + 1, i_start + num_elements + 1)
+        rows_ref = slice(None, -1)
+        if i_turn == num_turns - 1:
+            rows = slice(i_start + 1, None)
+            rows_ref = slice(None)
+        assert np.all(tw_mt.name[rows][:num_elements]
+                      == tw_ref.name[:num_elements])
+        xo.assert_allclose(tw_mt.s[rows], tw_ref.s[rows_ref] + i_turn * circum,
+                           atol=1e-10, rtol=0)
+        for cc in ['x', 'px', 'y', 'py', 'delta']:
+            xo.assert_allclose(tw_mt[cc][rows], tw_ref[cc][rows_ref],
+                               atol=1e-12, rtol=0)
+        for cc in ['betx', 'bety', 'alfx', 'alfy', 'dx', 'dpx']:
+            xo.assert_allclose(tw_mt[cc][rows], tw_ref[cc][rows_ref],
+                               atol=1e-8, rtol=1e-8)
+        for cc in ['mux', 'muy', 'muzeta']:
+            xo.assert_allclose(tw_mt[cc][rows], tw_ref[cc][rows_ref],
+                               atol=1e-9, rtol=0)
+        xo.assert_allclose(tw_mt.dzeta[rows], tw_ref.dzeta[rows_ref],
+                           atol=1e-6, rtol=1e-8)
+        if method == '4d' and k1sl == 0:
+            # The chain of open twisses restarts the off-momentum probes
+            # from the uncoupled chromatic functions at each turn
+            for cc in ['dmux', 'dmuy', 'bx_chrom', 'by_chrom', 'ax_chrom',
+                       'ay_chrom', 'ddx', 'ddpx']:
+                xo.assert_allclose(tw_mt[cc][rows], tw_ref[cc][rows_ref],
+                                   atol=1e-5, rtol=1e-5)
+        else:
+            for cc in ['dmux', 'bx_chrom', 'ddx']:
+                assert np.all(np.isfinite(tw_mt[cc][rows]))
+        xo.assert_allclose(tw_mt.k1l[rows], tw_ref.k1l[rows_ref],
+                           atol=0, rtol=0)
+
+    if method == '4d':
+        assert np.all(tw_mt.muzeta == 0)
+    xo.assert_allclose(tw_mt.s[-1], num_turns * circum, atol=1e-10, rtol=0)
+    xo.assert_allclose(tw_mt.mux[-1], num_turns * tw0.qx, atol=1e-9, rtol=0)
+    xo.assert_allclose(tw_mt.betx[-1], tw_mt.betx[0], atol=0, rtol=1e-8)
+
+def test_multiturn_twiss_rebuilds_prebuilt_kernel():
+    line = xt.Line(elements=[
+        xt.Multipole(knl=[0, 0.2]), xt.Drift(length=1.0),
+        xt.Multipole(knl=[0, -0.2]), xt.Drift(length=1.0)])
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+    tw_mt_ref = line.twiss(method='4d', num_turns=3)
+
+    # Mark the kernels as taken from the prebuilt kernels
+    shared_kernels = line.tracker.track_kernel
+    for kk in shared_kernels.values():
+        kk._xtrack_prebuilt = True
+
+    tw_mt = line.twiss(method='4d', num_turns=3)
+
+    # The kernels of other trackers sharing the dictionary are left alone
+    assert all(kk._xtrack_prebuilt for kk in shared_kernels.values())
+    assert line.tracker.track_kernel is not shared_kernels
+    assert any(not getattr(kk, '_xtrack_prebuilt', False)
+               for kk in line.tracker.track_kernel.values())
+    xo.assert_allclose(tw_mt.betx, tw_mt_ref.betx, atol=0, rtol=1e-12)
+
+def test_twiss_incremental():
+    n = 6
+    elements = []
+    for _ in range(n):
+        elements += [
+            xt.Multipole(length=0.2, knl=[0, +0.2], ksl=[0, 0]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=0.2, knl=[0, -0.2], ksl=[0, 0]),
+            xt.Drift(length=1.0),
+            xt.Multipole(length=1.0, knl=[2 * np.pi / n], hxl=[2 * np.pi / n]),
+            xt.Drift(length=1.0),
+        ]
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+
+    tw_kwargs = dict(method='4d', start='e0', end='e35', betx=3, bety=2,
+                     dx=0.1)
+
+    def _check(tw, tw_ref):
+        for cc in ['s', 'x', 'px', 'betx', 'bety', 'alfx', 'alfy', 'mux',
+                   'muy', 'dx', 'dpx']:
+            xo.assert_allclose(tw[cc], tw_ref[cc], atol=1e-14, rtol=1e-14)
+
+    tw0 = line.twiss(incremental=True, **tw_kwargs)
+    _check(tw0, line.twiss(**tw_kwargs))
+    assert len(line.tracker._tracker_data_base._incremental_twiss_states) == 1
+
+    # No change
+    _check(line.twiss(incremental=True, **tw_kwargs), tw0)
+
+    # Change downstream, upstream part is not recomputed
+    line['e20'].knl[1] = -0.25
+    line['e21'].length = 1.1
+    mon = line.tracker._tracker_data_base._incremental_twiss_states[
+        next(iter(line.tracker._tracker_data_base._incremental_twiss_states))
+    ]['monitor']
+    x_upstream = mon.x[:, :20].copy()
+    x_downstream = mon.x[:, 21:].copy()
+    tw1 = line.twiss(incremental=True, **tw_kwargs)
+    _check(tw1, line.twiss(**tw_kwargs))
+    assert np.all(mon.x[:, :20] == x_upstream)
+    assert np.any(mon.x[:, 21:] != x_downstream)
+    assert np.any(tw1.betx != tw0.betx)
+    assert np.all(tw1.betx[:21] == tw0.betx[:21])
+
+    # Different initial conditions
+    tw2 = line.twiss(incremental=True, **(tw_kwargs | dict(betx=4)))
+    _check(tw2, line.twiss(**(tw_kwargs | dict(betx=4))))
+    assert len(line.tracker._tracker_data_base._incremental_twiss_states) == 2
+
+
 @for_all_test_contexts
 def test_coupled_beta(test_context):
     mad = Madx(stdout=False)
@@ -420,6 +959,117 @@ def test_get_R_matrix():
             / norm(W_ref_4d[:, 2*i_mode], ord=2),
             0, rtol=0, atol=5e-5)
 
+def test_linear_normal_form_stack():
+
+    from scipy.linalg import expm
+    from xtrack.linear_normal_form import (compute_linear_normal_form,
+                                           healy_symplectify, S, Rot2D)
+
+    rng = np.random.default_rng(42)
+
+    # Stack of coupled symplectic matrices M = W Rot W^-1
+    n_mat = 50
+    MM = np.zeros((n_mat, 6, 6))
+    for ii in range(n_mat):
+        HH = rng.normal(size=(6, 6))
+        WW = expm(S @ (HH + HH.T) * 0.15)
+        RR = np.zeros((6, 6))
+        for jj, mu in enumerate(rng.uniform(0.1, 3., 3)):
+            RR[2*jj:2*jj+2, 2*jj:2*jj+2] = Rot2D(mu)
+        MM[ii] = WW @ RR @ np.linalg.inv(WW)
+
+    W, invW, Rot, eigenvalues = compute_linear_normal_form(MM)
+    assert W.shape == (n_mat, 6, 6)
+    assert eigenvalues.shape == (n_mat, 3)
+    xo.assert_allclose(W @ Rot @ invW, MM, atol=1e-10, rtol=0)
+
+    for ii in range(n_mat):
+        W_ii, invW_ii, Rot_ii, eig_ii = compute_linear_normal_form(MM[ii])
+        xo.assert_allclose(W[ii], W_ii, atol=1e-12, rtol=0)
+        xo.assert_allclose(invW[ii], invW_ii, atol=1e-12, rtol=0)
+        xo.assert_allclose(Rot[ii], Rot_ii, atol=1e-12, rtol=0)
+        xo.assert_allclose(eigenvalues[ii], eig_ii, atol=1e-12, rtol=0)
+
+    W4d, _, _, _ = compute_linear_normal_form(MM, only_4d_block=True)
+    for ii in range(n_mat):
+        xo.assert_allclose(
+            W4d[ii], compute_linear_normal_form(MM[ii], only_4d_block=True)[0],
+            atol=1e-12, rtol=0)
+
+    # Symplectification of a perturbed stack
+    MM_pert = MM + 1e-6 * rng.normal(size=MM.shape)
+    MM_sympl = healy_symplectify(MM_pert)
+    xo.assert_allclose(np.swapaxes(MM_sympl, 1, 2) @ S @ MM_sympl,
+                       np.broadcast_to(S, MM.shape), atol=1e-12, rtol=0)
+    xo.assert_allclose(MM_sympl[3], healy_symplectify(MM_pert[3]),
+                       atol=1e-14, rtol=0)
+    xo.assert_allclose(MM_sympl, MM, atol=1e-4, rtol=0)
+
+def test_non_linear_chromaticity_batched():
+    fname_line_particles = test_data_folder / 'hllhc15_noerrors_nobb/line_and_particle.json'
+    line = xt.Line.from_json(fname_line_particles)
+    line.particle_ref = xp.Particles(p0c=7e12, mass0=xp.PROTON_MASS_EV)
+    line.build_tracker()
+
+    nlchr = line.get_non_linear_chromaticity((-1e-3, 1e-3), num_delta=7)
+    nlchr_batched = line.get_non_linear_chromaticity((-1e-3, 1e-3),
+                                                     num_delta=7, batched=True)
+
+    assert 'twiss' not in nlchr_batched._data
+    xo.assert_allclose(nlchr_batched.qx, nlchr.qx, atol=1e-6, rtol=0)
+    xo.assert_allclose(nlchr_batched.qy, nlchr.qy, atol=1e-6, rtol=0)
+    xo.assert_allclose(nlchr_batched.momentum_compaction_factor,
+                       nlchr.momentum_compaction_factor, atol=0, rtol=1e-4)
+    xo.assert_allclose(nlchr_batched.dnqx[:3], nlchr.dnqx[:3], atol=0, rtol=1e-4)
+    xo.assert_allclose(nlchr_batched.dnqy[:3], nlchr.dnqy[:3], atol=0, rtol=1e-4)
+
+    nlchr_full = line.get_non_linear_chromaticity((-1e-3, 1e-3), num_delta=7,
+                                                  batched=True, full_twiss=True)
+    assert len(nlchr_full.twiss) == 7
+    for tw, dd in zip(nlchr_full.twiss, nlchr.delta0):
+        xo.assert_allclose(tw.delta[0], dd, atol=1e-12, rtol=0)
+    xo.assert_allclose(nlchr_full.qx, nlchr.qx, atol=1e-6, rtol=0)
+    xo.assert_allclose(nlchr_full.qy, nlchr.qy, atol=1e-6, rtol=0)
+
+
+def test_non_linear_chromaticity_batched_with_cavity():
+    n = 12
+    elements = []
+    for ii in range(n):
+        elements += [
+            xt.Quadrupole(length=0.3, k1=0.3),
+            xt.Drift(length=1.0),
+            xt.Multipole(knl=[0, -0.09, 0.05]),
+            xt.Drift(length=1.0),
+            xt.Bend(length=1.0, k0=2 * np.pi / n, h=2 * np.pi / n,
+                    model='expanded'),
+            xt.Cavity(voltage=(1e6 if ii == 0 else 0), frequency=400e6,
+                      lag=30),
+            xt.Drift(length=1.0),
+        ]
+    line = xt.Line(elements=elements)
+    line.particle_ref = xp.Particles(mass0=xp.PROTON_MASS_EV, q0=1, p0c=1e9)
+    line.build_tracker()
+
+    nlchr = line.get_non_linear_chromaticity((-1e-3, 1e-3), num_delta=5)
+    nlchr_batched = line.get_non_linear_chromaticity((-1e-3, 1e-3),
+                                                     num_delta=5, batched=True)
+
+    xo.assert_allclose(nlchr_batched.qx, nlchr.qx, atol=1e-8, rtol=0)
+    xo.assert_allclose(nlchr_batched.qy, nlchr.qy, atol=1e-8, rtol=0)
+    xo.assert_allclose(nlchr_batched.momentum_compaction_factor,
+                       nlchr.momentum_compaction_factor, atol=0, rtol=1e-4)
+    # The energy is frozen only during the computation
+    assert not line._energy_is_frozen()
+
+    for kwargs in [{'freeze_longitudinal': True},
+                   {'start': 'e0', 'end': 'e6'},
+                   {'freeze_energy': False}]:
+        with pytest.raises(ValueError):
+            line.get_non_linear_chromaticity((-1e-3, 1e-3), num_delta=5,
+                                             batched=True, **kwargs)
+
+
 def test_hide_thin_groups():
 
     line = xt.Line.from_json(test_data_folder /
@@ -964,6 +1614,11 @@ def test_twiss_against_matrix(test_context):
         xo.assert_allclose(chroma_table.dnqx[1:], dnqx[1:], atol=1e-5, rtol=1e-5)
         xo.assert_allclose(chroma_table.dnqy[1:], dnqy[1:], atol=1e-5, rtol=1e-5)
 
+        chroma_batched = line.get_non_linear_chromaticity((-1e-2, 1e-2),
+                                                num_delta=25, batched=True)
+        xo.assert_allclose(chroma_batched.dnqx[1:], dnqx[1:], atol=1e-5, rtol=1e-5)
+        xo.assert_allclose(chroma_batched.dnqy[1:], dnqy[1:], atol=1e-5, rtol=1e-5)
+
 @for_all_test_contexts
 @pytest.mark.parametrize('machine', ['sps', 'psb'])
 def test_longitudinal_plane_against_matrix(machine, test_context):
@@ -15,6 +15,9 @@ from .tracker_data import TrackerData
 from .line import Line, Node, freeze_longitudinal, _temp_knobs, EnergyProgram
 from .environment import Environment, Place
 from .tracker import Tracker, Log
+from .kernel_cache import enable_kernel_cache, disable_kernel_cache
+from .ensemble import EnsembleTracker, TwissEnsembleTable, twiss_ensemble
+from .parallel import ParallelTracker
 from .match import (Vary, Target, TargetList, VaryList, TargetInequality, Action,
                     TargetRelPhaseAdvance, TargetSet, GreaterThan, LessThan,
                     TargetRmatrixTerm, TargetRmatrix)
@@ -33,7 +36,7 @@ from .multiline import Multiline, MultiTwiss
 
 from .mad_loader import MadLoader
 
-from .multisetter import MultiSetter
+from .multisetter import MultiSetter, CompiledKnobs, TimeDependentVarsTable
 
 from .footprint import Footprint, LinearRescale
 
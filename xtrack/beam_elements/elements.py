@@ -2278,12 +2278,17 @@ class FirstOrderTaylorMap(BeamElement):
         6x6 array of the first order Taylor map coefficients.
     radiation_flag : int
         Flag for synchrotron radiation. 0 - no radiation, 1 - radiation on.
+    advance_s : int
+        If 1, the s coordinate of the particles is advanced by `length`,
+        consistently with the s positions of the elements of the line. Set
+        for the maps built by `from_elements`. Defaults to 0.
     """
 
     isthick = True
 
     _xofields = {
         'radiation_flag': xo.Int64,
+        'advance_s': xo.Int64,
         'length': xo.Float64,
         'm0': xo.Field(xo.Float64[6], default=np.zeros(6, dtype=np.float64)),
         'm1': xo.Field(xo.Float64[6, 6], default=np.eye(6, dtype=np.float64)),
@@ -2299,6 +2304,70 @@ class FirstOrderTaylorMap(BeamElement):
     _internal_record_class = SynchrotronRadiationRecord # not functional,
     # included for compatibility with Multipole
 
+    @classmethod
+    def from_elements(cls, elements, particle_ref, **kwargs):
+
+        '''
+        Generate a `FirstOrderTaylorMap` equivalent to a sequence of elements,
+        to first order around the reference trajectory. The coefficients are
+        computed with central finite differences.
+
+        The map is not exact for drifts: the dependence of the drift on the
+        momentum deviation (chromatic terms, e.g. in x the term
+        L * px * delta / (1 + delta)) and the path lengthening, which are of
+        second order in the coordinates, are dropped.
+
+        Parameters
+        ----------
+        elements : list of BeamElement
+            Elements to be replaced by the map.
+        particle_ref : Particles
+            Reference particle.
+
+        Returns
+        -------
+        FirstOrderTaylorMap
+            A `FirstOrderTaylorMap` object.
+
+        '''
+
+        context = xo.context_default
+        particle_ref = particle_ref.copy(_context=context)
+        beta0 = particle_ref.beta0[0]
+
+        # Steps in x, px, y, py, tau, ptau
+        steps = np.array([1e-6, 1e-7, 1e-6, 1e-7, 1e-6, 1e-6])
+        coords = np.zeros(shape=(6, 13), dtype=np.float64)
+        for jj in range(6):
+            coords[jj, jj] = steps[jj]
+            coords[jj, jj + 6] = -steps[jj]
+
+        part = xt.Particles(_context=context,
+                            mass0=particle_ref.mass0, q0=particle_ref.q0,
+                            p0c=particle_ref.p0c[0],
+                            x=coords[0], px=coords[1],
+                            y=coords[2], py=coords[3],
+                            zeta=coords[4] * beta0, ptau=coords[5])
+
+        length = 0
+        for ee in elements:
+            ee = ee.copy(_context=context)
+            ee.track(part)
+            if getattr(ee, 'isthick', False):
+                length += ee.length
+
+        coords_out = np.array([part.x, part.px, part.y, part.py,
+                               part.zeta / part.beta0, part.ptau])
+
+        m0 = coords_out[:, 12]
+        m1 = np.zeros(shape=(6, 6), dtype=np.float64)
+        for jj in range(6):
+            m1[:, jj] = (coords_out[:, jj] - coords_out[:, jj + 6]) / (
+                                                                2 * steps[jj])
+
+        kwargs.setdefault('advance_s', 1)
+        return cls(m0=m0, m1=m1, length=length, **kwargs)
+
 
 class LinearTransferMatrix:
     def __init__(self, **kwargs):
@@ -11,6 +11,7 @@ void FirstOrderTaylorMap_track_local_particle(FirstOrderTaylorMapData el, LocalP
 
     int64_t const radiation_flag = FirstOrderTaylorMapData_get_radiation_flag(el);
     double const length = FirstOrderTaylorMapData_get_length(el); // m
+    int64_t const advance_s = FirstOrderTaylorMapData_get_advance_s(el);
 
     double dpx_record, dpy_record, dp_record;
     //start_per_particle_block (part0->part)
@@ -68,6 +69,9 @@ void FirstOrderTaylorMap_track_local_particle(FirstOrderTaylorMapData el, LocalP
 
         LocalParticle_update_ptau(part, ptau);
         LocalParticle_set_zeta(part,tau*beta0);
+        if (advance_s){
+            LocalParticle_add_to_s(part, length);
+        }
 
         // Radiation
         if (radiation_flag > 0 && length > 0){
@@ -0,0 +1,69 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import os
+import pickle
+from pathlib import Path
+
+CHECKPOINT_PREFIX = 'checkpoint_'
+CHECKPOINT_SUFFIX = '.pkl'
+
+
+def checkpoint_file_name(num_turns_done):
+    return f'{CHECKPOINT_PREFIX}{num_turns_done:010d}{CHECKPOINT_SUFFIX}'
+
+
+def list_checkpoints(checkpoint_path):
+    """
+    Return the checkpoint files in `checkpoint_path`, oldest first.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    if not checkpoint_path.is_dir():
+        return []
+    return sorted(checkpoint_path.glob(
+        CHECKPOINT_PREFIX + '*' + CHECKPOINT_SUFFIX))
+
+
+def write_checkpoint(checkpoint_path, state, num_turns_done, keep=2):
+    """
+    Write a tracking checkpoint and remove the oldest ones, keeping at most
+    `keep` of them. The file is first written to a temporary file and then
+    renamed, so that a checkpoint is either complete or absent.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    checkpoint_path.mkdir(parents=True, exist_ok=True)
+
+    fname = checkpoint_path / checkpoint_file_name(num_turns_done)
+    tmp_fname = fname.with_name(fname.name + f'.tmp{os.getpid()}')
+    with open(tmp_fname, 'wb') as fid:
+        pickle.dump(state, fid, protocol=pickle.HIGHEST_PROTOCOL)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(tmp_fname, fname)
+
+    if keep is not None:
+        for ff in list_checkpoints(checkpoint_path)[:-keep]:
+            try:
+                ff.unlink()
+            except OSError:
+                pass
+
+    return fname
+
+
+def load_checkpoint(checkpoint_path):
+    """
+    Load a tracking checkpoint. If `checkpoint_path` is a directory, the most
+    recent checkpoint in it is loaded.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    if checkpoint_path.is_dir():
+        checkpoints = list_checkpoints(checkpoint_path)
+        if len(checkpoints) == 0:
+            raise FileNotFoundError(
+                f'No checkpoint found in {checkpoint_path}')
+        checkpoint_path = checkpoints[-1]
+    with open(checkpoint_path, 'rb') as fid:
+        return pickle.load(fid)
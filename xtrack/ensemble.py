@@ -0,0 +1,971 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+from contextlib import ExitStack
+from functools import partial
+
+import numpy as np
+import xobjects as xo
+import xtrack as xt
+
+from .base_element import _handle_per_particle_blocks
+from .general import _pkg_root
+from .line import _is_collective
+from .tracker import (_config_to_headers, _element_switch_cases_source,
+                      _element_ref_data_class_from_element_classes)
+from .twiss import (ClosedOrbitSearchError, DEFAULT_CO_SEARCH_TOL,
+                    DEFAULT_CO_SEARCH_NEWTON_TOL,
+                    DEFAULT_CO_SEARCH_NEWTON_MAX_ITERATIONS,
+                    _build_co_search_probes, _co_search_newton_error,
+                    _co_search_probes_output,
+                    _complete_steps_r_matrix_with_default)
+
+
+class EnsembleTracker:
+
+    '''
+    Track particles through an ensemble of lattice variants (e.g. different
+    error seeds of the same machine) in a single kernel launch.
+
+    All lines must have the same sequence of element classes. Their elements
+    are stacked in a single buffer and each particle carries the index of the
+    lattice variant through which it is tracked.
+    '''
+
+    def __init__(self, lines, _context=None, _buffer=None, compile=True):
+        """
+        Parameters
+        ----------
+        lines: list of xtrack.Line
+            Lattice variants. Lines without a tracker are frozen and
+            associated to a tracker in the common buffer. Lines that already
+            have a tracker must have been built on the same buffer.
+        _context: xobjects.Context, optional
+            Context on which the tracking is performed.
+        _buffer: xobjects.Buffer, optional
+            Common buffer in which the elements of all lines are stored.
+        compile: bool, optional
+            If True (default) the ensemble kernel is compiled immediately,
+            otherwise at the first usage.
+        """
+
+        lines = list(lines)
+        if len(lines) == 0:
+            raise ValueError('At least one line is needed')
+
+        layout = [ee.__class__ for ee in lines[0].elements]
+        for ll in lines[1:]:
+            if [ee.__class__ for ee in ll.elements] != layout:
+                raise ValueError('All lines of the ensemble must have the '
+                                 'same sequence of element classes')
+
+        if _buffer is None:
+            for ll in lines:
+                if ll._has_valid_tracker():
+                    _buffer = ll._buffer
+                    break
+        if _buffer is None:
+            if _context is None:
+                _context = xo.context_default
+            _buffer = _context.new_buffer()
+
+        for ii, ll in enumerate(lines):
+            if not ll._has_valid_tracker():
+                ll.build_tracker(_buffer=_buffer, compile=False)
+            elif ll._buffer is not _buffer:
+                raise ValueError(
+                    f'The tracker of line {ii} is not in the common buffer. '
+                    'Please build all trackers with the same `_buffer`.')
+            if ll.iscollective or np.any(
+                    [_is_collective(ee, ll) for ee in ll.elements]):
+                raise NotImplementedError(
+                    'Collective elements are not supported in ensemble mode')
+
+        hash_config = lines[0].tracker._hashable_config()
+        for ll in lines[1:]:
+            if ll.tracker._hashable_config() != hash_config:
+                raise ValueError('All lines of the ensemble must have the '
+                                 'same tracker configuration')
+
+        self.lines = lines
+        self.num_variants = len(lines)
+        self.num_elements = len(layout)
+        self.line_length = lines[0].get_length()
+
+        element_classes = set()
+        for ll in lines:
+            element_classes |= set(
+                ll.tracker._tracker_data_base.line_element_classes)
+        ElementRefData = _element_ref_data_class_from_element_classes(
+                            sorted(element_classes, key=lambda cc: cc.__name__))
+
+        # Stack the elements of all variants (variant-major)
+        self._element_ref_data = ElementRefData(
+            elements=self.num_variants * self.num_elements,
+            names=[], _buffer=_buffer)
+        self._element_ref_data.elements = [
+            ee._xobject for ll in lines
+            for ee in ll.tracker._tracker_data_base.elements]
+
+        self._track_kernels = {}
+        if compile:
+            _ = self.track_kernel
+
+    @property
+    def _buffer(self):
+        return self._element_ref_data._buffer
+
+    @property
+    def _context(self):
+        return self._buffer.context
+
+    @property
+    def config(self):
+        return self.lines[0].config
+
+    @property
+    def kernel_element_classes(self):
+        return self._element_ref_data.elements._itemtype._reftypes
+
+    @property
+    def track_kernel(self):
+        # The configuration can be changed temporarily on all lines (e.g.
+        # energy frozen for a 4d twiss), hence kernels are cached per config
+        hash_config = self.lines[0].tracker._hashable_config()
+        if hash_config not in self._track_kernels:
+            self._track_kernels[hash_config] = self._build_kernel()
+        return self._track_kernels[hash_config]
+
+    def _build_kernel(self):
+
+        src_lines = [_ensemble_local_particle_shift_source()]
+        src_lines.append(
+            r"""
+            /*gpukern*/
+            void track_line_ensemble(
+                /*gpuglmem*/ int8_t* buffer,
+                             ElementRefData elem_ref_data,
+                             ParticlesData particles,
+                /*gpuglmem*/ int64_t* lattice_variant,
+                             int num_turns,
+                             int flag_end_turn_actions,
+                             int flag_reset_s_at_end_turn,
+                             int num_ele_line,
+                /*gpuglmem*/ int8_t* io_buffer){
+
+            int64_t const capacity = ParticlesData_get__capacity(particles);
+
+            #pragma omp parallel for                                      //only_for_context cpu_openmp
+            for (int64_t part_id = 0; part_id < capacity; part_id++){     //only_for_context cpu_serial cpu_openmp
+            int64_t part_id = blockDim.x * blockIdx.x + threadIdx.x;  //only_for_context cuda
+            int64_t part_id = get_global_id(0);                       //only_for_context opencl
+
+            if (part_id < capacity){
+
+            // Each local particle holds a single particle, as different
+            // particles see different elements
+            LocalParticle lpart;
+            lpart.io_buffer = io_buffer;
+            Particles_to_LocalParticle(particles, &lpart, part_id, part_id + 1);
+            LocalParticle_shift_to_particle(&lpart, part_id);  //only_for_context cpu_serial
+
+            int64_t isactive = check_is_active(&lpart);
+
+            if (isactive){
+
+            int64_t const elem_offset =
+                lattice_variant[LocalParticle_get_particle_id(&lpart)] * num_ele_line;
+
+            for (int64_t iturn=0; iturn<num_turns; iturn++){
+
+                for (int64_t elem_idx = 0; elem_idx < num_ele_line; elem_idx++){
+
+                        /*gpuglmem*/ void* el = ElementRefData_member_elements(
+                                            elem_ref_data, elem_offset + elem_idx);
+                        int64_t elem_type = ElementRefData_typeid_elements(
+                                            elem_ref_data, elem_offset + elem_idx);
+
+                        switch(elem_type){
+        """
+        )
+
+        src_lines.extend(_element_switch_cases_source(self.kernel_element_classes))
+
+        src_lines.append(
+            r"""
+                        } //switch
+
+                    isactive = check_is_active(&lpart);
+                    if (!isactive){
+                        break;
+                    }
+                    increment_at_element(&lpart, 1);
+
+                } // for elements
+
+                if (!isactive){
+                    break;
+                }
+
+                if (flag_end_turn_actions>0){
+                    increment_at_turn(&lpart, flag_reset_s_at_end_turn);
+                }
+
+            } // for turns
+
+            } // if isactive
+
+            LocalParticle_to_Particles(&lpart, particles, part_id, 0);
+
+            } // if part_id
+            } //only_for_context cpu_serial cpu_openmp
+        }//kernel
+        """
+        )
+
+        kernel_descriptions = {
+            'track_line_ensemble': xo.Kernel(
+                c_name='track_line_ensemble',
+                args=[
+                    xo.Arg(xo.Int8, pointer=True, name='buffer'),
+                    xo.Arg(self._element_ref_data.__class__, name='tracker_data'),
+                    xo.Arg(xt.Particles._XoStruct, name='particles'),
+                    xo.Arg(xo.Int64, pointer=True, name='lattice_variant'),
+                    xo.Arg(xo.Int32, name='num_turns'),
+                    xo.Arg(xo.Int32, name='flag_end_turn_actions'),
+                    xo.Arg(xo.Int32, name='flag_reset_s_at_end_turn'),
+                    xo.Arg(xo.Int32, name='num_ele_line'),
+                    xo.Arg(xo.Int8, pointer=True, name='io_buffer'),
+                ],
+            )
+        }
+
+        kernels = self._context.build_kernels(
+            sources=['\n'.join(src_lines)],
+            kernel_descriptions=kernel_descriptions,
+            extra_headers=(_config_to_headers(self.config)
+                           + [_pkg_root.joinpath('headers/constants.h')]),
+            extra_classes=list(self.kernel_element_classes),
+            apply_to_source=[
+                partial(_handle_per_particle_blocks,
+                        local_particle_src=xt.Particles.gen_local_particle_api())],
+            specialize=True,
+        )
+        return kernels['track_line_ensemble']
+
+    def merge_particles(self, particles):
+        """
+        Merge the particles of the different variants into a single Particles
+        object.
+
+        Parameters
+        ----------
+        particles: xtrack.Particles or list of xtrack.Particles
+            One Particles object per variant. If a single Particles object is
+            given, it is replicated for all variants.
+
+        Returns
+        -------
+        merged: xtrack.Particles
+            Particles object to be tracked with `track_merged`.
+        lattice_variant: array
+            Lattice variant index for each `particle_id` of `merged`.
+        id_maps: list
+            Information needed by `split_particles` to restore the original
+            particle ids.
+        """
+
+        if isinstance(particles, xt.Particles):
+            particles = [particles] * self.num_variants
+
+        if len(particles) != self.num_variants:
+            raise ValueError(f'Expected {self.num_variants} Particles objects, '
+                             f'got {len(particles)}')
+
+        lst = []
+        id_maps = []
+        lattice_variant = []
+        first = 0
+        for iv, pp in enumerate(particles):
+            pp = pp.copy(_context=xo.context_default)
+            capacity = pp._capacity
+            id_maps.append((first, pp.particle_id.copy(),
+                            pp.parent_particle_id.copy()))
+            new_ids = np.arange(first, first + capacity, dtype=np.int64)
+            pp.particle_id[:] = new_ids
+            pp.parent_particle_id[:] = new_ids
+            lattice_variant.append(np.full(capacity, iv, dtype=np.int64))
+            lst.append(pp)
+            first += capacity
+
+        merged = xt.Particles.merge(lst, _context=self._context)
+        lattice_variant = np.concatenate(lattice_variant)
+
+        return merged, lattice_variant, id_maps
+
+    def split_particles(self, merged, lattice_variant, id_maps):
+        """
+        Split particles merged by `merge_particles` into one Particles object
+        per variant, restoring the original particle ids.
+        """
+
+        ctx2np = merged._context.nparray_from_context_array
+        variant_of_particle = lattice_variant[ctx2np(merged.particle_id)]
+
+        out = []
+        for iv in range(self.num_variants):
+            pp = merged.filter(variant_of_particle == iv)
+            first, orig_ids, orig_parent_ids = id_maps[iv]
+            pp_cpu = pp.copy(_context=xo.context_default)
+            local_idx = pp_cpu.particle_id - first
+            pp_cpu.particle_id[:] = orig_ids[local_idx]
+            pp_cpu.parent_particle_id[:] = orig_parent_ids[local_idx]
+            if isinstance(merged._context, xo.ContextCpu):
+                pp_cpu._buffer.context = merged._context
+                out.append(pp_cpu)
+            else:
+                out.append(pp_cpu.copy(_context=merged._context))
+        return out
+
+    def track_merged(self, particles, lattice_variant, num_turns=1):
+        """
+        Track merged particles in place for `num_turns` full turns.
+
+        Parameters
+        ----------
+        particles: xtrack.Particles
+            Merged particles (see `merge_particles`).
+        lattice_variant: array
+            Lattice variant index for each `particle_id` of `particles`.
+        num_turns: int
+            Number of turns to be tracked.
+        """
+
+        assert num_turns >= 1
+
+        hash_config = self.lines[0].tracker._hashable_config()
+        for ll in self.lines[1:]:
+            if ll.tracker._hashable_config() != hash_config:
+                raise ValueError('All lines of the ensemble must have the '
+                                 'same tracker configuration')
+
+        if (np.any([ll._needs_rng for ll in self.lines])
+                and not particles._has_valid_rng_state()):
+            particles._init_random_number_generator()
+
+        lattice_variant_ctx = self._context.nparray_to_context_array(
+                                    np.asarray(lattice_variant, dtype=np.int64))
+        io_buffer = self.lines[0].tracker.io_buffer
+
+        track_kernel = self.track_kernel
+        track_kernel.description.n_threads = particles._capacity
+        track_kernel(
+            buffer=self._buffer.buffer,
+            tracker_data=self._element_ref_data,
+            particles=particles._xobject,
+            lattice_variant=lattice_variant_ctx,
+            num_turns=num_turns,
+            flag_end_turn_actions=not self.lines[0].skip_end_turn_actions,
+            flag_reset_s_at_end_turn=self.lines[0].reset_s_at_end_turn,
+            num_ele_line=self.num_elements,
+            io_buffer=io_buffer.buffer,
+        )
+
+        if isinstance(self._context, xo.ContextCpu):
+            particles.reorganize()
+
+    def track(self, particles, num_turns=1):
+        """
+        Track particles through all lattice variants.
+
+        Parameters
+        ----------
+        particles: xtrack.Particles or list of xtrack.Particles
+            One Particles object per variant. If a single Particles object is
+            given, it is replicated for all variants. The input objects are
+            not modified.
+        num_turns: int
+            Number of turns to be tracked.
+
+        Returns
+        -------
+        particles_out: list of xtrack.Particles
+            Tracked particles, one Particles object per variant.
+        """
+
+        merged, lattice_variant, id_maps = self.merge_particles(particles)
+        self.track_merged(merged, lattice_variant, num_turns=num_turns)
+        return self.split_particles(merged, lattice_variant, id_maps)
+
+    def find_closed_orbit(self, particle_ref=None, delta0=None, zeta0=None,
+                          co_search_settings=None,
+                          continue_on_closed_orbit_error=False,
+                          _return_co_search_R_matrix=False):
+        """
+        Find the closed orbit of all lattice variants with a Newton search
+        in which all variants are iterated together. At each iteration the
+        orbit guesses and the finite-difference probes of all variants are
+        tracked in a single kernel launch.
+
+        Parameters
+        ----------
+        particle_ref: xtrack.Particles, optional
+            Reference particle. If not provided, the reference particle of
+            the first line is used.
+        delta0: float, optional
+            If provided, the search is performed at fixed delta (4d search).
+        zeta0: float, optional
+            If provided, the search is performed at fixed zeta.
+        co_search_settings: dict, optional
+            Settings of the Newton search (`tol`, `max_iterations`,
+            `steps_r_matrix`), as for `Line.find_closed_orbit` with
+            `co_search_method='newton'`.
+        continue_on_closed_orbit_error: bool, optional
+            If True, None is returned for the variants for which the search
+            does not converge, otherwise a ClosedOrbitSearchError is raised.
+
+        Returns
+        -------
+        particles_on_co: list of xtrack.Particles
+            Particle on the closed orbit of each variant.
+        """
+
+        # With _return_co_search_R_matrix, the one-turn matrices computed by
+        # the search at the closed orbit are also returned
+
+        if np.any([ll.energy_program is not None for ll in self.lines]):
+            raise NotImplementedError(
+                'Energy programs are not supported in ensemble mode')
+
+        co_search_settings = (co_search_settings or {}).copy()
+        steps_r_matrix = _complete_steps_r_matrix_with_default(
+                    (co_search_settings.get('steps_r_matrix') or {}).copy())
+        tol = co_search_settings.get('tol', None)
+        if tol is None:
+            tol = DEFAULT_CO_SEARCH_NEWTON_TOL
+        max_iterations = co_search_settings.get('max_iterations', None)
+        if max_iterations is None:
+            max_iterations = DEFAULT_CO_SEARCH_NEWTON_MAX_ITERATIONS
+        tol = np.array(tol, dtype=np.float64)
+        tol_floor = np.maximum(tol, DEFAULT_CO_SEARCH_TOL)
+
+        line = self.lines[0]
+        if particle_ref is None:
+            particle_ref = line.particle_ref
+        if particle_ref is None:
+            raise ValueError('`particle_ref` must be provided')
+
+        co_guess = particle_ref.copy(_context=self._context)
+        for nn in ['x', 'px', 'y', 'py', 'zeta', 'delta', 's']:
+            setattr(co_guess, nn, 0)
+        co_guess.at_element = 0
+        co_guess.at_turn = 0
+
+        x0 = np.zeros(6)
+        if zeta0 is not None:
+            x0[4] = zeta0
+        if delta0 is not None:
+            x0[5] = delta0
+
+        probes = _EnsembleCoSearchProbes(self, co_guess, steps_r_matrix)
+
+        num_variants = self.num_variants
+        pp = np.tile(x0, (num_variants, 1))
+        err = np.zeros((num_variants, 6))
+        jac_err = np.zeros((num_variants, 6, 6))
+        RR = np.zeros((num_variants, 6, 6))
+        info = [{'method': 'newton', 'converged': False, 'n_iterations': 0,
+                 'residuals': [], 'step_lengths': [], 'message': None}
+                for _ in range(num_variants)]
+        n_tracks = 0
+
+        def _evaluate(variants, p_eval):
+            p_out, jac, rr, lost = probes.track(variants, p_eval)
+            ee, jj = _co_search_newton_error(p_eval, p_out, jac, delta0, zeta0)
+            return ee, jj, rr, lost
+
+        all_variants = np.arange(num_variants)
+        err[:], jac_err[:], RR[:], lost = _evaluate(all_variants, pp)
+        n_tracks += 1
+
+        active = ~lost
+        for iv in all_variants[lost]:
+            info[iv]['message'] = 'Particles lost at the initial guess'
+
+        for _ in range(max_iterations + 1):
+            for iv in all_variants[active]:
+                info[iv]['residuals'].append(np.max(np.abs(err[iv]) / tol))
+            converged = active & np.all(np.abs(err) < tol, axis=1)
+            for iv in all_variants[converged]:
+                info[iv]['converged'] = True
+            active &= ~converged
+            if not np.any(active):
+                break
+
+            for iv in all_variants[active]:
+                if info[iv]['n_iterations'] == max_iterations:
+                    info[iv]['message'] = 'Maximum number of iterations reached'
+                    active[iv] = False
+
+            dp = np.zeros((num_variants, 6))
+            for iv in all_variants[active]:
+                try:
+                    dp[iv] = -np.linalg.solve(jac_err[iv], err[iv])
+                except np.linalg.LinAlgError:
+                    info[iv]['message'] = 'Singular Jacobian'
+                    active[iv] = False
+
+            # Backtracking line search, the variants for which the step is
+            # not yet accepted are tracked together
+            merit = np.linalg.norm(err / tol, axis=1)
+            alpha = 1.
+            pending = active.copy()
+            while np.any(pending) and alpha >= 1 / 64:
+                variants = all_variants[pending]
+                p_try = pp[variants] + alpha * dp[variants]
+                ee, jj, rr, lost = _evaluate(variants, p_try)
+                n_tracks += 1
+                new_merit = np.linalg.norm(ee / tol, axis=1)
+                accepted = ~lost & (new_merit < (1 - 1e-4 * alpha)
+                                    * merit[variants])
+                for ii in np.where(accepted)[0]:
+                    iv = variants[ii]
+                    pp[iv] = p_try[ii]
+                    err[iv] = ee[ii]
+                    jac_err[iv] = jj[ii]
+                    RR[iv] = rr[ii]
+                    info[iv]['n_iterations'] += 1
+                    info[iv]['step_lengths'].append(alpha)
+                pending[variants[accepted]] = False
+                alpha *= 0.5
+
+            for iv in all_variants[pending]:
+                active[iv] = False
+                if np.all(np.abs(err[iv]) < tol_floor):
+                    # Limited by the numerical noise of the tracking
+                    info[iv]['converged'] = True
+                    info[iv]['message'] = 'Tolerance limited by numerical noise'
+                else:
+                    info[iv]['message'] = 'Line search failed'
+
+        failed = [iv for iv in all_variants if not info[iv]['converged']]
+        if len(failed) > 0 and not continue_on_closed_orbit_error:
+            raise ClosedOrbitSearchError(
+                f'Closed orbit search failed for variants {failed}')
+
+        out = []
+        out_R_matrix = []
+        for iv in all_variants:
+            info[iv]['n_tracks'] = n_tracks
+            if not info[iv]['converged']:
+                out.append(None)
+                out_R_matrix.append(None)
+                continue
+            particle_on_co = co_guess.copy()
+            particle_on_co.x = pp[iv, 0]
+            particle_on_co.px = pp[iv, 1]
+            particle_on_co.y = pp[iv, 2]
+            particle_on_co.py = pp[iv, 3]
+            particle_on_co.zeta = pp[iv, 4]
+            particle_on_co.delta = pp[iv, 5]
+            particle_on_co._fsolve_info = info[iv]
+            out.append(particle_on_co)
+            out_R_matrix.append(
+                {'R_matrix': RR[iv], 'steps_r_matrix': steps_r_matrix})
+
+        if _return_co_search_R_matrix:
+            return out, out_R_matrix
+        return out
+
+    def twiss(self, seeds=None, **kwargs):
+        """
+        Compute the twiss of all lattice variants.
+
+        For periodic twiss, only the closed orbit search is batched: the
+        closed orbits and the one-turn matrices of all variants are computed
+        together (see `find_closed_orbit`) and passed to the twiss of each
+        variant. The rest of the twiss (element-by-element tracking of the
+        closed orbit and of the eigenvectors, optics functions, chromatic
+        properties) is computed with `Line.twiss`, one variant after the
+        other. Variants for which the batched search does not converge are
+        computed with the closed orbit search of `Line.twiss`.
+
+        Parameters
+        ----------
+        seeds: array, optional
+            Labels of the variants, stored in the `seed` attribute of the
+            output. Defaults to the variant index.
+        **kwargs:
+            Arguments passed to `Line.twiss`.
+
+        Returns
+        -------
+        twiss_ensemble: TwissEnsembleTable
+            Twiss tables of all variants stacked along the seed axis.
+        """
+
+        tw_kwargs = {**self.lines[0].twiss_default,
+                     **{kk: vv for kk, vv in kwargs.items() if vv is not None}}
+
+        with ExitStack() as stack:
+            particles_on_co = None
+            if self._twiss_is_batched(tw_kwargs):
+                method = tw_kwargs.get('method', None) or '6d'
+                delta0 = tw_kwargs.get('delta0', None)
+                if method == '4d' and delta0 is None:
+                    delta0 = 0
+                for ll in self.lines:
+                    if tw_kwargs.get('freeze_longitudinal', False):
+                        stack.enter_context(xt.freeze_longitudinal(ll))
+                    elif (tw_kwargs.get('freeze_energy', None)
+                            or (tw_kwargs.get('freeze_energy', None) is None
+                                and method == '4d')):
+                        if not ll._energy_is_frozen():
+                            stack.enter_context(xt.line._preserve_config(ll))
+                            ll.freeze_energy(force=True)
+                co_search_settings = (
+                    tw_kwargs.get('co_search_settings', None) or {}).copy()
+                co_search_settings.setdefault(
+                    'steps_r_matrix', tw_kwargs.get('steps_r_matrix', None))
+                particles_on_co, co_search_R_matrices = self.find_closed_orbit(
+                    particle_ref=tw_kwargs.get('particle_ref', None),
+                    delta0=delta0, zeta0=tw_kwargs.get('zeta0', None),
+                    co_search_settings=co_search_settings,
+                    continue_on_closed_orbit_error=True,
+                    _return_co_search_R_matrix=True)
+
+            tw_list = []
+            for iv, ll in enumerate(self.lines):
+                kwargs_variant = kwargs.copy()
+                if particles_on_co is not None and particles_on_co[iv] is not None:
+                    kwargs_variant['particle_on_co'] = particles_on_co[iv]
+                    kwargs_variant['_co_search_R_matrix'] = (
+                                                co_search_R_matrices[iv])
+                tw_list.append(ll.twiss(**kwargs_variant))
+
+        return TwissEnsembleTable(tw_list, seeds=seeds)
+
+    def _twiss_is_batched(self, tw_kwargs):
+        # The batched closed orbit search is used only for the plain periodic
+        # twiss, all other cases are delegated to Line.twiss
+        for kk in _TWISS_ARGS_NOT_BATCHED:
+            if tw_kwargs.get(kk, None) is not None:
+                return False
+        if tw_kwargs.get('init', None) not in [None, 'periodic']:
+            return False
+        if tw_kwargs.get('num_turns', None) not in [None, 1]:
+            return False
+        for ll in self.lines:
+            if (ll._radiation_model is not None
+                    or ll.energy_program is not None
+                    or ll.enable_time_dependent_vars):
+                return False
+        return True
+
+
+class _EnsembleCoSearchProbes:
+
+    # Orbit guesses and finite-difference probes (see
+    # xtrack.twiss._build_co_search_probes) of all the variants of an
+    # ensemble, stored in a single Particles object
+
+    def __init__(self, ensemble, co_guess, steps_r_matrix):
+
+        self.ensemble = ensemble
+        self.steps_r_matrix = steps_r_matrix
+
+        template, self.dpzeta = _build_co_search_probes(
+                                ensemble.lines[0], co_guess, steps_r_matrix)
+        self.num_per_variant = template._capacity
+
+        num_variants = ensemble.num_variants
+        merged = xt.Particles.merge([template] * num_variants)
+        ids = np.arange(num_variants * self.num_per_variant, dtype=np.int64)
+        merged.particle_id = ids
+        merged.parent_particle_id = ids
+        self.merged = merged
+        self.lattice_variant = ids // self.num_per_variant
+
+        ctx2np = template._context.nparray_from_context_array
+        self.coord_offsets = {}
+        for nn in ['x', 'px', 'y', 'py', 'zeta', 'ptau']:
+            vv = ctx2np(getattr(template, nn))
+            self.coord_offsets[nn] = np.tile(vv - vv[0], num_variants)
+        self.beta0 = float(ctx2np(template.beta0)[0])
+        self.gamma0 = float(ctx2np(template.gamma0)[0])
+
+    def track(self, variants, p_guess):
+        """
+        Track the probes of the given variants, with the orbit guesses
+        p_guess (shape (len(variants), 6)). Returns the tracked guesses,
+        the one-turn Jacobians, the R matrices and a mask of the variants
+        with lost particles.
+        """
+
+        context = self.merged._context
+        ctx2np = context.nparray_from_context_array
+        np2ctx = context.nparray_to_context_array
+
+        n_per = self.num_per_variant
+        mask = np.isin(self.lattice_variant, variants)
+        part = self.merged.filter(np2ctx(mask))
+
+        p_guess = np.asarray(p_guess, dtype=np.float64)
+        p_per_particle = np.repeat(p_guess, n_per, axis=0)
+        for ii, nn in enumerate(['x', 'px', 'y', 'py', 'zeta']):
+            setattr(part, nn, np2ctx(
+                self.coord_offsets[nn][mask] + p_per_particle[:, ii]))
+        beta0 = self.beta0
+        gamma0 = self.gamma0
+        delta = p_per_particle[:, 5]
+        ptau_guess = (np.sqrt((1 + delta)**2 + 1 / (beta0 * gamma0)**2)
+                      - 1 / beta0)
+        part.update_ptau(np2ctx(self.coord_offsets['ptau'][mask] + ptau_guess))
+
+        delta_in = ctx2np(part.delta).reshape(len(variants), n_per).copy()
+
+        self.ensemble.track_merged(part, self.lattice_variant)
+
+        order = np.argsort(ctx2np(part.particle_id))
+        def _get(vv):
+            return ctx2np(vv)[order].reshape(len(variants), n_per)
+
+        lost = np.any(_get(part.state) <= 0, axis=1)
+        coords = np.array([_get(part.x), _get(part.px), _get(part.y),
+                           _get(part.py), _get(part.zeta), _get(part.delta),
+                           _get(part.ptau / part.beta0)])
+
+        p_out, jac, RR = _co_search_probes_output(
+                    coords, delta_in, self.steps_r_matrix, self.dpzeta)
+        p_out[lost] = np.nan
+
+        return p_out, jac, RR, lost
+
+
+class TwissEnsembleTable:
+
+    """
+    Twiss results of an ensemble of lattice variants.
+
+    Columns and scalars of the twiss tables are stacked along the first axis
+    (seed axis), e.g. `tw_ens.betx` has shape (num_seeds, num_rows) and
+    `tw_ens.qx` has shape (num_seeds,). Summary statistics over the seeds
+    are provided by `mean`, `std`, `min` and `max`, and the scalars of each
+    seed by `scalars`.
+    """
+
+    def __init__(self, twiss, seeds=None):
+        self.twiss = list(twiss)
+        if seeds is None:
+            seeds = np.arange(len(self.twiss))
+        self.seed = np.array(seeds)
+        assert len(self.seed) == len(self.twiss)
+
+        tw0 = self.twiss[0]
+        for tt in self.twiss[1:]:
+            if len(tt) != len(tw0):
+                raise ValueError('All twiss tables must have the same rows')
+        self.name = tw0.name
+        self.s = tw0.s
+
+    @property
+    def num_seeds(self):
+        return len(self.twiss)
+
+    def __len__(self):
+        return self.num_seeds
+
+    def _column_names(self):
+        tw0 = self.twiss[0]
+        return [cc for cc in tw0._col_names if cc not in ['name', 's']
+                and np.issubdtype(np.asarray(tw0[cc]).dtype, np.number)]
+
+    def _scalar_names(self):
+        tw0 = self.twiss[0]
+        out = []
+        for kk in tw0.keys():
+            if kk in tw0._col_names:
+                continue
+            vv = tw0._data[kk]
+            if np.isscalar(vv) and isinstance(vv, (int, float, np.number)):
+                out.append(kk)
+        return out
+
+    def __getitem__(self, key):
+        return np.array([tt[key] for tt in self.twiss])
+
+    def __getattr__(self, key):
+        if key.startswith('_') or key == 'twiss':
+            raise AttributeError(key)
+        if key not in self.twiss[0]:
+            raise AttributeError(key)
+        return self[key]
+
+    def __dir__(self):
+        return list(super().__dir__()) + list(self.twiss[0].keys())
+
+    @property
+    def scalars(self):
+        """Table with the scalar quantities of each seed."""
+        data = {'seed': self.seed}
+        for kk in self._scalar_names():
+            data[kk] = self[kk]
+        return xt.Table(data, col_names=list(data.keys()), index='seed')
+
+    def _summary(self, func):
+        data = {'name': self.name, 's': self.s}
+        col_names = list(data.keys())
+        for cc in self._column_names():
+            data[cc] = func(self[cc], axis=0)
+            col_names.append(cc)
+        for kk in self._scalar_names():
+            data[kk] = func(self[kk], axis=0)
+        return xt.Table(data, col_names=col_names)
+
+    def mean(self):
+        """Mean over the seeds of the columns and scalars."""
+        return self._summary(np.mean)
+
+    def std(self):
+        """Standard deviation over the seeds of the columns and scalars."""
+        return self._summary(np.std)
+
+    def min(self):
+        """Minimum over the seeds of the columns and scalars."""
+        return self._summary(np.min)
+
+    def max(self):
+        """Maximum over the seeds of the columns and scalars."""
+        return self._summary(np.max)
+
+
+def twiss_ensemble(lines_or_line, seed_setter=None, num_seeds=None,
+                   seeds=None, _context=None, _buffer=None, **kwargs):
+    """
+    Compute the twiss of an ensemble of lattice variants (e.g. error seeds
+    of the same machine) sharing the same element layout.
+
+    The closed orbits and one-turn matrices of all variants are computed
+    together, with a single kernel launch per iteration of the search; the
+    rest of the twiss of each variant is computed serially with
+    `Line.twiss` (see `EnsembleTracker.twiss`).
+
+    Parameters
+    ----------
+    lines_or_line: list of xtrack.Line or xtrack.Line
+        Lattice variants, or a base line from which the variants are
+        generated with `seed_setter`.
+    seed_setter: callable or dict, optional
+        Needed if a single line is given. If callable, it is called as
+        `seed_setter(line, i_seed)` on a copy of the base line for each
+        seed. If a dict, it maps a field name (or a tuple (field, index)
+        for array fields) to a tuple (element_names, values) where values
+        has shape (num_seeds, len(element_names)); the values are written
+        in the elements through `MultiSetter`.
+    num_seeds: int, optional
+        Number of seeds. Needed if `seed_setter` is callable.
+    seeds: array, optional
+        Labels of the seeds stored in the output.
+    _context: xobjects.Context, optional
+        Context used for the variants generated from a base line.
+    _buffer: xobjects.Buffer, optional
+        Common buffer in which the variants are stored.
+    **kwargs:
+        Arguments passed to `Line.twiss`.
+
+    Returns
+    -------
+    twiss_ensemble: TwissEnsembleTable
+        Twiss tables of all variants stacked along the seed axis.
+    """
+
+    if isinstance(lines_or_line, xt.Line):
+        if seed_setter is None:
+            raise ValueError('`seed_setter` must be provided when a single '
+                             'line is given')
+        lines = _lines_from_seed_setter(lines_or_line, seed_setter,
+                                        num_seeds, _context, _buffer)
+    else:
+        if seed_setter is not None:
+            raise ValueError('`seed_setter` can be used only with a single '
+                             'line')
+        lines = list(lines_or_line)
+
+    ens = EnsembleTracker(lines, _context=_context, _buffer=_buffer,
+                          compile=False)
+    return ens.twiss(seeds=seeds, **kwargs)
+
+
+def _lines_from_seed_setter(line, seed_setter, num_seeds, _context, _buffer):
+
+    if isinstance(seed_setter, dict):
+        seed_values = {}
+        for field, (names, values) in seed_setter.items():
+            values = np.atleast_2d(np.array(values, dtype=np.float64))
+            if values.shape[1] != len(names):
+                raise ValueError(f'Values for `{field}` must have shape '
+                                 f'(num_seeds, {len(names)})')
+            seed_values[field] = (list(names), values)
+            if num_seeds is None:
+                num_seeds = values.shape[0]
+            elif values.shape[0] != num_seeds:
+                raise ValueError(f'Values for `{field}` must have '
+                                 f'{num_seeds} rows')
+    elif num_seeds is None:
+        raise ValueError('`num_seeds` must be provided when `seed_setter` '
+                         'is callable')
+
+    if _buffer is None:
+        if _context is None:
+            _context = (line._context if line._has_valid_tracker()
+                        else xo.context_default)
+        _buffer = _context.new_buffer()
+
+    lines = []
+    for iseed in range(num_seeds):
+        ll = line.copy()
+        ll.build_tracker(_buffer=_buffer, compile=False)
+        if isinstance(seed_setter, dict):
+            for field, (names, values) in seed_values.items():
+                if isinstance(field, tuple):
+                    field, index = field
+                else:
+                    index = None
+                setter = xt.MultiSetter(ll, names, field=field, index=index)
+                setter.set_values(values[iseed])
+        else:
+            seed_setter(ll, iseed)
+        lines.append(ll)
+
+    return lines
+
+
+_TWISS_ARGS_NOT_BATCHED = [
+    'particle_on_co', 'R_matrix', 'W_matrix', 'co_guess', 'start', 'end',
+    'betx', 'bety', 'co_search_at', 'search_for_t_rev', 'radiation_method',
+    'at_s', 'compute_R_element_by_element',
+]
+
+
+def _ensemble_local_particle_shift_source():
+    # On the serial CPU context the per-particle blocks run from index zero
+    # to the number of active particles, so the local particle is made to
+    # point to a single particle by shifting all the per-particle arrays.
+    src_lines = ['''
+    #ifndef XTRACK_ENSEMBLE_SHIFT_H
+    #define XTRACK_ENSEMBLE_SHIFT_H
+    /*gpufun*/
+    void LocalParticle_shift_to_particle(LocalParticle* part, int64_t ii){''']
+    for _, vv in xt.Particles.per_particle_vars:
+        src_lines.append(f'        part->{vv} += ii;')
+    src_lines.append('''
+        part->ipart = 0;
+        part->endpart = 1;
+        part->_num_active_particles = (part->state[0] > 0) ? 1 : 0;
+        part->_num_lost_particles = 1 - part->_num_active_particles;
+    }
+    #endif
+    ''')
+    return '\n'.join(src_lines)
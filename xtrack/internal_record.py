@@ -85,6 +85,34 @@ class RecordIndex(xo.Struct):
     _extra_c_sources = [_RecordIndex_get_slot_source]
 
 
+_ElementProfileRecord_add_source = r'''
+/*gpufun*/
+void ElementProfileRecord_add(ElementProfileRecord record, int64_t ii,
+                              double dt, int64_t num_particles){
+    /*gpuglmem*/ double* time = ElementProfileRecord_getp1_time(record, ii);
+    /*gpuglmem*/ int64_t* num_part = ElementProfileRecord_getp1_num_particles(
+                                                                record, ii);
+    #pragma omp atomic //only_for_context cpu_openmp
+    *time += dt;
+    #pragma omp atomic //only_for_context cpu_openmp
+    *num_part += num_particles;
+}
+'''
+
+
+class ElementProfileRecord(xo.Struct):
+    '''
+    Time spent in each element of a line and number of particles tracked
+    through it, filled by the track kernel when the tracker config flag
+    `XTRACK_PROFILE_ELEMENTS` is set.
+    '''
+    num_particle_turns = xo.Int64
+    time = xo.Float64[:]
+    num_particles = xo.Int64[:]
+
+    _extra_c_sources = [_ElementProfileRecord_add_source]
+
+
 class IOBufferHeader(xo.Struct):
     buffer_id = xo.Int64
 
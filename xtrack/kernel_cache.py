@@ -0,0 +1,240 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import atexit
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+from ._version import __version__
+
+logger = logging.getLogger(__name__)
+
+KERNEL_CACHE_DIR_ENV = 'XTRACK_KERNEL_CACHE_DIR'
+DEFAULT_MAX_ENTRIES = 64
+
+_MODULE_PREFIX = 'xtrack_track_kernel_'
+
+_kernel_cache_settings = {
+    'directory': os.environ.get(KERNEL_CACHE_DIR_ENV) or None,
+    'max_entries': DEFAULT_MAX_ENTRIES,
+}
+
+
+def enable_kernel_cache(directory=None, max_entries=DEFAULT_MAX_ENTRIES):
+    """
+    Enable the persistent on-disk cache of compiled track kernels.
+
+    Compiled shared objects are stored in `directory` and reused by any
+    process building a tracker with the same element classes, tracker
+    configuration, local particle API and context type. The cache can also
+    be enabled by setting the environment variable `XTRACK_KERNEL_CACHE_DIR`.
+
+    Parameters
+    ----------
+    directory: str or Path, optional
+        Directory where the compiled kernels are stored. Defaults to
+        `~/.cache/xtrack/kernels`.
+    max_entries: int, optional
+        Maximum number of kernels kept in the cache. When exceeded, the least
+        recently used kernels are removed.
+    """
+    if directory is None:
+        directory = Path.home() / '.cache' / 'xtrack' / 'kernels'
+    assert max_entries >= 1
+    # Absolute, as worker processes run in their own working directory
+    _kernel_cache_settings['directory'] = str(Path(directory).absolute())
+    _kernel_cache_settings['max_entries'] = int(max_entries)
+
+
+def disable_kernel_cache():
+    """
+    Disable the persistent on-disk cache of compiled track kernels.
+    """
+    _kernel_cache_settings['directory'] = None
+
+
+def get_kernel_cache_directory():
+    """
+    Return the directory of the kernel cache or None if the cache is disabled.
+    """
+    directory = _kernel_cache_settings['directory']
+    if directory is None:
+        return None
+    return Path(directory).absolute()
+
+
+def kernel_cache_key(element_classes, hashable_config, local_particle_src,
+                     context, extra_headers=(), specialization=None):
+    """
+    Compute the content address of a track kernel from the quantities that
+    determine the generated source, including the content of the C sources
+    of the element classes (and of their dependencies) and of the extra
+    headers, so that edited sources are not served from the cache.
+    """
+    hh = hashlib.sha256()
+    hh.update(__version__.encode())
+    hh.update(type(context).__name__.encode())
+    for cc in element_classes:
+        xostruct = getattr(cc, '_XoStruct', cc)
+        hh.update(xostruct.__name__.encode())
+        for ff in xostruct._fields:
+            hh.update(f'{ff.name}:{ff.ftype.__name__};'.encode())
+    hh.update(_c_sources_digest(element_classes).encode())
+    hh.update(repr(hashable_config).encode())
+    hh.update(local_particle_src.encode())
+    for hd in extra_headers:
+        hh.update(_source_content(hd))
+    if specialization is not None:
+        hh.update(specialization.encode())
+    return hh.hexdigest()[:32]
+
+
+def _source_content(source):
+    if isinstance(source, Path):
+        try:
+            return source.read_bytes()
+        except OSError:
+            return str(source).encode()
+    return str(source).encode()
+
+
+def _c_sources_digest(element_classes):
+    hh = hashlib.sha256()
+    seen = set()
+    to_visit = [getattr(cc, '_XoStruct', cc) for cc in element_classes]
+    while to_visit:
+        cc = to_visit.pop()
+        if cc in seen:
+            continue
+        seen.add(cc)
+        hh.update(cc.__name__.encode())
+        for src in getattr(cc, '_extra_c_sources', []):
+            hh.update(_source_content(src))
+        to_visit.extend(getattr(dd, '_XoStruct', dd)
+                        for dd in getattr(cc, '_depends_on', []))
+    return hh.hexdigest()
+
+
+def kernel_cache_module_name(key):
+    return _MODULE_PREFIX + key
+
+
+def find_cached_kernel(key):
+    """
+    Return the path of the shared object cached for `key` or None.
+    """
+    directory = get_kernel_cache_directory()
+    if directory is None:
+        return None
+    found = sorted(directory.glob(kernel_cache_module_name(key) + '.*so'))
+    if len(found) == 0:
+        found = sorted(directory.glob(kernel_cache_module_name(key) + '.*pyd'))
+    if len(found) == 0:
+        return None
+    return found[0]
+
+
+def touch_cached_kernel(so_file):
+    """
+    Mark a cached kernel as recently used.
+    """
+    try:
+        os.utime(so_file)
+    except OSError:
+        pass
+
+
+@contextmanager
+def kernel_cache_lock(key='global', blocking=True):
+    """
+    Inter-process lock on a kernel cache entry, to make sure that concurrent
+    jobs on the same node compile a given kernel only once.
+
+    Yields True if the lock was acquired. With `blocking=False`, yields False
+    without waiting if the lock is held by someone else.
+    """
+    directory = get_kernel_cache_directory()
+    directory.mkdir(parents=True, exist_ok=True)
+    lock_path = directory / f'{_MODULE_PREFIX}{key}.lock'
+    with open(lock_path, 'a') as fid:
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fid.fileno(), flags)
+            except BlockingIOError:
+                yield False
+                return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fid.fileno(), fcntl.LOCK_UN)
+
+
+def evict_kernel_cache(max_entries=None):
+    """
+    Remove the least recently used kernels from the cache, keeping at most
+    `max_entries` of them. Kernels that are being compiled or loaded by
+    another process are skipped.
+    """
+    directory = get_kernel_cache_directory()
+    if directory is None or not directory.exists():
+        return
+    if max_entries is None:
+        max_entries = _kernel_cache_settings['max_entries']
+
+    with kernel_cache_lock():
+        so_files = [ff for ff in directory.glob(_MODULE_PREFIX + '*')
+                    if ff.suffix in ('.so', '.pyd')]
+        num_to_remove = len(so_files) - max_entries
+        if num_to_remove <= 0:
+            return
+        so_files.sort(key=lambda ff: ff.stat().st_mtime)
+        for ff in so_files:
+            if num_to_remove == 0:
+                break
+            module_name = ff.name.split('.')[0]
+            key = module_name[len(_MODULE_PREFIX):]
+            with kernel_cache_lock(key, blocking=False) as acquired:
+                if not acquired:
+                    logger.info(f'Kernel {module_name} is in use, '
+                                'not removing it from the kernel cache')
+                    continue
+                logger.info(
+                    f'Removing kernel {module_name} from the kernel cache')
+                for related in directory.glob(module_name + '.*'):
+                    if related.suffix == '.lock':
+                        continue
+                    try:
+                        related.unlink()
+                    except OSError:
+                        pass
+            num_to_remove -= 1
+
+
+def use_private_build_directory():
+    """
+    Move the current process to a private temporary working directory.
+
+    The kernel sources and object files are written in the working directory
+    while compiling. Worker processes call this at startup, so that a worker
+    stopped while compiling does not leave build files in the directory of
+    the user.
+    """
+    build_dir = tempfile.mkdtemp(prefix='xtrack_build_')
+    os.chdir(build_dir)
+    atexit.register(shutil.rmtree, build_dir, ignore_errors=True)
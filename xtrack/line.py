@@ -32,7 +32,7 @@ from .survey import survey_from_line
 from xtrack.twiss import (compute_one_turn_matrix_finite_differences,
                           find_closed_orbit_line, twiss_line,
                           compute_T_matrix_line,
-                          get_non_linear_chromaticity,
+                          get_non_linear_chromaticity, TwissCache,
                           DEFAULT_MATRIX_STABILITY_TOL,
                           DEFAULT_MATRIX_RESPONSIVENESS_TOL)
 from .match import match_line, closed_orbit_correction, match_knob_line, Action
@@ -40,7 +40,8 @@ from .tapering import compensate_radiation_energy_loss
 from .mad_loader import MadLoader
 from .beam_elements import element_classes
 from . import beam_elements
-from .beam_elements import Drift, BeamElement, Marker, Multipole
+from .beam_elements import (Drift, BeamElement, Marker, Multipole,
+                            FirstOrderTaylorMap)
 from .footprint import Footprint, _footprint_with_linear_rescale
 from .internal_record import (start_internal_logging_for_elements_of_type,
                               stop_internal_logging_for_elements_of_type,
@@ -898,6 +899,8 @@ class Line:
         if hasattr(self, 'tracker') and self.tracker is not None:
             self.tracker._invalidate()
             self.tracker = None
+        if getattr(self, '_twiss_cache', None) is not None:
+            self._twiss_cache.clear()
 
     def track(
         self,
@@ -952,6 +955,40 @@ class Line:
             is provided, it is used as the number of turns between two updates
             of the progress bar. If True, 100 is taken by default. By default,
             equals to False and no progress bar is displayed.
+        compact_lost_particles: bool or float, optional
+            If truthy, the tracking is split in segments of
+            `compaction_interval` turns and, between segments, the active
+            particles are moved to the beginning of the particle arrays when
+            the fraction of lost particles among the tracked ones exceeds the
+            given threshold (0.2 if True). The following segments are
+            launched only on the active particles. Available only for
+            non-collective tracking on CPU contexts without OpenMP.
+        compaction_interval: int, optional
+            Number of turns between two checks of the fraction of lost
+            particles when `compact_lost_particles` is used. Defaults to 100.
+        stop_condition: str, float or callable, optional
+            If provided, the tracking is stopped before `num_turns` when the
+            condition is met. It can be 'all_lost' (or True) to stop when no
+            particle is active, a float to stop when the fraction of lost
+            particles exceeds the given value, or a function taking the
+            particles as argument and returning True to stop. The condition
+            is checked every `stop_condition_interval` turns. If the
+            turn-by-turn monitor is created by the tracker, its data are
+            truncated to the tracked turns.
+        stop_condition_interval: int, optional
+            Number of turns between two checks of `stop_condition`. Defaults
+            to 100.
+        checkpoint_every: int, optional
+            If provided, the state of the tracking (particles including the
+            random number generator state, turn-by-turn monitor and state of
+            the time-dependent variables) is written every `checkpoint_every`
+            turns in `checkpoint_path`. The tracking can be continued with
+            `Line.resume_from_checkpoint`.
+        checkpoint_path: str or Path, optional
+            Directory where the checkpoints are written.
+        checkpoint_keep: int, optional
+            Number of most recent checkpoints kept in `checkpoint_path`.
+            Defaults to 2.
         """
 
         if hasattr(particles, '_needs_pipeline') and particles._needs_pipeline:
@@ -981,6 +1018,63 @@ class Line:
             with_progress=with_progress,
             **kwargs)
 
+    def track_async(self, particles, awaitable=False, executor=None,
+                    **kwargs):
+        """
+        Track particles on a worker thread and return immediately. The
+        compiled track kernel runs without holding the Python GIL, so that
+        different lines (e.g. the two beams of a Multiline) can be tracked at
+        the same time while the interpreter remains available. Tracking calls
+        on the same line are executed one after the other.
+
+        Parameters
+        ----------
+        particles: xpart.Particles
+            The particles to track.
+        awaitable: bool, optional
+            If True, an asyncio future is returned, which can be awaited in a
+            coroutine. Defaults to False.
+        executor: concurrent.futures.Executor, optional
+            Executor used to run the tracking. Defaults to a thread pool
+            shared by all lines.
+        **kwargs:
+            Tracking options (see `Line.track`).
+
+        Returns
+        -------
+        future: concurrent.futures.Future or asyncio.Future
+            Future whose result is the value returned by `Line.track`. A
+            turn-by-turn monitor created by the tracking is available in
+            `line.record_last_track` after completion, until the line is
+            tracked again (in any thread).
+        """
+        self._check_valid_tracker()
+        return self.tracker.track_async(particles, awaitable=awaitable,
+                                        executor=executor, **kwargs)
+
+    def resume_from_checkpoint(self, checkpoint_path, **kwargs):
+        """
+        Resume a tracking interrupted after writing a checkpoint (see the
+        `checkpoint_every` argument of `Line.track`) and track the remaining
+        turns.
+
+        Parameters
+        ----------
+        checkpoint_path: str or Path
+            Checkpoint file or directory containing the checkpoints, in which
+            case the most recent one is used.
+        **kwargs:
+            Tracking options overriding those stored in the checkpoint.
+
+        Returns
+        -------
+        particles: xtrack.Particles
+            The tracked particles. The turn-by-turn monitor, if any, is
+            available in `line.record_last_track`.
+        """
+        self._check_valid_tracker()
+        return self.tracker.resume_from_checkpoint(checkpoint_path, **kwargs)
+
     def slice_thick_elements(self, slicing_strategies):
         """
         Slice thick elements in the line. Slicing is done in place.
@@ -1204,6 +1298,11 @@ class Line:
         _keep_initial_particles=None,
         _initial_particles=None,
         _ebe_monitor=None,
+        _co_search_R_matrix=None,
+        incremental=None,
+        engine=None,
+        co_search_method=None,
+        lazy_columns=None,
         ele_start='__discontinued__',
         ele_stop='__discontinued__',
         ele_init='__discontinued__',
@@ -1226,10 +1325,40 @@ class Line:
                 tw_kwargs[kk] = vv
 
         tw_kwargs.pop('self')
-        return twiss_line(self, **tw_kwargs)
+
+        twiss_cache = getattr(self, '_twiss_cache', None)
+        if twiss_cache is None:
+            return twiss_line(self, **tw_kwargs)
+
+        cache_key = twiss_cache.key(self, tw_kwargs)
+        out = twiss_cache.get(cache_key)
+        if out is None:
+            out = twiss_cache.put(cache_key, twiss_line(self, **tw_kwargs))
+        return out
 
     twiss.__doc__ = twiss_line.__doc__
 
+    def enable_twiss_cache(self, max_size=32):
+        """
+        Enable the caching of the twiss results. Calls to `twiss` with the
+        same arguments, the same values of the independent variables, the
+        same tracker configuration and unchanged elements return a copy of
+        the cached table, with read-only columns.
+
+        Parameters
+        ----------
+        max_size: int, optional
+            Maximum number of twiss tables kept in the cache. When exceeded,
+            the least recently used tables are removed. Defaults to 32.
+        """
+        self._twiss_cache = TwissCache(max_size=max_size)
+
+    def disable_twiss_cache(self):
+        """
+        Disable the caching of the twiss results (see `enable_twiss_cache`).
+        """
+        self._twiss_cache = None
+
     def twiss4d(self, **kwargs):
 
         """
@@ -1244,7 +1373,8 @@ class Line:
                   solver_options={}, allow_twiss_failure=True,
                   restore_if_fail=True, verbose=False,
                   n_steps_max=20, default_tol=None,
-                  solver=None, check_limits=True, **kwargs):
+                  solver=None, check_limits=True, num_jacobian_workers=None,
+                  jacobian_method=None, compile_knobs=False, **kwargs):
         '''
         Change a set of knobs in the beamline in order to match assigned targets.
 
@@ -1287,6 +1417,26 @@ class Line:
             If True (default), the limits of the knobs are checked before the
             optimization. If False, if the knobs are out of limits, the optimization
             knobs are set to the limits on the first iteration.
+        num_jacobian_workers : int
+            If provided, the columns of the Jacobian are computed concurrently
+            by the given number of worker processes, each holding a copy of
+            the line (serial CPU context only).
+        jacobian_method : str
+            Method used to obtain the Jacobian at each step of the matching.
+            Can be 'finite_differences' (default), which recomputes it at each
+            step, 'broyden', which updates it with rank-one corrections from
+            the steps taken and recomputes it only if the matching stalls, or
+            'analytical', which computes the response of linear optics targets
+            (beta, alpha, phase advance, tunes, dispersion) to variables
+            driving quadrupole strengths from the twiss table and uses finite
+            differences only for the other variables.
+            The number of twiss calls can be inspected with
+            `xt.match.match_stats`.
+        compile_knobs : bool
+            If True, the knobs to be varied are compiled into linear maps to
+            the element fields (see `Line.compile_knobs`), so that setting
+            them does not require the evaluation of the dependency graph.
+            Defaults to False.
         **kwargs : dict
             Additional arguments to be passed to the twiss.
 
@@ -1361,7 +1511,10 @@ class Line:
                         restore_if_fail=restore_if_fail,
                         verbose=verbose, n_steps_max=n_steps_max,
                         default_tol=default_tol, solver=solver,
-                        check_limits=check_limits, **kwargs)
+                        check_limits=check_limits,
+                        num_jacobian_workers=num_jacobian_workers,
+                        jacobian_method=jacobian_method,
+                        compile_knobs=compile_knobs, **kwargs)
 
 
     def match_knob(self, knob_name, vary, targets,
@@ -1397,6 +1550,72 @@ class Line:
 
         return opt
 
+    def compile_knobs(self, knobs, step=1.):
+
+        '''
+        Compile a set of knobs into linear maps from the knob values to the
+        element fields in the tracker buffer, such that setting a knob is a
+        vectorized buffer write instead of an evaluation of the dependency
+        graph.
+
+        Parameters
+        ----------
+        knobs : list of str
+            Names of the independent variables to be compiled.
+        step : float
+            Step used to evaluate the coefficients of the linear maps and to
+            check their linearity. Defaults to 1.
+
+        Returns
+        -------
+        compiled_knobs : CompiledKnobs
+            Object used to set the knobs, e.g. ``compiled_knobs['on_x1'] = 10``
+            or ``compiled_knobs.update({'on_x1': 10, 'on_x5': 10})``. It can be
+            used as container of `xt.Vary` in matching.
+        '''
+
+        if not self._has_valid_tracker():
+            self.build_tracker()
+
+        return xt.CompiledKnobs(self, knobs, step=step)
+
+    def precompute_time_dependent_vars(self, t_s):
+
+        '''
+        Sample the element fields driven by the time-dependent variables
+        (i.e. by `line.vars['t_turn_s']`) on a time grid and use the sampled
+        values during tracking, instead of evaluating the dependency graph at
+        each update of the time-dependent variables.
+
+        At each turn the values of the last sample not later than the time
+        of the turn are written in the tracker buffer, hence the grid replaces
+        `dt_update_time_dependent_vars`. The table needs to be recomputed if
+        the variables or the expressions are changed.
+
+        Parameters
+        ----------
+        t_s : array or None
+            Times (in seconds, strictly increasing) at which the variables are
+            sampled. If None, the precomputed table is discarded and the
+            dependency graph is evaluated again during tracking.
+
+        Returns
+        -------
+        table : TimeDependentVarsTable or None
+            Table with the sampled values.
+        '''
+
+        if not self._has_valid_tracker():
+            self.build_tracker()
+
+        if t_s is None:
+            self.tracker._time_dependent_vars_table = None
+            return None
+
+        table = xt.TimeDependentVarsTable(self, t_s)
+        self.tracker._time_dependent_vars_table = table
+        return table
+
 
     def survey(self,X0=0,Y0=0,Z0=0,theta0=0, phi0=0, psi0=0,
                element0=0, reverse=None):
@@ -1590,7 +1809,8 @@ class Line:
                           co_search_at=None,
                           search_for_t_rev=False,
                           num_turns_search_t_rev=None,
-                          symmetrize=False):
+                          symmetrize=False,
+                          co_search_method='optimize'):
 
         """
         Find the closed orbit of the beamline.
@@ -1629,6 +1849,15 @@ class Line:
         co_search_at : int or str
             Element at which the closed orbit search is performed. If None,
             the closed orbit search is performed at the start of the line.
+        co_search_method : str
+            Method used for the search. It can be ``'optimize'`` (default) or
+            ``'newton'``. With ``'newton'``, the guess is tracked together
+            with finite-difference probes giving the one-turn Jacobian at each
+            iteration, and the step is controlled by a line search. In this
+            case ``co_search_settings`` can contain ``max_iterations``,
+            ``tol`` (list of six tolerances) and ``steps_r_matrix``.
+            Convergence information is available in
+            ``particle_on_co._fsolve_info``.
 
         Returns
         -------
@@ -1666,7 +1895,8 @@ class Line:
                                  co_search_at=co_search_at,
                                  search_for_t_rev=search_for_t_rev,
                                  num_turns_search_t_rev=num_turns_search_t_rev,
-                                 symmetrize=symmetrize)
+                                 symmetrize=symmetrize,
+                                 co_search_method=co_search_method)
 
     def compute_T_matrix(self, start=None, end=None,
                          particle_on_co=None, steps_t_matrix=None):
@@ -1873,7 +2103,8 @@ class Line:
             start=None, end=None,
             num_turns=1,
             element_by_element=False, only_markers=False,
-            symmetrize=False):
+            symmetrize=False, at_elements=None, streaming=False,
+            chunk_size=None):
 
         '''Compute the one turn matrix using finite differences.
 
@@ -1890,11 +2121,29 @@ class Line:
         end : str
             Optional. It can be used to find the periodic solution for a
             portion of the line.
+        element_by_element : bool
+            If True, the R matrix from the start of the line to each element
+            is also computed (``R_matrix_ebe`` in the output, the positions
+            being given by ``R_matrix_ebe_index``).
+        only_markers : bool
+            If True, the element-by-element R matrix is returned only at the
+            markers and at the end of the line.
+        at_elements : list of str or int
+            Optional. Names or indices of the elements at which the
+            element-by-element R matrix is returned. The end of the line can be
+            selected with ``'_end_point'`` or ``len(line.element_names)``.
+        streaming : bool
+            If True, the element-by-element R matrix is computed tracking the
+            line in chunks of elements, so that the probe coordinates are
+            never stored for the full line.
+        chunk_size : int
+            Number of elements tracked at once when ``streaming`` is True.
 
         Returns
         -------
-        one_turn_matrix : np.ndarray
-            One turn matrix.
+        out : dict
+            Dictionary containing the one turn matrix (``R_matrix``) and,
+            if requested, the element-by-element R matrices.
 
         '''
 
@@ -1914,10 +2163,14 @@ class Line:
                         num_turns=num_turns,
                         element_by_element=element_by_element,
                         only_markers=only_markers,
-                        symmetrize=symmetrize)
+                        symmetrize=symmetrize,
+                        at_elements=at_elements,
+                        streaming=streaming,
+                        chunk_size=chunk_size)
 
     def get_non_linear_chromaticity(self,
-                        delta0_range=(-1e-3, 1e-3), num_delta=5, fit_order=3, **kwargs):
+                        delta0_range=(-1e-3, 1e-3), num_delta=5, fit_order=3,
+                        batched=False, full_twiss=False, **kwargs):
 
         '''Get non-linear chromaticity for given range of delta values
 
@@ -1927,6 +2180,19 @@ class Line:
             Range of delta values for chromaticity computation.
         num_delta : int
             Number of delta values for chromaticity computation.
+        batched : bool
+            If True, the closed orbits and the one-turn matrices for all the
+            delta values are computed together, tracking the finite-difference
+            probes of all delta values in a single particles object. Only the
+            tunes and the momentum compaction factor are computed, unless
+            `full_twiss` is True. The probes are tracked with the energy
+            frozen, as in the 4d twiss; the only twiss argument accepted in
+            this mode is `freeze_energy`, and lines with radiation are not
+            supported.
+        full_twiss : bool
+            If True and `batched` is True, the twiss tables for all the delta
+            values are computed and returned in the `twiss` field of the
+            output. They are always returned when `batched` is False.
         kwargs : dict
             Additional arguments to be passed to the twiss.
 
@@ -1938,7 +2204,8 @@ class Line:
         '''
 
         return get_non_linear_chromaticity(self, delta0_range, num_delta,
-                                           fit_order, **kwargs)
+                                           fit_order, batched=batched,
+                                           full_twiss=full_twiss, **kwargs)
 
     def get_length(self):
 
@@ -2646,7 +2913,8 @@ class Line:
         self._check_valid_tracker()
         compensate_radiation_energy_loss(self, **all_kwargs)
 
-    def optimize_for_tracking(self, compile=True, verbose=True, keep_markers=False):
+    def optimize_for_tracking(self, compile=True, verbose=True, keep_markers=False,
+                              fuse_linear_elements=False):
 
         """
         Optimize the line for tracking by removing inactive elements and
@@ -2661,6 +2929,13 @@ class Line:
             If True (default), print information about the optimization.
         keep_markers: bool or list of str
             If True, all markers are kept.
+        fuse_linear_elements: bool or dict
+            If True, runs of consecutive linear elements are replaced by first
+            order maps (see `Line.fuse_linear_elements`). A dict is passed as
+            arguments to `Line.fuse_linear_elements`, e.g.
+            ``{'fuse_drifts': True}``. With the defaults, drifts are not
+            fused, so that little is fused in lattices where the magnets are
+            separated by drifts. Defaults to False.
 
         """
 
@@ -2714,6 +2989,13 @@ class Line:
         if verbose: _print("Use simple quadrupoles")
         self.use_simple_quadrupoles()
 
+        if fuse_linear_elements:
+            if verbose: _print("Fuse linear elements")
+            if isinstance(fuse_linear_elements, dict):
+                self.fuse_linear_elements(**fuse_linear_elements)
+            else:
+                self.fuse_linear_elements()
+
         if verbose: _print("Rebuild tracker data")
         self.build_tracker(_buffer=buffer, io_buffer=io_buffer)
 
@@ -2958,6 +3240,126 @@ class Line:
         else:
             return newline
 
+    def fuse_linear_elements(self, inplace=True, keep=None, min_elements=2,
+                             fuse_drifts=False, check_tolerance=None,
+                             check_amplitudes=None, verbose=False):
+
+        '''
+        Replace runs of consecutive linear elements (drifts, thin dipole,
+        quadrupole and skew quadrupole kicks, shifts and rotations) by a single
+        `FirstOrderTaylorMap` computed around the reference trajectory.
+        The maps are exact for thin elements, shifts and rotations, but not
+        for drifts: their terms beyond first order, i.e. their chromatic
+        effects (the dependence of the transverse motion on the momentum
+        deviation, which gives the natural chromaticity of a thin lattice) and
+        the path lengthening, are dropped. For this reason drifts of non-zero
+        length are not fused unless `fuse_drifts` is True. This default is
+        exact but fuses only the runs of thin elements that are not separated
+        by drifts, which in most lattices are short; `fuse_drifts=True`,
+        possibly with `check_tolerance`, is needed to fuse the drifts between
+        magnets, and the effects above are then lost.
+
+        Parameters
+        ----------
+        inplace : bool
+            If True, fuse the elements in the line (default: True),
+            otherwise return a new line.
+        keep : str or list of str
+            Name of the elements to keep (default: None)
+        min_elements : int
+            Minimum number of consecutive linear elements to be fused
+            (default: 2).
+        fuse_drifts : bool
+            If True, drifts of non-zero length are also fused, dropping their
+            chromatic effects and path lengthening (default: False).
+        check_tolerance : float, optional
+            If given, particles with the amplitudes given by `check_amplitudes`
+            are tracked through each run element by element and through the
+            fused map, and the run is kept unchanged if the maximum deviation
+            in any coordinate exceeds the tolerance.
+        check_amplitudes : dict, optional
+            Amplitudes in x, px, y, py, zeta, delta used by the check
+            (default: 1e-3, 1e-5, 1e-3, 1e-5, 1e-3, 1e-4).
+        verbose : bool
+            If True, print the number of fused elements (default: False).
+
+        Returns
+        -------
+        line : Line
+            Line with runs of linear elements fused.
+
+        '''
+
+        assert inplace is True, 'Only inplace is supported for now'
+
+        self._frozen_check()
+
+        if self.particle_ref is None:
+            raise ValueError('`particle_ref` must be defined to fuse '
+                             'linear elements')
+
+        if keep is None:
+            keep = []
+        elif isinstance(keep, str):
+            keep = [keep]
+
+        if check_amplitudes is None:
+            check_amplitudes = {}
+        amplitudes = dict(x=1e-3, px=1e-5, y=1e-3, py=1e-5, zeta=1e-3,
+                          delta=1e-4)
+        amplitudes.update(check_amplitudes)
+
+        newline = Line(elements=[], element_names=[])
+        run_names = []
+        run_elements = []
+        n_fused = 0
+
+        def _flush_run():
+            nonlocal n_fused
+            fmap = None
+            if len(run_names) >= min_elements:
+                fmap = FirstOrderTaylorMap.from_elements(
+                    run_elements, particle_ref=self.particle_ref)
+                if (check_tolerance is not None and _linear_map_deviation(
+                        run_elements, fmap, self.particle_ref, amplitudes)
+                        > check_tolerance):
+                    fmap = None
+            if fmap is None:
+                for nn in run_names:
+                    newline.append_element(self.element_dict[nn], nn)
+            else:
+                newline.append_element(fmap, '_'.join(
+                    [run_names[0], 'to', run_names[-1], 'fused']))
+                n_fused += len(run_names)
+            run_names.clear()
+            run_elements.clear()
+
+        for nn in self.element_names:
+            ee = self.element_dict[nn]
+            if isinstance(ee, xt.Replica):
+                ee_resolved = ee.resolve(self)
+            else:
+                ee_resolved = ee
+            if (nn not in keep and _is_linear_element(ee_resolved, self)
+                    and (fuse_drifts or not _is_drift(ee_resolved, self)
+                         or ee_resolved.length == 0)):
+                run_names.append(nn)
+                run_elements.append(ee_resolved)
+            else:
+                _flush_run()
+                newline.append_element(ee, nn)
+        _flush_run()
+
+        if verbose:
+            _print(f'Fused {n_fused} linear elements')
+
+        if inplace:
+            self.element_names = newline.element_names
+            self.element_dict.update(newline.element_dict)
+            return self
+        else:
+            return newline
+
     def remove_redundant_apertures(self, inplace=True, keep=None,
                                   drifts_that_need_aperture=[]):
 
@@ -4076,6 +4478,7 @@ class Line:
             out.tracker.__dict__.update(self.tracker.__dict__)
             out.tracker.iscollective = False
             out.tracker.line = out
+            out.tracker._reset_last_track_info()
 
             return out
 
@@ -4557,6 +4960,41 @@ def _behaves_like_drift(element, line):
         element = element.resolve(line)
     return hasattr(element, 'behaves_like_drift') and element.behaves_like_drift
 
+def _is_linear_element(element, line):
+    if isinstance(element, xt.Replica):
+        element = element.resolve(line)
+    if isinstance(element, (beam_elements.Drift, beam_elements.SRotation,
+                            beam_elements.XYShift,
+                            beam_elements.SimpleThinQuadrupole)):
+        return True
+    if isinstance(element, Multipole):
+        return (np.all(element._xobject.knl.to_nparray()[2:] == 0)
+                and np.all(element._xobject.ksl.to_nparray()[2:] == 0)
+                and element.hxl == 0 and element.radiation_flag == 0)
+    if isinstance(element, beam_elements.FirstOrderTaylorMap):
+        return element.radiation_flag == 0
+    return False
+
+def _linear_map_deviation(elements, fmap, particle_ref, amplitudes):
+    # Maximum deviation between element-by-element tracking and tracking
+    # through the fused map for particles at the given amplitudes
+    context = xo.context_default
+    signs = [-1, 1]
+    coords = {nn: [] for nn in amplitudes}
+    for nn in amplitudes:
+        for ss in signs:
+            for mm in amplitudes:
+                coords[mm].append(ss * amplitudes[nn] if mm == nn else 0)
+    part_ebe = xt.Particles(_context=context, mass0=particle_ref.mass0,
+                            q0=particle_ref.q0,
+                            p0c=particle_ref._xobject.p0c[0], **coords)
+    part_map = part_ebe.copy()
+    for ee in elements:
+        ee.copy(_context=context).track(part_ebe)
+    fmap.copy(_context=context).track(part_map)
+    return max(np.max(np.abs(getattr(part_ebe, nn) - getattr(part_map, nn)))
+               for nn in ['x', 'px', 'y', 'py', 'zeta', 'delta'])
+
 def _is_aperture(element, line):
     if isinstance(element, xt.Replica):
         element = element.resolve(line)
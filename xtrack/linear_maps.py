@@ -0,0 +1,565 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2024.                 #
+# ######################################### #
+
+import numpy as np
+
+from .beam_elements import (Drift, Marker, Multipole, Quadrupole, Bend,
+                            FirstOrderTaylorMap, SRotation, XYShift,
+                            DipoleEdge)
+
+# Coordinates of the linear maps (same as the W matrices of the twiss)
+MAP_COORDINATES = ('x', 'px', 'y', 'py', 'zeta', 'pzeta')
+
+COMPLEX_STEP = 1e-20
+
+DEFAULT_STEPS_FINITE_DIFFERENCES = {
+    'x': 1e-6, 'px': 1e-7, 'y': 1e-6, 'py': 1e-7, 'zeta': 1e-6, 'delta': 1e-6}
+
+
+def compute_element_linear_maps(line, monitor, i_start, i_stop,
+                                particle_template, i_part=0,
+                                element_map_params=None):
+    """
+    Compute the linear maps of the elements of a line around a reference
+    trajectory.
+
+    Parameters
+    ----------
+    line : xtrack.Line
+        Line with a built tracker.
+    monitor : xtrack.ParticlesMonitor
+        Element-by-element monitor containing the reference trajectory.
+    i_start : int
+        Index of the first element.
+    i_stop : int
+        Index of the element after the last one.
+    particle_template : xtrack.Particles
+        Reference particle used to build the probes for the elements for which
+        the map is obtained by finite differences.
+    i_part : int
+        Index of the reference particle in the monitor. Default is 0.
+    element_map_params : list, optional
+        Output of `get_element_map_params` for the line (computed if not
+        provided).
+
+    Returns
+    -------
+    maps : np.ndarray
+        Array of shape (i_stop - i_start, 6, 6) with the linear maps in the
+        coordinates (x, px, y, py, zeta, pzeta). The maps are obtained by
+        differentiation (complex step) of a numpy implementation of the
+        tracking maps for the elements for which it is available
+        (Drift, Marker, Multipole, Quadrupole, Bend with expanded model,
+        FirstOrderTaylorMap, SRotation, XYShift, DipoleEdge with linear model)
+        and by finite differences on single element tracking for the others.
+    """
+
+    if element_map_params is None:
+        element_map_params = get_element_map_params(line)
+
+    orbit = {nn: np.array(getattr(monitor, nn)[i_part, i_start:i_stop],
+                          dtype=np.float64)
+             for nn in ('x', 'px', 'y', 'py', 'zeta', 'ptau', 'beta0', 'chi')}
+    orbit['pzeta'] = orbit.pop('ptau') / orbit['beta0']
+
+    maps = np.zeros((i_stop - i_start, 6, 6), dtype=np.float64)
+    by_map = {}
+    finite_differences = []
+    for ii in range(i_start, i_stop):
+        map_function, params = element_map_params[ii]
+        if map_function is None:
+            finite_differences.append(ii)
+            continue
+        indices, param_list = by_map.setdefault(map_function, ([], []))
+        indices.append(ii - i_start)
+        param_list.append(params)
+
+    for map_function, (indices, param_list) in by_map.items():
+        indices = np.array(indices, dtype=np.int64)
+        params = {kk: np.array([pp[kk] for pp in param_list])
+                  for kk in param_list[0].keys()}
+        maps[indices] = _complex_step_jacobian(
+            map_function, {kk: vv[indices] for kk, vv in orbit.items()},
+            params)
+
+    if len(finite_differences) > 0:
+        import xpart
+        probes = xpart.build_particles(_context=line._context,
+                    particle_ref=particle_template, x=np.zeros(12))
+        reference = {nn: np.array(getattr(monitor, nn)[i_part, :])
+                     for _, nn in probes.per_particle_vars
+                     if hasattr(monitor.data, nn)}
+        for ii in finite_differences:
+            maps[ii - i_start] = _finite_differences_jacobian(
+                line, probes, {nn: vv[ii] for nn, vv in reference.items()},
+                i_ele=ii)
+
+    return maps
+
+
+def get_element_map_params(line, positions=None):
+    """
+    Extract the parameters of the numpy implementation of the maps of the
+    elements of a line.
+
+    Parameters
+    ----------
+    line : xtrack.Line
+        Line with a built tracker.
+    positions : list of int, optional
+        Positions of the elements in the line. If not provided all the
+        elements are considered.
+
+    Returns
+    -------
+    element_map_params : list
+        List of tuples (map_function, params) for each element, with
+        (None, None) for the elements for which the map is obtained by
+        finite differences (including all the elements with active shifts
+        or tilts).
+    """
+
+    elements = line.tracker._tracker_data_base._elements
+    config = line.config
+
+    if positions is not None:
+        elements = [elements[ii] for ii in positions]
+
+    out = []
+    for ee in elements:
+        handler = _ELEMENT_MAPS.get(type(ee), None)
+        params = None
+        if handler is not None and not _has_transformations(ee):
+            params = handler[0](ee, config)
+        if params is None:
+            out.append((None, None))
+        else:
+            out.append((handler[1], params))
+    return out
+
+
+def cumulative_matrix_products(maps, W0):
+    """
+    Compute the products ``maps[k-1] @ ... @ maps[0] @ W0`` for all k.
+
+    Parameters
+    ----------
+    maps : np.ndarray
+        Array of shape (n, 6, 6).
+    W0 : np.ndarray
+        Array of shape (6, 6).
+
+    Returns
+    -------
+    out : np.ndarray
+        Array of shape (n + 1, 6, 6), ``out[0]`` being ``W0``.
+    """
+
+    # Inclusive prefix scan with log2(n) batched products
+    prod = maps.copy()
+    dd = 1
+    while dd < len(prod):
+        prod[dd:] = prod[dd:] @ prod[:-dd]
+        dd *= 2
+
+    out = np.zeros((len(maps) + 1, 6, 6), dtype=np.float64)
+    out[0] = W0
+    out[1:] = prod @ W0
+    return out
+
+
+def _complex_step_jacobian(map_function, orbit, params):
+
+    nn = len(orbit['x'])
+    coords = {}
+    for jj, kk in enumerate(MAP_COORDINATES):
+        cc = np.zeros((nn, 6), dtype=np.complex128)
+        cc[:] = orbit[kk][:, None]
+        cc[:, jj] += 1j * COMPLEX_STEP
+        coords[kk] = cc
+    coords['beta0'] = orbit['beta0'][:, None]
+    coords['chi'] = orbit['chi'][:, None]
+    params = {kk: (vv[:, None] if vv.ndim == 1 else vv[:, None, :])
+              for kk, vv in params.items()}
+
+    map_function(coords, **params)
+
+    out = np.zeros((nn, 6, 6), dtype=np.float64)
+    for ii, kk in enumerate(MAP_COORDINATES):
+        out[:, ii, :] = np.imag(coords[kk]) / COMPLEX_STEP
+    return out
+
+
+def _finite_differences_jacobian(line, part, reference, i_ele):
+
+    # All the per-particle variables of the probes are overwritten, so that
+    # the same particles object can be used for all elements
+    context = part._context
+    ctx2np = context.nparray_from_context_array
+    steps = DEFAULT_STEPS_FINITE_DIFFERENCES
+
+    with part._bypass_linked_vars():
+        for nn, vv in reference.items():
+            getattr(part, nn)[:] = context.nparray_to_context_array(
+                np.full(12, vv))
+
+    for jj, kk in enumerate(MAP_COORDINATES[:5]):
+        vv = ctx2np(getattr(part, kk)).copy()
+        vv[jj] += steps[kk]
+        vv[jj + 6] -= steps[kk]
+        getattr(part, kk)[:] = context.nparray_to_context_array(vv)
+    delta = ctx2np(part.delta).copy()
+    delta[5] += steps['delta']
+    delta[11] -= steps['delta']
+    part.update_delta(context.nparray_to_context_array(delta))
+
+    coords_in = np.array([ctx2np(_get_coordinate(part, kk)).copy()
+                          for kk in MAP_COORDINATES])
+
+    line.track(part, ele_start=i_ele, num_elements=1)
+
+    coords_out = np.array([ctx2np(_get_coordinate(part, kk)).copy()
+                           for kk in MAP_COORDINATES])
+
+    dd_in = np.diag(coords_in[:, :6] - coords_in[:, 6:])
+    return (coords_out[:, :6] - coords_out[:, 6:]) / dd_in
+
+
+def _get_coordinate(part, name):
+    if name == 'pzeta':
+        return part.ptau / part.beta0
+    return getattr(part, name)
+
+
+# Numpy implementations of the tracking maps. They act in place on a dict of
+# complex arrays and need to be analytic in the particle coordinates (no
+# branches on the coordinates other than on their real part).
+
+def _one_plus_delta_and_rvv(cc):
+    beta0 = cc['beta0']
+    ptau = beta0 * cc['pzeta']
+    one_plus_delta = np.sqrt(ptau * ptau + 2 * ptau / beta0 + 1)
+    rvv = one_plus_delta / (1 + beta0 * ptau)
+    return one_plus_delta, rvv
+
+
+def _drift_expanded(cc, length):
+    one_plus_delta, rvv = _one_plus_delta_and_rvv(cc)
+    xp = cc['px'] / one_plus_delta
+    yp = cc['py'] / one_plus_delta
+    cc['x'] = cc['x'] + xp * length
+    cc['y'] = cc['y'] + yp * length
+    cc['zeta'] = cc['zeta'] + length * (1 - (1 + (xp * xp + yp * yp) / 2) / rvv)
+
+
+def _drift_exact(cc, length):
+    one_plus_delta, rvv = _one_plus_delta_and_rvv(cc)
+    px = cc['px']
+    py = cc['py']
+    one_over_pz = 1 / np.sqrt(one_plus_delta * one_plus_delta - px * px - py * py)
+    cc['x'] = cc['x'] + px * one_over_pz * length
+    cc['y'] = cc['y'] + py * one_over_pz * length
+    cc['zeta'] = cc['zeta'] + length * (1 - one_plus_delta * one_over_pz / rvv)
+
+
+def _drift_map(cc, length, exact):
+    exact = exact.astype(bool)
+    if np.all(exact):
+        _drift_exact(cc, length)
+    elif not np.any(exact):
+        _drift_expanded(cc, length)
+    else:
+        raise ValueError('Mixed drift models')
+
+
+def _srotation(cc, sin_z, cos_z):
+    x, y, px, py = cc['x'], cc['y'], cc['px'], cc['py']
+    cc['x'] = cos_z * x + sin_z * y
+    cc['y'] = -sin_z * x + cos_z * y
+    cc['px'] = cos_z * px + sin_z * py
+    cc['py'] = -sin_z * px + cos_z * py
+
+
+def _identity_map(cc):
+    pass
+
+
+def _multipole_map(cc, knl, ksl, hxl, length, factor):
+    chi = cc['chi']
+    x = cc['x']
+    y = cc['y']
+
+    order = knl.shape[-1] - 1
+    inv_factorial = 1. / float(np.prod(np.arange(1, order + 1)))
+    index = order
+    dpx = chi * knl[..., index] * factor * inv_factorial
+    dpy = chi * ksl[..., index] * factor * inv_factorial
+    while index > 0:
+        zre = dpx * x - dpy * y
+        zim = dpx * y + dpy * x
+        inv_factorial *= index
+        index -= 1
+        dpx = chi * knl[..., index] * factor * inv_factorial + zre
+        dpy = chi * ksl[..., index] * factor * inv_factorial + zim
+    dpx = -dpx
+
+    one_plus_delta, rvv = _one_plus_delta_and_rvv(cc)
+    safe_length = np.where(length != 0, length, 1.)
+    b1l = chi * knl[..., 0] * factor
+    dpx = dpx + hxl * one_plus_delta
+    dpx = dpx - np.where(length != 0, b1l * hxl * x / safe_length, 0)
+
+    cc['zeta'] = cc['zeta'] - chi * hxl * x / rvv
+    cc['px'] = cc['px'] + dpx
+    cc['py'] = cc['py'] + dpy
+
+
+def _sin_cos_thick(kk, length):
+    # Returns sin(sqrt(K) L)/sqrt(K) and cos(sqrt(K) L) (with their analytic
+    # continuation for K < 0) branching on the real part of K only
+    pos = np.real(kk) > 0
+    neg = np.real(kk) < 0
+    sqrt_pos = np.sqrt(np.where(pos, kk, 1.))
+    sqrt_neg = np.sqrt(np.where(neg, -kk, 1.))
+    ss = np.where(pos, np.sin(sqrt_pos * length) / sqrt_pos,
+            np.where(neg, np.sinh(sqrt_neg * length) / sqrt_neg, length))
+    cs = np.where(pos, np.cos(sqrt_pos * length),
+            np.where(neg, np.cosh(sqrt_neg * length), 1.))
+    return ss, cs
+
+
+def _thick_cfd(cc, length, k0_, k1_, h):
+    # Port of track_thick_cfd
+
+    x, y, px, py = cc['x'], cc['y'], cc['px'], cc['py']
+    one_plus_delta, rvv = _one_plus_delta_and_rvv(cc)
+    chi = cc['chi']
+
+    k0 = chi * k0_ / one_plus_delta
+    k1 = chi * k1_ / one_plus_delta
+
+    Kx = k0 * h + k1
+    Ky = -k1
+    Kx_nonzero = np.real(Kx) != 0
+    Ky_nonzero = np.real(Ky) != 0
+    Kx_safe = np.where(Kx_nonzero, Kx, 1.)
+    Ky_safe = np.where(Ky_nonzero, Ky, 1.)
+
+    Sx, Cx = _sin_cos_thick(Kx, length)
+    Sy, Cy = _sin_cos_thick(Ky, length)
+
+    xp = px / one_plus_delta
+    yp = py / one_plus_delta
+    A = -Kx * x - k0 + h
+    B = xp
+    C = -Ky * y
+    D = yp
+
+    x_ = x * Cx + xp * Sx
+    y_ = y * Cy + yp * Sy
+    px_ = (A * Sx + B * Cx) * one_plus_delta
+    py_ = (C * Sy + D * Cy) * one_plus_delta
+
+    x_ = x_ + np.where(Kx_nonzero, (k0 - h) * (Cx - 1.0) / Kx_safe,
+                                   -(k0 - h) * 0.5 * length**2)
+
+    length_ = length + np.where(Kx_nonzero,
+        - (h * ((Cx - 1.0) * xp + Sx * A + length * (k0 - h))) / Kx_safe
+        + 0.5 * (
+            - (A**2 * Cx * Sx) / (2.0 * Kx_safe)
+            + (B**2 * Cx * Sx) / 2.0
+            + (A**2 * length) / (2.0 * Kx_safe)
+            + (B**2 * length) / 2.0
+            - (A * B * Cx**2) / Kx_safe
+            + (A * B) / Kx_safe),
+        h * length * (3.0 * length * xp + 6.0 * x - (k0 - h) * length**2) / 6.0
+        + 0.5 * B**2 * length)
+
+    length_ = length_ + np.where(Ky_nonzero,
+        0.5 * (
+            - (C**2 * Cy * Sy) / (2.0 * Ky_safe)
+            + (D**2 * Cy * Sy) / 2.0
+            + (C**2 * length) / (2.0 * Ky_safe)
+            + (D**2 * length) / 2.0
+            - (C * D * Cy**2) / Ky_safe
+            + (C * D) / Ky_safe),
+        0.5 * D**2 * length)
+
+    cc['x'] = x_
+    cc['px'] = px_
+    cc['y'] = y_
+    cc['py'] = py_
+    cc['zeta'] = cc['zeta'] + length - length_ / rvv
+
+
+def _thick_map(cc, length, k0, k1, h, sin_rot, cos_rot, r21_entry,
+               r43_entry, r21_exit, r43_exit, exact_drift):
+
+    # Straight elements with vanishing strengths are tracked as drifts
+    is_drift = (k0 == 0) & (k1 == 0)
+
+    _dipole_edge_linear(cc, r21_entry, r43_entry)
+    _srotation(cc, sin_rot, cos_rot)
+    cc_drift = dict(cc)
+    _thick_cfd(cc, length, k0, k1, h)
+    _drift_map(cc_drift, length, exact_drift)
+    for kk in MAP_COORDINATES:
+        cc[kk] = np.where(is_drift, cc_drift[kk], cc[kk])
+    _srotation(cc, -sin_rot, cos_rot)
+    _dipole_edge_linear(cc, r21_exit, r43_exit)
+
+
+def _dipole_edge_linear(cc, r21, r43):
+    cc['px'] = cc['px'] + cc['chi'] * r21 * cc['x']
+    cc['py'] = cc['py'] + cc['chi'] * r43 * cc['y']
+
+
+def _dipole_edge_map(cc, r21, r43):
+    _dipole_edge_linear(cc, r21, r43)
+
+
+def _first_order_taylor_map(cc, m1):
+    beta0 = cc['beta0']
+    vin = [cc['x'], cc['px'], cc['y'], cc['py'], cc['zeta'] / beta0,
+           cc['pzeta'] * beta0]
+    vout = [sum(m1[..., ii, jj] * vin[jj] for jj in range(6))
+            for ii in range(6)]
+    cc['x'], cc['px'], cc['y'], cc['py'] = vout[:4]
+    cc['zeta'] = vout[4] * beta0
+    cc['pzeta'] = vout[5] / beta0
+
+
+# Parameter extraction. Returns None if the configuration of the element is
+# not covered by the numpy implementation of the map.
+
+def _has_transformations(ee):
+    # Shifts and tilts (shift_x, shift_y, shift_s, rot_s_rad) are not
+    # implemented in the numpy maps. Same condition as in the tracking kernels.
+    return getattr(ee, '_sin_rot_s', -999.) > -2.
+
+
+def _exact_drifts(config):
+    return bool(config.get('XTRACK_USE_EXACT_DRIFTS', False))
+
+
+def _delta_taper_factor(ee, config):
+    if config.get('XTRACK_MULTIPOLE_NO_SYNRAD', False):
+        return 1.
+    return 1. + ee.delta_taper
+
+
+def _params_identity(ee, config):
+    return {}
+
+
+def _params_drift(ee, config):
+    return {'length': ee.length, 'exact': _exact_drifts(config)}
+
+
+def _params_srotation(ee, config):
+    return {'sin_z': ee.sin_z, 'cos_z': ee.cos_z}
+
+
+def _params_multipole(ee, config):
+    if not config.get('XTRACK_MULTIPOLE_NO_SYNRAD', False):
+        if ee.radiation_flag != 0 or config.get('XTRACK_MULTIPOLE_TAPER', False):
+            return None
+    order = ee.order
+    knl = np.zeros(_MAX_ORDER + 1)
+    ksl = np.zeros(_MAX_ORDER + 1)
+    if order > _MAX_ORDER:
+        return None
+    knl[:order + 1] = ee.knl[:order + 1]
+    ksl[:order + 1] = ee.ksl[:order + 1]
+    return {'knl': knl, 'ksl': ksl, 'hxl': ee.hxl, 'length': ee.length,
+            'factor': _delta_taper_factor(ee, config)}
+
+
+def _params_dipole_edge(ee, config):
+    if ee.model != 'linear':
+        if ee.model == 'suppressed':
+            return {'r21': 0., 'r43': 0.}
+        return None
+    if config.get('XTRACK_DIPOLEEDGE_TAPER', False):
+        return None
+    factor = _delta_taper_factor(ee, config)
+    return {'r21': ee._r21 * factor, 'r43': ee._r43 * factor}
+
+
+def _thick_params(length, k0, k1, h, sin_rot=0., cos_rot=1.,
+                  edges=((0., 0.), (0., 0.)), exact_drift=False):
+    return {'length': length, 'k0': k0, 'k1': k1, 'h': h,
+            'sin_rot': sin_rot, 'cos_rot': cos_rot,
+            'r21_entry': edges[0][0], 'r43_entry': edges[0][1],
+            'r21_exit': edges[1][0], 'r43_exit': edges[1][1],
+            'exact_drift': exact_drift}
+
+
+def _params_quadrupole(ee, config):
+    if ee.edge_entry_active or ee.edge_exit_active:
+        return None
+    if np.any(ee.knl != 0) or np.any(ee.ksl != 0):
+        return None
+    if ee.k1s != 0:
+        angle_rot = -np.arctan2(ee.k1s, ee.k1) / 2.
+        return _thick_params(ee.length, 0., np.sqrt(ee.k1**2 + ee.k1s**2), 0.,
+                             sin_rot=np.sin(angle_rot),
+                             cos_rot=np.cos(angle_rot),
+                             exact_drift=_exact_drifts(config))
+    return _thick_params(ee.length, 0., ee.k1, 0.,
+                         exact_drift=_exact_drifts(config))
+
+
+def _bend_edge_coefficients(k0, active, model, angle, angle_fdown, hgap, fint):
+    if not active or model == -1:
+        return (0., 0.)
+    if model != 0:
+        return None
+    corr = 2.0 * k0 * hgap * fint
+    r21 = k0 * np.tan(angle)
+    e1_v = angle + angle_fdown
+    temp = corr / np.cos(e1_v) * (1.0 + np.sin(e1_v)**2)
+    r43 = -k0 * np.tan(e1_v - temp)
+    return (r21, r43)
+
+
+def _params_bend(ee, config):
+    if ee._model != 4:
+        return None
+    if np.any(ee.knl != 0) or np.any(ee.ksl != 0):
+        return None
+    edges = (
+        _bend_edge_coefficients(ee.k0, ee.edge_entry_active,
+            ee._edge_entry_model, ee.edge_entry_angle,
+            ee.edge_entry_angle_fdown, ee.edge_entry_hgap, ee.edge_entry_fint),
+        _bend_edge_coefficients(ee.k0, ee.edge_exit_active,
+            ee._edge_exit_model, ee.edge_exit_angle,
+            ee.edge_exit_angle_fdown, ee.edge_exit_hgap, ee.edge_exit_fint))
+    if edges[0] is None or edges[1] is None:
+        return None
+    return _thick_params(ee.length, ee.k0, ee.k1, ee.h, edges=edges,
+                         exact_drift=_exact_drifts(config))
+
+
+def _params_first_order_taylor_map(ee, config):
+    if ee.radiation_flag != 0:
+        return None
+    return {'m1': np.array(ee.m1)}
+
+
+_MAX_ORDER = 20
+
+_ELEMENT_MAPS = {
+    Marker: (_params_identity, _identity_map),
+    XYShift: (_params_identity, _identity_map),
+    Drift: (_params_drift, _drift_map),
+    SRotation: (_params_srotation, _srotation),
+    Multipole: (_params_multipole, _multipole_map),
+    DipoleEdge: (_params_dipole_edge, _dipole_edge_map),
+    Quadrupole: (_params_quadrupole, _thick_map),
+    Bend: (_params_bend, _thick_map),
+    FirstOrderTaylorMap: (_params_first_order_taylor_map,
+                          _first_order_taylor_map),
+}
@@ -10,6 +10,7 @@ from .general import _print
 
 def healy_symplectify(M):
     # https://accelconf.web.cern.ch/e06/PAPERS/WEPCH152.PDF
+    # M can be a single 6x6 matrix or a stack of matrices of shape (N, 6, 6)
     #_print("Symplectifying linear One-Turn-Map...")
 
     #_print("Before symplectifying: det(M) = {}".format(np.linalg.det(M)))
@@ -26,18 +27,26 @@ def healy_symplectify(M):
         ]
     )
 
+    M = np.asarray(M)
     V = np.matmul(S, np.matmul(I - M, np.linalg.inv(I + M)))
-    W = (V + V.T) / 2
-    if np.linalg.det(I - np.matmul(S, W)) != 0:
-        M_new = np.matmul(I + np.matmul(S, W),
-                          np.linalg.inv(I - np.matmul(S, W)))
-    else:
+    W = (V + np.swapaxes(V, -1, -2)) / 2
+    det_IminusSW = np.linalg.det(I - np.matmul(S, W))
+    mask_singular = det_IminusSW == 0
+
+    M_new = np.empty_like(M)
+    mask_regular = ~mask_singular
+    if np.any(mask_regular):
+        SW = np.matmul(S, W[mask_regular])
+        M_new[mask_regular] = np.matmul(I + SW, np.linalg.inv(I - SW))
+    if np.any(mask_singular):
         _print("WARNING: det(I - SW) = 0!")
-        V_else = np.matmul(S, np.matmul(I + M, np.linalg.inv(I - M)))
-        W_else = (V_else + V_else.T) / 2
-        M_new = -np.matmul(
-            I + np.matmul(S, W_else), np.linalg.det(I - np.matmul(S, W_else))
-        )
+        M_sing = M[mask_singular]
+        V_else = np.matmul(S, np.matmul(I + M_sing, np.linalg.inv(I - M_sing)))
+        W_else = (V_else + np.swapaxes(V_else, -1, -2)) / 2
+        M_new[mask_singular] = [
+            -np.matmul(I + np.matmul(S, ww),
+                       np.linalg.det(I - np.matmul(S, ww)))
+            for ww in W_else]
 
     #_print("After symplectifying: det(M) = {}".format(np.linalg.det(M_new)))
     return M_new
@@ -71,7 +80,9 @@ def compute_linear_normal_form(M, symplectify=False, only_4d_block=False,
     Parameters
     ----------
     M : np.ndarray
-        6x6 matrix
+        6x6 matrix or stack of matrices of shape (N, 6, 6). For a stack, all
+        the steps are performed with vectorized operations and all outputs
+        carry the additional leading dimension.
     symplectify : bool
         If True, symplectify the matrix before computing the normal form
     only_4d_block : bool
@@ -93,13 +104,17 @@ def compute_linear_normal_form(M, symplectify=False, only_4d_block=False,
         3x1 vector
     '''
 
+    M = np.asarray(M)
+    is_stack = M.ndim == 3
+    if not is_stack:
+        M = M[np.newaxis, :, :]
+
     if only_4d_block:
         M = M.copy()
-        M[4:, :] = 0
-        M[:, 4:] = 0
+        M[:, 4:, :] = 0
+        M[:, :, 4:] = 0
         muz_dummy = np.pi/10
-        M[4:, 4:] = np.array([[np.cos(muz_dummy), np.sin(muz_dummy)],
-                              [-np.sin(muz_dummy), np.cos(muz_dummy)]])
+        M[:, 4:, 4:] = Rot2D(muz_dummy)
 
     if responsiveness_tol is not None:
         _assert_matrix_responsiveness(M, responsiveness_tol)
@@ -116,85 +131,98 @@ def compute_linear_normal_form(M, symplectify=False, only_4d_block=False,
     if stability_tol is not None:
         _assert_matrix_stability(w0, stability_tol)
 
-    a0 = np.real(v0)
-    b0 = np.imag(v0)
+    W, invW, R, eigenvalues = _normal_form_from_eigenvectors(w0, v0)
 
-    index_list = [0,5,1,2,3,4] # we mix them up to check the algorithm
+    if not is_stack:
+        return W[0], invW[0], R[0], eigenvalues[0]
 
-    ##### Sort modes in pairs of conjugate modes #####
-    conj_modes = np.zeros([3,2], dtype=np.int64)
+    return W, invW, R, eigenvalues
+
+def _sort_conjugate_modes(w0):
+
+    '''
+    Pair the eigenvalues in w0 (shape (N, 6)) into complex conjugate pairs.
+    Returns an array of shape (N, 3, 2) with the indices of the pairs.
+    '''
+
+    n_mat = w0.shape[0]
+    i_mat = np.arange(n_mat)
+
+    index_list = np.array([0,5,1,2,3,4]) # we mix them up to check the algorithm
+    w_list = w0[:, index_list]
+    available = np.ones((n_mat, 6), dtype=bool)
+
+    conj_modes = np.zeros([n_mat, 3, 2], dtype=np.int64)
     for j in [0,1]:
-        conj_modes[j,0] = index_list[0]
-        del index_list[0]
+        # First available mode (in the order of index_list)
+        i_first = np.argmax(available, axis=1)
+        available[i_mat, i_first] = False
 
-        min_index = 0
-        min_diff = abs(np.imag(w0[conj_modes[j,0]] + w0[index_list[min_index]]))
-        for i in range(1,len(index_list)):
-            diff = abs(np.imag(w0[conj_modes[j,0]] + w0[index_list[i]]))
-            if min_diff > diff:
-                min_diff = diff
-                min_index = i
+        # Closest to the complex conjugate among the available ones
+        diff = np.abs(np.imag(w_list[i_mat, i_first][:, np.newaxis] + w_list))
+        diff[~available] = np.inf
+        i_conj = np.argmin(diff, axis=1)
+        available[i_mat, i_conj] = False
 
-        conj_modes[j,1] = index_list[min_index]
-        del index_list[min_index]
+        conj_modes[:, j, 0] = index_list[i_first]
+        conj_modes[:, j, 1] = index_list[i_conj]
 
-    conj_modes[2,0] = index_list[0]
-    conj_modes[2,1] = index_list[1]
+    conj_modes[:, 2, :] = index_list[np.nonzero(available)[1].reshape(n_mat, 2)]
+
+    return conj_modes
+
+def _normal_form_from_eigenvectors(w0, v0):
+
+    n_mat = w0.shape[0]
+    i_mat = np.arange(n_mat)
+    i_mode = np.arange(3)
+
+    a0 = np.real(v0)
+    b0 = np.imag(v0)
+
+    ##### Sort modes in pairs of conjugate modes #####
+    conj_modes = _sort_conjugate_modes(w0)
 
     ##################################################
     #### Select mode from pairs with positive (real @ S @ imag) #####
 
-    modes = np.empty(3, dtype=np.int64)
-    for ii,ind in enumerate(conj_modes):
-        if np.matmul(np.matmul(a0[:,ind[0]], S), b0[:,ind[0]]) > 0:
-            modes[ii] = ind[0]
-        else:
-            modes[ii] = ind[1]
+    ind0 = conj_modes[:, :, 0]
+    a_ind0 = np.take_along_axis(a0, ind0[:, np.newaxis, :], axis=2)
+    b_ind0 = np.take_along_axis(b0, ind0[:, np.newaxis, :], axis=2)
+    aSb = np.einsum('nim,ij,njm->nm', a_ind0, S, b_ind0)
+    modes = np.where(aSb > 0, ind0, conj_modes[:, :, 1])
 
     ##################################################
     #### Sort modes such that (1,2,3) is close to (x,y,zeta) ####
     # Identify the longitudinal mode
     for i in [0,1]:
-        if abs(v0[:,modes[2]])[5] < abs(v0[:,modes[i]])[5]:
-            modes[2], modes[i] = modes[i], modes[2]
+        swap = (np.abs(v0[i_mat, 5, modes[:, 2]])
+                < np.abs(v0[i_mat, 5, modes[:, i]]))
+        modes[swap, 2], modes[swap, i] = modes[swap, i], modes[swap, 2]
 
     # Identify the vertical mode
-    if abs(v0[:,modes[1]])[2] < abs(v0[:,modes[0]])[2]:
-        modes[0], modes[1] = modes[1], modes[0]
+    swap = np.abs(v0[i_mat, 2, modes[:, 1]]) < np.abs(v0[i_mat, 2, modes[:, 0]])
+    modes[swap, 0], modes[swap, 1] = modes[swap, 1], modes[swap, 0]
 
     ##################################################
     #### Rotate eigenvectors to the Courant-Snyder parameterization ####
-    phase0 = np.log(v0[0,modes[0]]).imag
-    phase1 = np.log(v0[2,modes[1]]).imag
-    phase2 = np.log(v0[4,modes[2]]).imag
-
-    v0[:,modes[0]] *= np.exp(-1.j*phase0)
-    v0[:,modes[1]] *= np.exp(-1.j*phase1)
-    v0[:,modes[2]] *= np.exp(-1.j*phase2)
+    v_modes = np.take_along_axis(v0, modes[:, np.newaxis, :], axis=2)
+    phase = np.log(v_modes[:, 2*i_mode, i_mode]).imag
+    v_modes *= np.exp(-1.j*phase)[:, np.newaxis, :]
 
     ##################################################
     #### Construct W #################################
 
-    a1 = v0[:,modes[0]].real
-    a2 = v0[:,modes[1]].real
-    a3 = v0[:,modes[2]].real
-    b1 = v0[:,modes[0]].imag
-    b2 = v0[:,modes[1]].imag
-    b3 = v0[:,modes[2]].imag
-
-    n1 = 1./np.sqrt(np.matmul(np.matmul(a1, S), b1))
-    n2 = 1./np.sqrt(np.matmul(np.matmul(a2, S), b2))
-    n3 = 1./np.sqrt(np.matmul(np.matmul(a3, S), b3))
+    a_modes = v_modes.real
+    b_modes = v_modes.imag
 
-    a1 *= n1
-    a2 *= n2
-    a3 *= n3
+    nn = 1./np.sqrt(np.einsum('nim,ij,njm->nm', a_modes, S, b_modes))
+    a_modes *= nn[:, np.newaxis, :]
+    b_modes *= nn[:, np.newaxis, :]
 
-    b1 *= n1
-    b2 *= n2
-    b3 *= n3
-
-    W = np.array([a1,b1,a2,b2,a3,b3]).T
+    W = np.zeros((n_mat, 6, 6))
+    W[:, :, 0::2] = a_modes
+    W[:, :, 1::2] = b_modes
     W[abs(W) < 1.e-14] = 0. # Set very small numbers to zero.
     #invW = np.matmul(np.matmul(S.T, W.T), S)
     invW = np.linalg.inv(W)
@@ -202,38 +230,32 @@ def compute_linear_normal_form(M, symplectify=False, only_4d_block=False,
     ##################################################
     #### Get tunes and rotation matrix in the normalized coordinates ####
 
-    mu1 = np.log(w0[modes[0]]).imag
-    mu2 = np.log(w0[modes[1]]).imag
-    mu3 = np.log(w0[modes[2]]).imag
-
-    #q1 = mu1/(2.*np.pi)
-    #q2 = mu2/(2.*np.pi)
-    #q3 = mu3/(2.*np.pi)
+    eigenvalues = np.take_along_axis(w0, modes, axis=1)
+    mu = np.log(eigenvalues).imag
 
     R = np.zeros_like(W)
-    R[0:2,0:2] = Rot2D(mu1)
-    R[2:4,2:4] = Rot2D(mu2)
-    R[4:6,4:6] = Rot2D(mu3)
+    R[:, 2*i_mode, 2*i_mode] = np.cos(mu)
+    R[:, 2*i_mode, 2*i_mode+1] = np.sin(mu)
+    R[:, 2*i_mode+1, 2*i_mode] = -np.sin(mu)
+    R[:, 2*i_mode+1, 2*i_mode+1] = np.cos(mu)
     ##################################################
 
-    eigenvalues = w0[modes]
-
     return W, invW, R, eigenvalues
 
 def _assert_matrix_responsiveness(M,
                 responsiveness_tol, only_4d=False):
     n_check = 4 if only_4d else 6
     for ii in range(n_check):
-        mask_non_zero = np.abs(M[:, ii]) > responsiveness_tol
-        mask_non_zero[ii] = False
-        if np.sum(mask_non_zero)<1:
+        mask_non_zero = np.abs(M[..., :, ii]) > responsiveness_tol
+        mask_non_zero[..., ii] = False
+        if np.any(np.sum(mask_non_zero, axis=-1)<1):
             raise ValueError(
                 'Invalid one-turn map: No coordinates respond to variations of '
                 + 'x px y py zeta delta'.split()[ii])
 
 
 def _assert_matrix_determinant_within_tol(M, tol=1e-15):
-    if np.abs(np.linalg.det(M)-1) > tol:
+    if np.any(np.abs(np.linalg.det(M)-1) > tol):
         raise ValueError(
             f'The determinant of M is out tolerance. det={np.linalg.det(M)}')
 
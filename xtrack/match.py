@@ -1,4 +1,8 @@
+import multiprocessing
+import numbers
+import os
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 import numpy as np
@@ -6,8 +10,10 @@ from scipy.optimize import fsolve, minimize
 
 from .twiss import TwissInit, VARS_FOR_TWISS_INIT_GENERATION, _complete_twiss_init
 from .general import _print, START, END, _LOC
+from .kernel_cache import use_private_build_directory
 import xtrack as xt
 import xdeps as xd
+import xobjects as xo
 
 XTRACK_DEFAULT_TOL = 1e-9
 XTRACK_DEFAULT_SIGMA_REL = 0.01
@@ -58,6 +64,7 @@ class ActionTwiss(xd.Action):
         self.kwargs = kwargs
         self.allow_twiss_failure = allow_twiss_failure
         self.compensate_radiation_energy_loss = compensate_radiation_energy_loss
+        self.num_twiss_calls = 0
 
     def prepare(self):
         line = self.line
@@ -191,6 +198,7 @@ class ActionTwiss(xd.Action):
             kwargs['_keep_initial_particles'] = _keep_ini_particles_list[0]
 
         tw0 = line.twiss(**kwargs)
+        self.num_twiss_calls += 1
 
         if ismultiline:
             kwargs['_initial_particles'] = [
@@ -208,11 +216,17 @@ class ActionTwiss(xd.Action):
                     'Radiation energy loss compensation is not yet supported'
                     ' for Multiline')
             self.line.compensate_radiation_energy_loss(verbose=False)
+        # Targets are evaluated right after the twiss, hence expensive groups
+        # of columns (e.g. chromatic functions) are computed only if needed
+        kwargs = self.kwargs
+        if kwargs.get('lazy_columns', None) is None:
+            kwargs = {**kwargs, 'lazy_columns': True}
+        self.num_twiss_calls += 1
         if not self.allow_twiss_failure or not allow_failure:
-            out = self.line.twiss(**self.kwargs)
+            out = self.line.twiss(**kwargs)
         else:
             try:
-                out = self.line.twiss(**self.kwargs)
+                out = self.line.twiss(**kwargs)
             except Exception as ee:
                 if allow_failure:
                     return 'failed'
@@ -796,7 +810,13 @@ def match_line(line, vary, targets, solve=True, assert_within_tol=True,
                   solver_options={}, allow_twiss_failure=True,
                   restore_if_fail=True, verbose=False,
                   n_steps_max=20, default_tol=None,
-                  solver=None, check_limits=True, **kwargs):
+                  solver=None, check_limits=True, num_jacobian_workers=None,
+                  jacobian_method=None, compile_knobs=False, **kwargs):
+
+    if jacobian_method is None:
+        jacobian_method = 'finite_differences'
+    if jacobian_method not in ('finite_differences', 'broyden', 'analytical'):
+        raise ValueError(f'Invalid jacobian_method `{jacobian_method}`')
 
     if not isinstance(targets, (list, tuple)):
         targets = [targets]
@@ -872,6 +892,8 @@ def match_line(line, vary, targets, solve=True, assert_within_tol=True,
 
     vary_flatten = _flatten_vary(vary)
     _complete_vary_with_info_from_line(vary_flatten, line)
+    if compile_knobs:
+        _compile_vary_knobs(vary_flatten, line)
 
     opt = xd.Optimize(vary=vary_flatten, targets=targets_flatten, solver=solver,
                         verbose=verbose, assert_within_tol=assert_within_tol,
@@ -880,11 +902,685 @@ def match_line(line, vary, targets, solve=True, assert_within_tol=True,
                         restore_if_fail=restore_if_fail,
                         check_limits=check_limits)
 
+    # The solver gets the Jacobian from the merit function
+    if num_jacobian_workers is not None:
+        _check_contexts_for_parallel_jacobian(line)
+        opt._err.get_jacobian = ParallelJacobian(opt._err,
+                                                 num_workers=num_jacobian_workers)
+    if jacobian_method == 'broyden':
+        opt._err.get_jacobian = BroydenJacobian(opt._err,
+                                        full_jacobian=opt._err.get_jacobian)
+    elif jacobian_method == 'analytical':
+        opt._err.get_jacobian = OpticsResponseJacobian(opt._err,
+                                        full_jacobian=opt._err.get_jacobian)
+
     if solve:
-        opt.solve()
+        try:
+            opt.solve()
+        finally:
+            if hasattr(opt._err.get_jacobian, 'close'):
+                opt._err.get_jacobian.close()
 
     return opt
 
+def match_stats(opt):
+
+    '''
+    Number of model evaluations made by an optimizer returned by `Line.match`
+    or `Multiline.match`.
+
+    Parameters
+    ----------
+    opt : xdeps.Optimize
+        Optimizer.
+
+    Returns
+    -------
+    stats : dict
+        Dictionary with the number of twiss calls (`num_twiss_calls`) and of
+        merit function evaluations (`num_merit_function_calls`). When Broyden
+        updates are used, also the number of full Jacobian evaluations
+        (`num_full_jacobians`) and of rank-one updates (`num_broyden_updates`).
+        When the analytical optics response is used, also the number of
+        Jacobian columns computed analytically (`num_analytical_columns`) and
+        with finite differences (`num_finite_difference_columns`).
+    '''
+
+    merit_function = opt._err
+    out = {
+        'num_twiss_calls': sum(aa.num_twiss_calls
+                               for aa in merit_function.actions
+                               if isinstance(aa, ActionTwiss)),
+        'num_merit_function_calls': merit_function.call_counter,
+    }
+    jacobian = merit_function.get_jacobian
+    if isinstance(jacobian, BroydenJacobian):
+        out['num_full_jacobians'] = jacobian.num_full_jacobians
+        out['num_broyden_updates'] = jacobian.num_broyden_updates
+    elif isinstance(jacobian, OpticsResponseJacobian):
+        out['num_analytical_columns'] = jacobian.num_analytical_columns
+        out['num_finite_difference_columns'] = (
+                                    jacobian.num_finite_difference_columns)
+
+    return out
+
+# Merit function and variable containers of a Jacobian worker process
+# (inherited from the parent process when the worker is forked)
+_jacobian_worker_state = None
+
+
+def _init_jacobian_worker(merit_function, var_containers):
+    global _jacobian_worker_state
+    use_private_build_directory()
+    merit_function.show_call_counter = False
+    _jacobian_worker_state = (merit_function, var_containers)
+
+
+def _eval_jacobian_column(x, ii, step, knob_deltas, vary_active,
+                          target_active, target_values):
+    merit_function, var_containers = _jacobian_worker_state
+
+    for i_container, name, value in knob_deltas:
+        var_containers[i_container][name] = value
+    for vv, active in zip(merit_function.vary, vary_active):
+        vv.active = active
+    for tt, active in zip(merit_function.targets, target_active):
+        tt.active = active
+    for i_target, value in target_values:
+        merit_function.targets[i_target].value = value
+
+    x = x.copy()
+    x[ii] += step
+    return merit_function(x, check_limits=False)
+
+
+def _var_values(container):
+    if not isinstance(container, xt.line.LineVars):
+        return None
+    return {nn: vv for nn, vv in container.line._xdeps_vref._owner.items()
+            if isinstance(vv, numbers.Number)}
+
+
+class ParallelJacobian:
+
+    '''
+    Finite-difference Jacobian of a matching merit function, with the columns
+    evaluated concurrently by a pool of worker processes.
+
+    The workers are forked from the current process when the Jacobian is
+    first requested, hence each of them holds its own copy of the lines, of
+    the twiss settings and of the targets, which is kept alive across the
+    iterations of the optimization. For each column the workers receive only
+    the knob values to be tested, the variables changed in the parent process
+    since the workers were started and the status of vary and targets. Other
+    modifications of the lines are seen by the workers only after they are
+    restarted (see `close`).
+
+    The workers need the `fork` start method, since the merit function (lines
+    with their trackers, targets defined by functions) cannot in general be
+    sent to spawned processes. It is not available on all platforms, and
+    is not used for lines on OpenMP contexts, whose threads cannot be safely
+    forked; in these cases an error is raised at construction.
+    '''
+
+    def __init__(self, merit_function, num_workers=None):
+        """
+        Parameters
+        ----------
+        merit_function: xdeps.optimize.MeritFunctionForMatch
+            Merit function of the optimizer.
+        num_workers: int, optional
+            Number of worker processes. Defaults to the number of CPUs.
+        """
+
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        assert num_workers >= 1
+
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise RuntimeError(
+                'The parallel Jacobian needs the `fork` start method, which '
+                'is not available on this platform')
+        for aa in merit_function.actions:
+            line = getattr(aa, 'line', None)
+            if (line is not None
+                    and getattr(line._context, 'openmp_enabled', False)):
+                raise RuntimeError(
+                    'The parallel Jacobian is not supported for lines on '
+                    'OpenMP contexts')
+
+        self.merit_function = merit_function
+        self.num_workers = num_workers
+
+        self._var_containers = []
+        for vv in merit_function.vary:
+            if not any(vv.container is cc for cc in self._var_containers):
+                self._var_containers.append(vv.container)
+
+        self._pool = None
+        self._var_snapshots = None
+        self._synced_vars = None
+
+    def _start(self):
+        # The workers are forked at the first submission, i.e. with the
+        # variables in the state recorded here
+        self._var_snapshots = [_var_values(cc) for cc in self._var_containers]
+        self._synced_vars = set()
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context('fork'),
+            initializer=_init_jacobian_worker,
+            initargs=(self.merit_function, self._var_containers))
+
+    def close(self):
+        """
+        Shut down the worker processes. They are started again at the next
+        Jacobian evaluation.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _knob_deltas(self):
+        knob_deltas = []
+        for ii, (cc, snapshot) in enumerate(
+                zip(self._var_containers, self._var_snapshots)):
+            if snapshot is None:
+                continue
+            for nn, vv in _var_values(cc).items():
+                if (ii, nn) in self._synced_vars:
+                    knob_deltas.append((ii, nn, vv))
+                elif (snapshot.get(nn, None) != vv
+                        and cc.line._xdeps_vref[nn]._expr is None):
+                    self._synced_vars.add((ii, nn))
+                    knob_deltas.append((ii, nn, vv))
+        return knob_deltas
+
+    def __call__(self, x, f0=None, columns=None):
+
+        mf = self.merit_function
+
+        x = np.array(x, dtype=np.float64)
+        steps = mf._knobs_to_x(mf.steps_for_jacobian)
+        assert len(x) == len(steps)
+        if f0 is None:
+            f0 = mf(x)
+        f0 = np.atleast_1d(f0)
+
+        if self._pool is None:
+            self._start()
+
+        knob_deltas = self._knob_deltas()
+        vary_active = [vv.active for vv in mf.vary]
+        target_active = [tt.active for tt in mf.targets]
+        target_values = [(ii, tt.value) for ii, tt in enumerate(mf.targets)
+                         if isinstance(tt.value, numbers.Number)]
+
+        if columns is None:
+            i_columns = np.where(mf.mask_input)[0]
+        else:
+            i_columns = np.array(columns, dtype=int)
+        futures = [self._pool.submit(_eval_jacobian_column, x, ii, steps[ii],
+                                     knob_deltas, vary_active, target_active,
+                                     target_values)
+                   for ii in i_columns]
+
+        jac = np.zeros((len(f0), len(x)))
+        for ii, ff in zip(i_columns, futures):
+            jac[:, ii] = (ff.result() - f0) / steps[ii]
+        mf.call_counter += len(i_columns)
+        for aa in mf.actions:
+            if isinstance(aa, ActionTwiss):
+                aa.num_twiss_calls += len(i_columns)
+
+        mf._last_jac = jac
+        return jac
+
+
+class BroydenJacobian:
+
+    '''
+    Jacobian of a matching merit function updated with Broyden's rank-one
+    formula from the steps taken by the solver, instead of being recomputed
+    at each iteration.
+
+    The full Jacobian is computed at the first call, when the active vary or
+    targets change and when the merit function stalls, i.e. when the last
+    step did not reduce the penalty at least by the factor `stall_ratio`.
+    '''
+
+    def __init__(self, merit_function, full_jacobian=None, stall_ratio=0.5):
+        """
+        Parameters
+        ----------
+        merit_function: xdeps.optimize.MeritFunctionForMatch
+            Merit function of the optimizer.
+        full_jacobian: callable, optional
+            Function computing the full Jacobian, with the same signature as
+            `merit_function.get_jacobian` (used if not provided).
+        stall_ratio: float, optional
+            Maximum ratio between the penalty after and before a step for which
+            the rank-one update is used. Defaults to 0.5.
+        """
+
+        if full_jacobian is None:
+            full_jacobian = merit_function.get_jacobian
+
+        self.merit_function = merit_function
+        self.full_jacobian = full_jacobian
+        self.stall_ratio = stall_ratio
+
+        self.num_full_jacobians = 0
+        self.num_broyden_updates = 0
+
+        self._jac = None
+        self._x = None
+        self._f = None
+        self._masks = None
+
+    def close(self):
+        if hasattr(self.full_jacobian, 'close'):
+            self.full_jacobian.close()
+
+    def __call__(self, x, f0=None):
+
+        mf = self.merit_function
+
+        x = np.array(x, dtype=np.float64)
+        if f0 is None:
+            f0 = mf(x)
+        f0 = np.atleast_1d(np.array(f0, dtype=np.float64))
+        masks = (tuple(mf.mask_input), tuple(mf.mask_output))
+
+        update = (self._jac is not None and masks == self._masks
+                  and self._jac.shape == (len(f0), len(x)))
+        if update:
+            dx = x - self._x
+            dx_sq = np.dot(dx, dx)
+            penalty = np.sqrt(np.dot(f0, f0))
+            penalty_before = np.sqrt(np.dot(self._f, self._f))
+            update = dx_sq > 0 and penalty < self.stall_ratio * penalty_before
+
+        if update:
+            jac = self._jac + np.outer(f0 - self._f - self._jac @ dx, dx) / dx_sq
+            jac[:, ~mf.mask_input] = 0
+            self.num_broyden_updates += 1
+        else:
+            jac = np.array(self.full_jacobian(x, f0=f0), dtype=np.float64)
+            self.num_full_jacobians += 1
+
+        self._jac = jac.copy()
+        self._x = x.copy()
+        self._f = f0.copy()
+        self._masks = masks
+
+        mf._last_jac = jac
+        return jac
+
+
+# Twiss quantities for which the response to quadrupole strengths is
+# computed analytically by OpticsResponseJacobian
+OPTICS_RESPONSE_TARGETS = ['betx', 'bety', 'alfx', 'alfy', 'mux', 'muy',
+                           'dx', 'dpx', 'dy', 'dpy', 'qx', 'qy']
+
+
+def _integrated_normal_quadrupole(element):
+    out = 0.
+    if isinstance(element, (xt.Quadrupole, xt.Bend)):
+        out += element.k1 * element.length
+    if hasattr(element, 'knl') and len(element.knl) > 1:
+        out += element.knl[1]
+    return out
+
+
+def _quadrupoles_driven_by_var(line, name):
+    '''
+    Names of the elements whose normal quadrupole strength depends on the
+    variable `name`. Returns None if the variable drives other quantities.
+    '''
+    vref = line._xdeps_vref
+    eref = line.element_refs
+    element_names = set(line.element_names)
+    out = set()
+    for rr in line.vars[name]._find_dependant_targets():
+        owner = getattr(rr, '_owner', None)
+        if owner is vref or owner is eref:
+            # Variable or element container
+            continue
+        if isinstance(owner, xd.refs.ItemRef) and owner._owner is eref:
+            # Element attribute
+            if rr._key == 'knl':
+                continue
+            if (rr._key == 'k1' and isinstance(line[owner._key],
+                                                (xt.Quadrupole, xt.Bend))):
+                out.add(owner._key)
+                continue
+            return None
+        if (isinstance(owner, xd.refs.AttrRef) and owner._key == 'knl'
+                and owner._owner._owner is eref and rr._key == 1):
+            out.add(owner._owner._key)
+            continue
+        return None
+    if not out.issubset(element_names):
+        return None
+    return sorted(out)
+
+
+def _linear_optics_response(tw, quantity, i_rows, j_rows, periodic):
+    '''
+    Derivatives of the twiss quantity `quantity` at the rows `i_rows` of the
+    table with respect to the integrated normal quadrupole strength of the
+    elements at the rows `j_rows` (thin-lens approximation, with the optics
+    of each element taken at the center of the element). Returns an array
+    with shape (len(i_rows), len(j_rows)).
+    '''
+
+    prefix, plane = quantity[:-1], quantity[-1]
+    ss = 1. if plane == 'x' else -1. # focusing in x is defocusing in y
+
+    bet = tw['bet' + plane]
+    alf = tw['alf' + plane]
+    mu = 2 * np.pi * (tw['mu' + plane] - tw['mu' + plane][0])
+    disp = tw['d' + plane]
+
+    bet_i = bet[i_rows][:, np.newaxis]
+    alf_i = alf[i_rows][:, np.newaxis]
+    mu_i = mu[i_rows][:, np.newaxis]
+    bet_j = (0.5 * (bet[j_rows] + bet[j_rows + 1]))[np.newaxis, :]
+    mu_j = (0.5 * (mu[j_rows] + mu[j_rows + 1]))[np.newaxis, :]
+    disp_j = (0.5 * (disp[j_rows] + disp[j_rows + 1]))[np.newaxis, :]
+    downstream = i_rows[:, np.newaxis] > j_rows[np.newaxis, :]
+
+    dmu = mu_i - mu_j
+
+    if not periodic:
+        # Only the elements upstream of the observation point contribute
+        if prefix == 'bet':
+            out = -ss * bet_i * bet_j * np.sin(2 * dmu)
+        elif prefix == 'alf':
+            out = ss * bet_j * (np.cos(2 * dmu) - alf_i * np.sin(2 * dmu))
+        elif prefix == 'mu':
+            out = ss * bet_j * np.sin(dmu)**2 / (2 * np.pi)
+        elif prefix == 'd':
+            out = -ss * disp_j * np.sqrt(bet_i * bet_j) * np.sin(dmu)
+        elif prefix == 'dp':
+            out = -ss * disp_j * np.sqrt(bet_j / bet_i) * (
+                np.cos(dmu) - alf_i * np.sin(dmu))
+        else:
+            raise ValueError(f'Invalid quantity `{quantity}`')
+        return np.where(downstream, out, 0.)
+
+    mu_tot = mu[-1]
+    sgn = np.where(downstream, 1., -1.)
+    adm = np.abs(dmu)
+    if prefix in ['bet', 'alf']:
+        gg = -ss * bet_j * np.cos(2 * adm - mu_tot) / (2 * np.sin(mu_tot))
+        if prefix == 'bet':
+            return bet_i * gg
+        return alf_i * gg - sgn * ss * bet_j * np.sin(2 * adm - mu_tot) / (
+                                                        2 * np.sin(mu_tot))
+    elif prefix == 'mu':
+        # Integral of the beta-beating along the ring from the first row
+        integral = np.where(downstream,
+            0.5 * (np.sin(mu_tot) + np.sin(2 * mu_j - mu_tot))
+            + 0.5 * (np.sin(2 * dmu - mu_tot) + np.sin(mu_tot)),
+            0.5 * (np.sin(2 * mu_j - mu_tot) - np.sin(2 * (mu_j - mu_i) - mu_tot)))
+        return ss * bet_j * integral / (2 * np.sin(mu_tot)) / (2 * np.pi)
+    elif prefix == 'd':
+        return -ss * disp_j * np.sqrt(bet_i * bet_j) * np.cos(
+                        adm - mu_tot / 2) / (2 * np.sin(mu_tot / 2))
+    elif prefix == 'dp':
+        return -ss * disp_j * np.sqrt(bet_j / bet_i) / (2 * np.sin(mu_tot / 2)) * (
+            -alf_i * np.cos(adm - mu_tot / 2) - sgn * np.sin(adm - mu_tot / 2))
+    else:
+        raise ValueError(f'Invalid quantity `{quantity}`')
+
+
+def _finite_difference_columns(merit_function, x, f0, columns):
+    x = np.array(x, dtype=np.float64)
+    steps = merit_function._knobs_to_x(merit_function.steps_for_jacobian)
+    jac = np.zeros((len(f0), len(x)))
+    for ii in columns:
+        x[ii] += steps[ii]
+        jac[:, ii] = (merit_function(x, check_limits=False) - f0) / steps[ii]
+        x[ii] -= steps[ii]
+    return jac
+
+
+class OpticsResponseJacobian:
+
+    '''
+    Jacobian of a matching merit function in which the derivatives of the
+    linear optics targets (beta and alpha functions, phase advances, tunes
+    and dispersion, see `OPTICS_RESPONSE_TARGETS`) with respect to the
+    variables driving quadrupole strengths are computed analytically from
+    the twiss table of the last merit function evaluation, using the
+    first-order response formulas of the linear optics. The elements
+    driven by each variable are found from the dependency graph of the line.
+
+    Columns associated to other variables are computed with finite
+    differences. If some of the active targets are not covered (e.g.
+    callables, inequalities, chromatic quantities or twiss with
+    `reverse=True`) the full Jacobian is computed with finite differences.
+    '''
+
+    def __init__(self, merit_function, full_jacobian=None):
+        """
+        Parameters
+        ----------
+        merit_function: xdeps.optimize.MeritFunctionForMatch
+            Merit function of the optimizer.
+        full_jacobian: callable, optional
+            Function computing the finite-difference Jacobian, with the same
+            signature as `merit_function.get_jacobian` (used if not provided).
+        """
+
+        if full_jacobian is None:
+            full_jacobian = merit_function.get_jacobian
+
+        self.merit_function = merit_function
+        self.full_jacobian = full_jacobian
+
+        self.num_analytical_columns = 0
+        self.num_finite_difference_columns = 0
+
+        self._quadrupoles_driven_by_vary = {}
+
+    def close(self):
+        if hasattr(self.full_jacobian, 'close'):
+            self.full_jacobian.close()
+
+    def _quadrupoles(self, vv):
+        if not isinstance(vv.container, (xt.line.LineVars, xt.CompiledKnobs)):
+            return None
+        if vv.name not in self._quadrupoles_driven_by_vary:
+            self._quadrupoles_driven_by_vary[vv.name] = (
+                _quadrupoles_driven_by_var(vv.container.line, vv.name))
+        return self._quadrupoles_driven_by_vary[vv.name]
+
+    def _twiss_for_response(self, action, data):
+        # Returns the twiss table computed by the action and whether it is
+        # periodic, or None if the analytical response cannot be used
+        if not isinstance(action, ActionTwiss):
+            return None
+        if not isinstance(action.line, xt.Line):
+            return None
+        tw = data[action]
+        if not isinstance(tw, xt.TwissTable):
+            return None
+        if tw._data.get('reference_frame', 'proper') != 'proper':
+            return None
+        init = action.kwargs.get('init', None)
+        if isinstance(init, TwissInit):
+            if init.element_name != tw.name[0]:
+                return None
+            return tw, False
+        if (action.kwargs.get('start', None) is not None
+                or action.kwargs.get('end', None) is not None):
+            return None
+        return tw, True
+
+    def _target_rows(self, tt, tw, periodic):
+        # Returns the list of (quantity, row, sign) giving the target from
+        # the twiss table, or None if the target is not covered
+        if tt.line is not None:
+            return None
+        if hasattr(tt.value, 'auxtarget') or tt.optimize_log:
+            return None
+
+        def _row(at):
+            if at == '__ele_start__':
+                return 0
+            if at == '__ele_stop__':
+                return len(tw) - 1
+            rows = np.where(tw.name == at)[0]
+            if len(rows) != 1:
+                return None
+            return rows[0]
+
+        if type(tt) is TargetRelPhaseAdvance:
+            i_end = _row(tt.end)
+            i_start = _row(tt.start)
+            if i_end is None or i_start is None:
+                return None
+            return [(tt.var, i_end, 1.), (tt.var, i_start, -1.)]
+
+        if type(tt) is not Target:
+            return None
+        if isinstance(tt.tar, tuple):
+            quantity, at = tt.tar
+        else:
+            quantity, at = tt.tar, None
+        if not isinstance(quantity, str) or quantity not in OPTICS_RESPONSE_TARGETS:
+            return None
+        if quantity in ['qx', 'qy']:
+            if at is not None or not periodic:
+                return None
+            return [('mu' + quantity[1], len(tw) - 1, 1.)]
+        if not isinstance(at, str):
+            return None
+        i_at = _row(at)
+        if i_at is None:
+            return None
+        return [(quantity, i_at, 1.)]
+
+    def __call__(self, x, f0=None):
+
+        mf = self.merit_function
+
+        x = np.array(x, dtype=np.float64)
+        if f0 is None:
+            f0 = mf(x)
+        f0 = np.atleast_1d(np.array(f0, dtype=np.float64))
+        # Twiss tables from the merit function evaluation at x
+        data = mf._last_data
+
+        mask_input = mf.mask_input
+        mask_output = mf.mask_output
+
+        twiss_for_response = {}
+        target_rows = {}
+        for ii, tt in enumerate(mf.targets):
+            if not mask_output[ii]:
+                continue
+            if tt.action not in twiss_for_response:
+                twiss_for_response[tt.action] = self._twiss_for_response(
+                                                            tt.action, data)
+            if twiss_for_response[tt.action] is None:
+                target_rows[ii] = None
+            else:
+                target_rows[ii] = self._target_rows(
+                                tt, *twiss_for_response[tt.action])
+
+        if any(rr is None for rr in target_rows.values()):
+            self.num_finite_difference_columns += int(np.sum(mask_input))
+            return self.full_jacobian(x, f0=f0)
+
+        lines = [aa.line for aa, tp in twiss_for_response.items()
+                 if tp is not None]
+        analytical_columns = []
+        for ii, vv in enumerate(mf.vary):
+            if not mask_input[ii] or self._quadrupoles(vv) is None:
+                continue
+            if all(vv.container.line is ll for ll in lines):
+                analytical_columns.append(ii)
+        fd_columns = [ii for ii in np.where(mask_input)[0]
+                      if ii not in analytical_columns]
+
+        # Derivatives of the integrated quadrupole strengths w.r.t. the knobs
+        steps = mf.steps_for_jacobian
+        dk1l_dknob = {}
+        for ii in analytical_columns:
+            vv = mf.vary[ii]
+            line = vv.container.line
+            names = self._quadrupoles(vv)
+            k1l_0 = np.array([_integrated_normal_quadrupole(line[nn])
+                              for nn in names])
+            val_0 = vv.get_value()
+            vv.container[vv.name] = val_0 + steps[ii]
+            k1l_1 = np.array([_integrated_normal_quadrupole(line[nn])
+                              for nn in names])
+            vv.container[vv.name] = val_0
+            dk1l_dknob[ii] = dict(zip(names, (k1l_1 - k1l_0) / steps[ii]))
+
+        jac = np.zeros((len(f0), len(x)))
+        weights_vary = np.array([1. if mf.vary[ii].weight is None
+                                 else mf.vary[ii].weight
+                                 for ii in analytical_columns])
+
+        for action, tp in twiss_for_response.items():
+            if tp is None:
+                continue
+            tw, periodic = tp
+            tw_rows = {nn: jj for jj, nn in enumerate(tw.name)}
+
+            # Matrix of the strength changes (elements x columns)
+            names = sorted({nn for dk in dk1l_dknob.values() for nn in dk
+                            if nn in tw_rows})
+            if len(names) == 0:
+                continue
+            j_rows = np.array([tw_rows[nn] for nn in names])
+            dk1l = np.array([[dk1l_dknob[ii].get(nn, 0.)
+                              for ii in analytical_columns] for nn in names])
+
+            entries = [(i_tar, quantity, i_row, sign)
+                       for i_tar, rows in target_rows.items()
+                       if mf.targets[i_tar].action is action
+                       for quantity, i_row, sign in rows]
+            for quantity in {ee[1] for ee in entries}:
+                this_entries = [ee for ee in entries if ee[1] == quantity]
+                i_rows = np.array([ee[2] for ee in this_entries])
+                dres = _linear_optics_response(tw, quantity, i_rows, j_rows,
+                                               periodic) @ dk1l
+                for (i_tar, _, _, sign), dd in zip(this_entries, dres):
+                    jac[i_tar, analytical_columns] += (
+                        sign * mf.targets[i_tar].weight * dd * weights_vary)
+
+        self.num_analytical_columns += len(analytical_columns)
+        self.num_finite_difference_columns += len(fd_columns)
+        if len(fd_columns) > 0:
+            if isinstance(self.full_jacobian, ParallelJacobian):
+                jac_fd = self.full_jacobian(x, f0=f0, columns=fd_columns)
+            else:
+                jac_fd = _finite_difference_columns(mf, x, f0, fd_columns)
+            jac[:, fd_columns] = jac_fd[:, fd_columns]
+
+        mf._last_jac = jac
+        return jac
+
+
+def _check_contexts_for_parallel_jacobian(line):
+    if isinstance(line, xt.Multiline):
+        lines = [line[nn] for nn in line.line_names]
+    else:
+        lines = [line]
+    for ll in lines:
+        ctx = ll._context
+        if not isinstance(ctx, xo.ContextCpu) or ctx.omp_num_threads != 0:
+            raise NotImplementedError(
+                'Parallel Jacobian evaluation is only supported for lines '
+                'on a serial CPU context')
+
 def _flatten_vary(vary):
     vary_flatten = []
     for vv in vary:
@@ -901,6 +1597,18 @@ def _complete_vary_with_info_from_line(vary, line):
             vv.container = line.vars
             vv._complete_limits_and_step_from_defaults()
 
+def _compile_vary_knobs(vary, line):
+    if isinstance(line, xt.Multiline):
+        raise NotImplementedError(
+            'Compiled knobs are not supported for Multiline')
+    vary_line_vars = [vv for vv in vary if vv.container is line.vars]
+    if len(vary_line_vars) == 0:
+        return
+    compiled_knobs = line.compile_knobs(
+                                sorted({vv.name for vv in vary_line_vars}))
+    for vv in vary_line_vars:
+        vv.container = compiled_knobs
+
 def closed_orbit_correction(line, line_co_ref, correction_config,
                             solver=None, verbose=False, restore_if_fail=True):
 
@@ -23,7 +23,13 @@ void ParticlesMonitor_track_local_particle(ParticlesMonitorData el,
 
     //start_per_particle_block (part0->part)
     int64_t at_turn;
-    if (ebe_mode){
+    if (ebe_mode == 2){
+        // Element by element over several turns, one record per element
+        // and per turn (repetition_period is the number of records per turn)
+        at_turn = LocalParticle_get_at_turn(part) * repetition_period
+                  + LocalParticle_get_at_element(part);
+    }
+    else if (ebe_mode){
         at_turn = LocalParticle_get_at_element(part);
     }
     else{
@@ -33,7 +39,7 @@ void ParticlesMonitor_track_local_particle(ParticlesMonitorData el,
         at_turn = LocalParticle_get_at_turn(part);
         #endif
     }
-    if (n_repetitions == 1){
+    if (n_repetitions == 1 || ebe_mode == 2){
         if (at_turn>=start_at_turn && at_turn<stop_at_turn){
             int64_t const particle_id = LocalParticle_get_particle_id(part);
             if (particle_id<part_id_end && particle_id>=part_id_start){
@@ -1 +1,3 @@
-from .multisetter import MultiSetter
\ No newline at end of file
+from .multisetter import MultiSetter
+from .compiled_knobs import CompiledKnobs
+from .time_dependent_vars import TimeDependentVarsTable
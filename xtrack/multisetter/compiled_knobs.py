@@ -0,0 +1,253 @@
+import numpy as np
+
+import xdeps as xd
+
+from .multisetter import MultiSetter
+
+
+def _element_field_targets(line, names, skip_elements=()):
+    '''
+    Element fields and variables depending on the variables `names`.
+
+    Returns a list of element fields as tuples (element_name, field, index),
+    with index None for scalar fields, and a list of dependent variables.
+    The fields of the elements in `skip_elements` are ignored.
+    '''
+
+    vref = line._xdeps_vref
+    eref = line.element_refs
+
+    element_fields = {}
+    dependent_vars = {}
+    for name in names:
+        for rr in line.vars[name]._find_dependant_targets():
+            owner = getattr(rr, '_owner', None)
+            if owner is vref:
+                if rr._key not in names:
+                    dependent_vars[rr._key] = None
+                continue
+            if owner is eref:
+                # Element container
+                continue
+            if isinstance(owner, xd.refs.ItemRef) and owner._owner is eref:
+                if owner._key in skip_elements:
+                    continue
+                ee = line.element_dict[owner._key]
+                if np.isscalar(getattr(ee, rr._key)):
+                    element_fields[(owner._key, rr._key, None)] = None
+                # Array fields are handled through their items
+                continue
+            if (isinstance(owner, xd.refs.AttrRef)
+                    and isinstance(owner._owner, xd.refs.ItemRef)
+                    and owner._owner._owner is eref):
+                element_fields[(owner._owner._key, owner._key, rr._key)] = None
+                continue
+            raise ValueError(f'Cannot compile the dependency `{rr}` of the '
+                             f'knobs {names}')
+
+    return list(element_fields.keys()), list(dependent_vars.keys())
+
+
+def _check_element_field(line, element_name, field, index):
+    ee = line.element_dict[element_name]
+    if isinstance(getattr(type(ee), field, None), property):
+        raise ValueError(f'`{element_name}.{field}` is computed in Python '
+                         'and cannot be set through buffer offsets')
+    if not hasattr(ee, '_xobject') or not hasattr(ee._xobject, field):
+        raise ValueError(f'`{element_name}.{field}` is not stored in the '
+                         'tracker buffer')
+    value = getattr(ee, field)
+    if index is not None:
+        value = value[index]
+    if not isinstance(value, np.float64):
+        raise ValueError(f'`{element_name}.{field}` is not a float64 field')
+
+
+def _build_setters(line, element_fields, rows):
+    # One MultiSetter for each field type, with the rows of `element_fields`
+    # that it sets
+    groups = {}
+    for rr in rows:
+        nn, field, index = element_fields[rr]
+        groups.setdefault((field, index), []).append(rr)
+    out = []
+    for (field, index), rr in groups.items():
+        names = [element_fields[ii][0] for ii in rr]
+        setter = MultiSetter(line, names, field=field, index=index)
+        out.append((setter, np.array(rr)))
+    return out
+
+
+class CompiledKnobs:
+
+    '''
+    Knobs of a line compiled into linear maps from the knob values to the
+    element fields of the tracker buffer.
+
+    The dependency graph of the knobs is evaluated once, when the object is
+    created, and the effect of each knob is stored as the buffer offsets of
+    the element fields it drives and the corresponding coefficients. Setting
+    a knob then amounts to adding the coefficients times the change of the
+    knob to the current values of the fields, with one vectorized buffer
+    read and write per field type through `MultiSetter`, instead of the
+    evaluation of the expressions in Python. Changes made in the meantime
+    through other variables are therefore preserved. The values of the knobs
+    and of the variables depending on them are also updated in `line.vars`,
+    without triggering the evaluation of the graph.
+
+    Only independent variables can be compiled and all the quantities driven
+    by them must be linear functions of the knobs. Changes in the
+    expressions made after the compilation are not seen by the compiled
+    knobs.
+
+    The object can be used as container of `xt.Vary` in matching.
+    '''
+
+    def __init__(self, line, knobs, step=1.):
+        """
+        Parameters
+        ----------
+        line : xtrack.Line
+            Line with a built tracker.
+        knobs : list of str
+            Names of the variables to be compiled.
+        step : float, optional
+            Step used to evaluate the coefficients of the linear maps and to
+            check their linearity. Defaults to 1.
+        """
+
+        knobs = list(knobs)
+        for kk in knobs:
+            if kk not in line.vars:
+                raise KeyError(f'Variable `{kk}` not found')
+            if line.vars[kk]._expr is not None:
+                raise ValueError(f'`{kk}` is defined by an expression and '
+                                 'cannot be compiled')
+
+        self.line = line
+        self.knob_names = knobs
+        self._knob_index = {kk: ii for ii, kk in enumerate(knobs)}
+
+        element_fields, dependent_vars = _element_field_targets(line, knobs)
+        for ef in element_fields:
+            _check_element_field(line, *ef)
+        self._element_fields = element_fields
+        self._dependent_vars = dependent_vars
+
+        values0 = np.array([line.vv[kk] for kk in knobs])
+
+        # Linear maps (the element fields are followed by the variables)
+        f0 = self._read_targets()
+        coeffs = np.zeros((len(f0), len(knobs)))
+        try:
+            for ii, kk in enumerate(knobs):
+                line.vars[kk] = values0[ii] + step
+                f_plus = self._read_targets()
+                line.vars[kk] = values0[ii] - step
+                f_minus = self._read_targets()
+                line.vars[kk] = values0[ii]
+                coeffs[:, ii] = (f_plus - f_minus) / (2 * step)
+                self._check_linear(f_plus + f_minus, 2 * f0, kk)
+
+            # Check that there are no products of knobs
+            for ii, kk in enumerate(knobs):
+                line.vars[kk] = values0[ii] + step
+            self._check_linear(self._read_targets(),
+                               f0 + coeffs.sum(axis=1) * step, knobs)
+        finally:
+            for ii, kk in enumerate(knobs):
+                line.vars[kk] = values0[ii]
+
+        self._coeffs = coeffs
+
+        num_fields = len(element_fields)
+        self._setters_all = _build_setters(
+                        line, element_fields, np.arange(num_fields))
+        self._setters_knob = []
+        for ii in range(len(knobs)):
+            rows = np.where(coeffs[:num_fields, ii] != 0)[0]
+            self._setters_knob.append(
+                _build_setters(line, element_fields, rows))
+        self._var_rows_knob = [
+            num_fields + np.where(coeffs[num_fields:, ii] != 0)[0]
+            for ii in range(len(knobs))]
+
+    def _read_targets(self):
+        out = []
+        for nn, field, index in self._element_fields:
+            value = getattr(self.line.element_dict[nn], field)
+            if index is not None:
+                value = value[index]
+            out.append(value)
+        var_values = self.line._xdeps_vref._owner
+        out += [var_values[nn] for nn in self._dependent_vars]
+        return np.array(out, dtype=np.float64)
+
+    def _check_linear(self, value, expected, knobs):
+        tol = 1e-10 * (np.abs(value) + np.abs(expected)) + 1e-15
+        nonlinear = np.abs(value - expected) > tol
+        if np.any(nonlinear):
+            ii = np.where(nonlinear)[0][0]
+            if ii < len(self._element_fields):
+                nn, field, index = self._element_fields[ii]
+                target = nn + '.' + field + (
+                    f'[{index}]' if index is not None else '')
+            else:
+                target = self._dependent_vars[ii - len(self._element_fields)]
+            raise ValueError(f'`{target}` is not a linear function of '
+                             f'{knobs}, which cannot be compiled')
+
+    def __contains__(self, key):
+        return key in self._knob_index
+
+    def keys(self):
+        return list(self.knob_names)
+
+    def __getitem__(self, key):
+        if key not in self._knob_index:
+            raise KeyError(key)
+        return self.line._xdeps_vref._owner[key]
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def get_values(self):
+        """Dictionary with the values of the knobs."""
+        var_values = self.line._xdeps_vref._owner
+        return {kk: var_values[kk] for kk in self.knob_names}
+
+    def update(self, values):
+        """
+        Set the values of a set of knobs.
+
+        Parameters
+        ----------
+        values : dict
+            Dictionary mapping the knob names to the values to be set.
+        """
+
+        var_values = self.line._xdeps_vref._owner
+        ctx2np = self.line._context.nparray_from_context_array
+
+        i_knobs = [self._knob_index[kk] for kk in values.keys()]
+        dvalues = np.zeros(len(self.knob_names))
+        for kk, vv in values.items():
+            dvalues[self._knob_index[kk]] = vv - var_values[kk]
+
+        deltas = self._coeffs @ dvalues
+
+        if len(i_knobs) == 1:
+            setters = self._setters_knob[i_knobs[0]]
+            var_rows = self._var_rows_knob[i_knobs[0]]
+        else:
+            setters = self._setters_all
+            var_rows = np.arange(len(self._element_fields), len(deltas))
+
+        for setter, rows in setters:
+            setter.set_values(ctx2np(setter.get_values()) + deltas[rows])
+
+        for kk, vv in values.items():
+            var_values[kk] = vv
+        num_fields = len(self._element_fields)
+        for rr in var_rows:
+            var_values[self._dependent_vars[rr - num_fields]] += deltas[rr]
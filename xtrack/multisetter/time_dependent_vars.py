@@ -0,0 +1,108 @@
+import numpy as np
+
+from .compiled_knobs import (_element_field_targets, _check_element_field,
+                             _build_setters)
+
+
+class TimeDependentVarsTable:
+
+    '''
+    Element fields driven by the time-dependent variables of a line (i.e. by
+    `line.vars['t_turn_s']`) sampled on a time grid before tracking.
+
+    The sampled values are stored on the context of the tracker and, during
+    tracking, the fields are set through `MultiSetter` buffer writes, without
+    evaluating the dependency graph. At each update the values of the last
+    sample not later than the time of the turn are used (the first sample
+    before the start of the grid), i.e. the grid plays the role of
+    `line.dt_update_time_dependent_vars`. The dependent variables of the line
+    are updated accordingly and an energy program, if present, is applied at
+    the exact time of the turn.
+
+    Changes in the variables or expressions made after the sampling are not
+    seen by the table.
+    '''
+
+    def __init__(self, line, t_s):
+        """
+        Parameters
+        ----------
+        line : xtrack.Line
+            Line with a built tracker.
+        t_s : array
+            Times (in seconds, strictly increasing) at which the
+            time-dependent variables are sampled.
+        """
+
+        t_s = np.array(t_s, dtype=np.float64)
+        if t_s.ndim != 1 or len(t_s) == 0:
+            raise ValueError('`t_s` must be a non-empty 1D array')
+        if np.any(np.diff(t_s) <= 0):
+            raise ValueError('`t_s` must be strictly increasing')
+
+        element_fields, dependent_vars = _element_field_targets(
+                        line, ['t_turn_s'], skip_elements=('energy_program',))
+        for ef in element_fields:
+            _check_element_field(line, *ef)
+
+        self.line = line
+        self.t_s = t_s
+        self.field_names = [nn + '.' + field + (
+                                f'[{index}]' if index is not None else '')
+                            for nn, field, index in element_fields]
+        self.var_names = dependent_vars
+
+        setters = _build_setters(line, element_fields,
+                                 np.arange(len(element_fields)))
+
+        context = line._context
+        ctx2np = context.nparray_from_context_array
+
+        var_values = line._xdeps_vref._owner
+        t_turn_s_0 = line.vv['t_turn_s']
+        self.field_values = np.zeros((len(t_s), len(element_fields)))
+        self.var_values = np.zeros((len(t_s), len(dependent_vars)))
+        try:
+            for ii, tt in enumerate(t_s):
+                line.vars['t_turn_s'] = tt
+                for setter, rows in setters:
+                    self.field_values[ii, rows] = ctx2np(setter.get_values())
+                self.var_values[ii, :] = [var_values[nn]
+                                          for nn in dependent_vars]
+        finally:
+            line.vars['t_turn_s'] = t_turn_s_0
+
+        self._setters = [
+            (setter, context.nparray_to_context_array(
+                        np.ascontiguousarray(self.field_values[:, rows])))
+            for setter, rows in setters]
+
+        self._i_last = None
+
+    def reset(self):
+        """Force the fields to be written at the next update."""
+        self._i_last = None
+
+    def apply(self, t_turn_s):
+        """
+        Set the element fields and the dependent variables to the values of
+        the sample associated to the time `t_turn_s`.
+
+        Parameters
+        ----------
+        t_turn_s : float
+            Time in seconds.
+        """
+
+        ii = max(int(np.searchsorted(self.t_s, t_turn_s, side='right')) - 1, 0)
+        var_values = self.line._xdeps_vref._owner
+        if ii != self._i_last:
+            for setter, values in self._setters:
+                setter.set_values(values[ii])
+            for nn, vv in zip(self.var_names, self.var_values[ii]):
+                var_values[nn] = vv
+            self._i_last = ii
+
+        var_values['t_turn_s'] = t_turn_s
+        if self.line.energy_program is not None:
+            self.line.energy_program.t_turn_s_line = t_turn_s
@@ -0,0 +1,238 @@
+# copyright ############################### #
+# This file is part of the Xtrack Package.  #
+# Copyright (c) CERN, 2021.                 #
+# ######################################### #
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xobjects as xo
+import xtrack as xt
+
+from .kernel_cache import (enable_kernel_cache, get_kernel_cache_directory,
+                           use_private_build_directory)
+from .particles import LAST_INVALID_STATE
+
+_RNG_FIELDS = ('_rng_s1', '_rng_s2', '_rng_s3', '_rng_s4')
+
+# Line tracked by a worker process
+_worker_line = None
+
+
+def _init_worker(line_dict, kernel_cache_directory):
+    global _worker_line
+    use_private_build_directory()
+    if kernel_cache_directory is not None:
+        enable_kernel_cache(kernel_cache_directory)
+    line = xt.Line.from_dict(line_dict)
+    line.build_tracker(_context=xo.ContextCpu())
+    _worker_line = line
+
+
+def _track_shard(particles_dict, track_kwargs):
+    particles = xt.Particles.from_dict(particles_dict,
+                                       _context=_worker_line._context)
+    _worker_line.track(particles, **track_kwargs)
+
+    monitor = None
+    if track_kwargs.get('turn_by_turn_monitor') in (True, 'ONE_TURN_EBE'):
+        monitor = _worker_line.record_last_track.to_dict()
+
+    return particles.to_dict(), monitor
+
+
+class ParallelTracker:
+
+    '''
+    Track particles through a line with a pool of worker processes, each
+    tracking a shard of the particles on a CPU serial context.
+
+    The line is serialized once and rebuilt in each worker. The particles
+    are split in shards of contiguous particle_id ranges, which are tracked
+    in parallel; the results (coordinates, lost particles information,
+    random number generator state and turn-by-turn monitor data) are merged
+    back into the original particles object.
+    '''
+
+    def __init__(self, line, num_workers=None, mp_context='spawn'):
+        """
+        Parameters
+        ----------
+        line: xtrack.Line
+            Line to be tracked.
+        num_workers: int, optional
+            Number of worker processes. Defaults to the number of CPUs.
+        mp_context: str, optional
+            Start method of the worker processes (see `multiprocessing`).
+            Defaults to 'spawn'.
+        """
+
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        assert num_workers >= 1
+
+        self.line = line
+        self.num_workers = num_workers
+        self.record_last_track = None
+
+        kernel_cache_directory = get_kernel_cache_directory()
+        if kernel_cache_directory is not None:
+            kernel_cache_directory = str(kernel_cache_directory)
+
+        self._pool = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context(mp_context),
+            initializer=_init_worker,
+            initargs=(line.to_dict(), kernel_cache_directory))
+
+    def close(self):
+        """
+        Shut down the worker processes.
+        """
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def track(self, particles, num_turns=1, turn_by_turn_monitor=None,
+              **kwargs):
+        """
+        Track particles through the line. The particles object is updated in
+        place, as in `Line.track`.
+
+        Parameters
+        ----------
+        particles: xtrack.Particles
+            Particles to be tracked.
+        num_turns: int, optional
+            Number of turns. Defaults to 1.
+        turn_by_turn_monitor: bool or str, optional
+            If True or 'ONE_TURN_EBE', the monitor data of all shards are
+            merged and made available in `record_last_track`.
+        **kwargs:
+            Other tracking options passed to `Line.track` in the workers.
+        """
+
+        if not (turn_by_turn_monitor is None or turn_by_turn_monitor is False
+                or turn_by_turn_monitor in (True, 'ONE_TURN_EBE')):
+            raise ValueError('Only turn_by_turn_monitor=True or '
+                             '"ONE_TURN_EBE" is supported by ParallelTracker')
+
+        track_kwargs = dict(num_turns=num_turns,
+                            turn_by_turn_monitor=turn_by_turn_monitor,
+                            **kwargs)
+
+        shards = _shard_particles(particles, self.num_workers)
+        futures = [self._pool.submit(_track_shard, pp.to_dict(), track_kwargs)
+                   for pp in shards]
+        results = [ff.result() for ff in futures]
+
+        tracked = [xt.Particles.from_dict(rr[0]) for rr in results]
+        _merge_shards_into(particles, tracked)
+
+        if turn_by_turn_monitor:
+            self.record_last_track = _merge_monitors(
+                [rr[1] for rr in results], _context=particles._context)
+        else:
+            self.record_last_track = None
+
+
+def _shard_particles(particles, num_shards):
+    # Split the particles in shards of contiguous particle_id ranges
+    ctx2np = particles._context.nparray_from_context_array
+    state = ctx2np(particles.state)
+    particle_id = ctx2np(particles.particle_id)
+
+    used = state > LAST_INVALID_STATE
+    pids = np.sort(particle_id[used])
+    num_shards = max(1, min(num_shards, len(pids)))
+
+    shards = []
+    for chunk in np.array_split(pids, num_shards):
+        if len(chunk) == 0:
+            continue
+        mask = used & (particle_id >= chunk[0]) & (particle_id <= chunk[-1])
+        shard = particles.filter(mask)
+        shard_cpu = shard.copy(_context=xo.context_default)
+        _copy_rng_state(particles, shard_cpu, mask)
+        shards.append(shard_cpu)
+    return shards
+
+
+def _copy_rng_state(particles, shard, mask):
+    ctx2np = particles._context.nparray_from_context_array
+    shard_pid = shard.particle_id
+    pid = ctx2np(particles.particle_id)[mask]
+    order = np.argsort(pid)
+    idx = order[np.searchsorted(pid[order], shard_pid)]
+    for nn in _RNG_FIELDS:
+        vv = ctx2np(getattr(particles, nn))
+        if np.isscalar(vv) or len(vv) == 0:
+            continue
+        getattr(shard, nn)[:] = vv[mask][idx]
+
+
+def _merge_shards_into(particles, tracked):
+    merged = xt.Particles.merge(tracked, _context=xo.context_default)
+
+    # Particles.merge does not carry the random number generator state
+    pid_all = np.concatenate([pp.particle_id for pp in tracked])
+    order = np.argsort(pid_all)
+    idx = order[np.searchsorted(pid_all[order], merged.particle_id)]
+    rng = {nn: np.concatenate([getattr(pp, nn) for pp in tracked])[idx]
+           for nn in _RNG_FIELDS}
+
+    assert merged._capacity <= particles._capacity
+    num_used = merged._capacity
+    ctx = particles._context
+    with particles._bypass_linked_vars():
+        for tt, nn in particles.per_particle_vars:
+            vv = ctx.nparray_from_context_array(getattr(particles, nn)).copy()
+            if nn in _RNG_FIELDS:
+                vv[:num_used] = rng[nn]
+            else:
+                vv[:num_used] = getattr(merged, nn)
+            if nn == 'state':
+                vv[num_used:] = LAST_INVALID_STATE
+            getattr(particles, nn)[:] = ctx.nparray_to_context_array(vv)
+
+    if isinstance(ctx, xo.ContextCpu):
+        particles.reorganize(include_rng_state=True)
+
+
+def _merge_monitors(monitor_dicts, _context):
+    monitors = [xt.ParticlesMonitor.from_dict(dd) for dd in monitor_dicts]
+    start_at_turn = monitors[0].start_at_turn
+    stop_at_turn = monitors[0].stop_at_turn
+    for mm in monitors:
+        assert mm.start_at_turn == start_at_turn
+        assert mm.stop_at_turn == stop_at_turn
+
+    part_id_start = min(mm.part_id_start for mm in monitors)
+    part_id_end = max(mm.part_id_end for mm in monitors)
+    out = xt.ParticlesMonitor(
+        _context=xo.context_default,
+        start_at_turn=start_at_turn, stop_at_turn=stop_at_turn,
+        particle_id_range=(part_id_start, part_id_end))
+    out.ebe_mode = monitors[0].ebe_mode
+
+    n_turns = stop_at_turn - start_at_turn
+    n_rows = part_id_end - part_id_start
+    with out.data._bypass_linked_vars():
+        for _, nn in out._ParticlesClass.per_particle_vars:
+            vv = np.array(getattr(out.data, nn)).reshape(n_rows, n_turns)
+            for mm in monitors:
+                i0 = mm.part_id_start - part_id_start
+                i1 = mm.part_id_end - part_id_start
+                vv[i0:i1, :] = np.array(getattr(mm.data, nn)).reshape(
+                                                            i1 - i0, n_turns)
+            getattr(out.data, nn)[:] = vv.flatten()
+
+    if not isinstance(_context, xo.ContextCpu):
+        out = out.copy(_context=_context)
+    return out
@@ -832,12 +832,18 @@ class Particles(xo.HybridClass):
         elif restore_hidden:
             self.hide_lost_particles(_assume_reorganized=True)
 
-    def reorganize(self):
+    def reorganize(self, include_rng_state=False):
 
         """
         Reorganize the particles object so that all active particles are at the
         beginning of the arrays.
 
+        Parameters
+        ----------
+        include_rng_state : bool, optional
+            If True, the state of the random number generator is moved
+            together with the particles. Defaults to False.
+
         Returns
         -------
         n_active : int
@@ -876,7 +882,8 @@ class Particles(xo.HybridClass):
             # Reorganize particles
             with self._bypass_linked_vars():
                 for tt, nn in self.per_particle_vars:
-                    if nn.startswith('_rng'):
+                    is_rng_state = nn.startswith('_rng')
+                    if is_rng_state and not include_rng_state:
                         continue
                     vv = getattr(self, nn)
                     vv_active = vv[mask_active]
@@ -884,7 +891,10 @@ class Particles(xo.HybridClass):
 
                     vv[:n_active] = vv_active
                     vv[n_active:n_active + n_lost] = vv_lost
-                    vv[n_active + n_lost:] = tt._dtype.type(LAST_INVALID_STATE)
+                    if is_rng_state:
+                        vv[n_active + n_lost:] = 0
+                    else:
+                        vv[n_active + n_lost:] = tt._dtype.type(LAST_INVALID_STATE)
 
         if isinstance(self._buffer.context, xo.ContextCpu):
             self._num_active_particles = n_active
@@ -2,11 +2,18 @@
 # This file is part of the Xtrack Package.  #
 # Copyright (c) CERN, 2021.                 #
 # ######################################### #
+import hashlib
+import os
+import pathlib
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from time import perf_counter
 from typing import Literal, Union
 import logging
-from functools import partial
+from functools import partial, wraps
 from collections import UserDict, defaultdict
+from contextlib import nullcontext
 
 from scipy.constants import c as clight
 
@@ -16,8 +23,13 @@ import xtrack as xt
 
 from .base_element import _handle_per_particle_blocks
 from .beam_elements import Drift
+from .checkpoint import load_checkpoint, write_checkpoint
 from .general import _pkg_root
-from .internal_record import new_io_buffer
+from .internal_record import ElementProfileRecord, new_io_buffer
+from .kernel_cache import (get_kernel_cache_directory, kernel_cache_key,
+                           kernel_cache_module_name, kernel_cache_lock,
+                           find_cached_kernel, touch_cached_kernel,
+                           evict_kernel_cache)
 from .line import Line, _is_thick, _is_collective
 from .line import freeze_longitudinal as _freeze_longitudinal
 from .pipeline import PipelineStatus
@@ -26,6 +38,77 @@ from .tracker_data import TrackerData
 
 logger = logging.getLogger(__name__)
 
+# Protects the kernels and tracker data shared between trackers (kernel dicts,
+# specialized kernel cache, buffers shared by the lines of a Multiline)
+_kernel_lock = threading.RLock()
+
+# Worker threads used by `Tracker.track_async`
+_track_async_executor = None
+
+
+def _get_track_async_executor():
+    global _track_async_executor
+    with _kernel_lock:
+        if _track_async_executor is None:
+            _track_async_executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count(),
+                thread_name_prefix='xtrack_track_async')
+    return _track_async_executor
+
+
+def _holding_track_lock(method):
+    # Tracking calls on the same tracker are serialized, as they share the
+    # io buffer, the time-dependent variables and the tracker data
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._track_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+DEFAULT_COMPACTION_THRESHOLD = 0.2
+
+# Kernels specialized for a given line, per context
+_specialized_kernel_cache = weakref.WeakKeyDictionary()
+
+# Lines with more elements are tracked with the generic kernel even if
+# XTRACK_SPECIALIZED_KERNEL is set, as the compilation time of the unrolled
+# element sequence grows with the length of the line
+SPECIALIZED_KERNEL_MAX_ELEMENTS = 2000
+
+_ELEMENT_PROFILE_HELPERS_SOURCE = r'''
+            #include <time.h>
+
+            /*gpufun*/
+            double ElementProfile_now(void){
+                struct timespec ts;
+                clock_gettime(CLOCK_MONOTONIC, &ts);
+                return (double) ts.tv_sec + 1e-9 * (double) ts.tv_nsec;
+            }
+
+            /*gpufun*/
+            int64_t ElementProfile_num_active(LocalParticle* part){
+                return part->_num_active_particles;                  //only_for_context cpu_serial
+                int64_t num_active = 0;                              //only_for_context cpu_openmp
+                for (int64_t ii = part->ipart; ii < part->endpart; ii++){ //only_for_context cpu_openmp
+                    if (part->state[ii] > 0) num_active++;           //only_for_context cpu_openmp
+                }                                                    //only_for_context cpu_openmp
+                return num_active;                                   //only_for_context cpu_openmp
+            }
+'''
+
+_ELEMENT_PROFILE_START_SOURCE = r'''
+                        #ifdef XTRACK_PROFILE_ELEMENTS
+                        num_profile = ElementProfile_num_active(&lpart);
+                        t_profile = ElementProfile_now();
+                        #endif'''
+
+def _element_profile_stop_source(elem_idx):
+    return f'''
+                        #ifdef XTRACK_PROFILE_ELEMENTS
+                        ElementProfileRecord_add(profile_record, {elem_idx},
+                                ElementProfile_now() - t_profile, num_profile);
+                        #endif'''
+
 class Tracker:
 
     '''
@@ -77,6 +160,7 @@ class Tracker:
         self.local_particle_src = local_particle_src
         self._enable_pipeline_hold = enable_pipeline_hold
         self.use_prebuilt_kernels = use_prebuilt_kernels
+        self._time_dependent_vars_table = None
 
         # Some data for collective mode prepared also for non-collective lines
         # to allow collective actions by the tracker (e.g. time-functions on knobs)
@@ -136,6 +220,7 @@ class Tracker:
             self._zerodrift = Drift(_context=_buffer.context, length=0)
 
         self._track_kernel = track_kernel or {}
+        self._init_thread_state()
         self._tracker_data_cache = {}
         self._tracker_data_cache[None] = tracker_data_base
 
@@ -290,14 +375,89 @@ class Tracker:
             self._tracker_data_cache = None
         self._is_invalidated = True
 
+    def _init_thread_state(self):
+        self._track_lock = threading.RLock()
+        self._reset_last_track_info()
+
+    def _reset_last_track_info(self):
+        self._last_track_info = {}
+
+    def _get_last_track_info(self, name):
+        # Value set by the most recent tracking, in any thread
+        return self._last_track_info.get(name, None)
+
+    def _set_last_track_info(self, name, value):
+        self._last_track_info[name] = value
+
+    @property
+    def record_last_track(self):
+        return self._get_last_track_info('record_last_track')
+
+    @record_last_track.setter
+    def record_last_track(self, value):
+        self._set_last_track_info('record_last_track', value)
+
+    @property
+    def time_last_track(self):
+        return self._get_last_track_info('time_last_track')
+
+    @time_last_track.setter
+    def time_last_track(self, value):
+        self._set_last_track_info('time_last_track', value)
+
     def _check_invalidated(self):
         if hasattr(self, '_is_invalidated') and self._is_invalidated:
             raise RuntimeError(
                 "This tracker is not anymore valid, most probably because the corresponding line has been unfrozen. "
                 "Please rebuild the tracker, for example using `line.build_tracker(...)`.")
 
+    def track_async(self, particles, *args, awaitable=False, executor=None,
+                    **kwargs):
+        """
+        Track particles on a worker thread. The compiled track kernel runs
+        without holding the Python GIL, so that other lines can be tracked
+        and other Python code can run at the same time. Tracking calls on the
+        same line are executed one after the other.
+
+        Parameters
+        ----------
+        particles: xtrack.Particles
+            The particles to track.
+        awaitable: bool, optional
+            If True, an asyncio future is returned, to be awaited in a
+            coroutine. Defaults to False.
+        executor: concurrent.futures.Executor, optional
+            Executor used to run the tracking. Defaults to a thread pool
+            shared by all lines.
+        *args, **kwargs:
+            Tracking options (see `Line.track`).
+
+        Returns
+        -------
+        future: concurrent.futures.Future or asyncio.Future
+            Future whose result is the value returned by `Line.track`. A
+            turn-by-turn monitor created by the tracking is available in
+            `record_last_track` after completion, until the line is tracked
+            again (in any thread).
+        """
+        self._check_invalidated()
+
+        if executor is None:
+            executor = _get_track_async_executor()
+        future = executor.submit(self._track, particles, *args, **kwargs)
+
+        if awaitable:
+            import asyncio
+            return asyncio.wrap_future(future)
+        return future
+
+    @_holding_track_lock
     def _track(self, particles, *args, with_progress: Union[bool, int] = False,
-               time=False, **kwargs):
+               time=False, compact_lost_particles: Union[bool, float] = False,
+               compaction_interval=100, stop_condition=None,
+               stop_condition_interval=100, checkpoint_every=None,
+               checkpoint_path=None, checkpoint_keep=2,
+               _checkpoint_turn_offset=0, **kwargs):
 
         out = None
 
@@ -311,23 +471,71 @@ class Tracker:
         else:
             tracking_func = self._track_no_collective
 
-        if with_progress:
+        if compact_lost_particles is True:
+            compaction_threshold = DEFAULT_COMPACTION_THRESHOLD
+        elif compact_lost_particles:
+            compaction_threshold = float(compact_lost_particles)
+            assert 0 < compaction_threshold <= 1
+        else:
+            compaction_threshold = None
+
+        if compaction_threshold is not None:
+            if tracking_func != self._track_no_collective:
+                raise NotImplementedError(
+                    'Compaction of lost particles is only available for '
+                    'non-collective tracking')
+            # The compaction reorganizes the particles on the host, which is
+            # not supported on GPUs and conflicts with the per-thread
+            # handling of the particles on OpenMP contexts
+            if (not isinstance(self._context, xo.ContextCpu)
+                    or getattr(self._context, 'openmp_enabled', False)):
+                raise NotImplementedError(
+                    'Compaction of lost particles is only available on CPU '
+                    'contexts without OpenMP')
+
+        if stop_condition is True:
+            stop_condition = 'all_lost'
+
+        if checkpoint_every is not None:
+            checkpoint_every = int(checkpoint_every)
+            assert checkpoint_every > 0
+            if checkpoint_path is None:
+                raise ValueError('`checkpoint_path` must be provided together '
+                                 'with `checkpoint_every`')
+
+        if (with_progress or compaction_threshold is not None
+                or stop_condition is not None or checkpoint_every is not None):
             if self.enable_pipeline_hold:
-                raise ValueError("Progress indicator is not supported with pipeline hold")
+                raise ValueError("Progress indicator, compaction of lost "
+                                 "particles, stop conditions and checkpoints "
+                                 "are not supported with pipeline hold")
 
             try:
                 num_turns = kwargs['num_turns']
             except KeyError:
-                raise ValueError('Tracking with progress indicator is only '
-                                 'possible over more than one turn.')
+                raise ValueError('Tracking with progress indicator, '
+                                 'compaction of lost particles, stop '
+                                 'condition or checkpoints is only possible '
+                                 'over more than one turn.')
 
+            batch_sizes = []
             if with_progress is True:
-                batch_size = scaling = 100
-            else:
-                batch_size = int(with_progress)
-                scaling = with_progress if batch_size > 1 else None
-
+                batch_sizes.append(100)
+            elif with_progress:
+                batch_sizes.append(int(with_progress))
+            if compaction_threshold is not None:
+                batch_sizes.append(int(compaction_interval))
+            if stop_condition is not None:
+                batch_sizes.append(int(stop_condition_interval))
+            if checkpoint_every is not None:
+                batch_sizes.append(checkpoint_every)
+            batch_size = int(np.gcd.reduce(batch_sizes))
+            assert batch_size > 0
+            scaling = batch_size if batch_size > 1 else None
+
+            monitor_owned = False
             if kwargs.get('turn_by_turn_monitor') is True:
+                monitor_owned = True
                 ele_start = kwargs.get('ele_start') or 0
                 ele_stop = kwargs.get('ele_stop')
                 if ele_stop is None:
@@ -340,11 +548,16 @@ class Tracker:
                 _, monitor, _, _ = self._get_monitor(particles, True, num_turns)
                 kwargs['turn_by_turn_monitor'] = monitor
 
-            for ii in progress(
-                    range(0, num_turns, batch_size),
+            batch_starts = range(0, num_turns, batch_size)
+            if with_progress:
+                batch_starts = progress(
+                    batch_starts,
                     desc='Tracking',
                     unit_scale=scaling,
-            ):
+                )
+
+            num_tracked = particles._capacity
+            for ii in batch_starts:
                 one_turn_kwargs = kwargs.copy()
                 is_first_batch = ii == 0
                 is_last_batch = ii + batch_size >= num_turns
@@ -371,8 +584,48 @@ class Tracker:
                     one_turn_kwargs['ele_stop'] = None
                     one_turn_kwargs['_reset_log'] = False
 
+                if compaction_threshold is not None:
+                    one_turn_kwargs['_num_threads'] = max(num_tracked, 1)
+
                 tracking_func(particles, *args, **one_turn_kwargs)
-                # particles.reorganize() # could be done in the future to optimize GPU usage
+
+                if is_last_batch:
+                    break
+
+                if (stop_condition is not None
+                        and _stop_condition_fired(particles, stop_condition)):
+                    if monitor_owned:
+                        # Drop the turns that were not tracked
+                        self.record_last_track = _truncate_monitor(
+                            kwargs['turn_by_turn_monitor'],
+                            num_turns=ii + batch_size)
+                    break
+
+                if compaction_threshold is not None:
+                    num_tracked = _compact_lost_particles(
+                        particles, num_tracked, compaction_threshold)
+
+                if (checkpoint_every is not None
+                        and (ii + batch_size) % checkpoint_every == 0):
+                    track_kwargs = {
+                        kk: kwargs[kk] for kk in
+                        ('ele_stop', 'num_elements', 'freeze_longitudinal')
+                        if kk in kwargs}
+                    track_kwargs.update(
+                        with_progress=with_progress,
+                        compact_lost_particles=compact_lost_particles,
+                        compaction_interval=compaction_interval,
+                        stop_condition_interval=stop_condition_interval,
+                        checkpoint_every=checkpoint_every,
+                        checkpoint_keep=checkpoint_keep)
+                    if not callable(stop_condition):
+                        track_kwargs['stop_condition'] = stop_condition
+                    self._write_checkpoint(
+                        checkpoint_path, particles,
+                        monitor=kwargs.get('turn_by_turn_monitor'),
+                        num_turns_done=_checkpoint_turn_offset + ii + batch_size,
+                        num_turns_remaining=num_turns - ii - batch_size,
+                        track_kwargs=track_kwargs, keep=checkpoint_keep)
         else:
             out = tracking_func(particles, *args, **kwargs)
 
@@ -385,6 +638,94 @@ class Tracker:
 
         return out
 
+    def _write_checkpoint(self, checkpoint_path, particles, monitor,
+                          num_turns_done, num_turns_remaining, track_kwargs,
+                          keep):
+
+        if not isinstance(monitor, self.particles_monitor_class):
+            monitor = None
+
+        line_state = {
+            '_t_last_update_time_dependent_vars':
+                self.line._t_last_update_time_dependent_vars,
+        }
+        if self.line.enable_time_dependent_vars:
+            line_state['t_turn_s'] = self.line.vv['t_turn_s']
+
+        state = {
+            'xtrack_version': xt.__version__,
+            'num_turns_done': num_turns_done,
+            'num_turns_remaining': num_turns_remaining,
+            'particles': particles.to_dict(),
+            'monitor': monitor.to_dict() if monitor is not None else None,
+            'line_state': line_state,
+            'track_kwargs': track_kwargs,
+        }
+
+        return write_checkpoint(checkpoint_path, state,
+                                num_turns_done=num_turns_done, keep=keep)
+
+    @_holding_track_lock
+    def resume_from_checkpoint(self, checkpoint_path, **kwargs):
+        """
+        Resume a tracking interrupted after writing a checkpoint (see the
+        `checkpoint_every` argument of `Line.track`). The particles, the
+        turn-by-turn monitor and the state of the time-dependent variables are
+        restored and the remaining turns are tracked, with the same options
+        as the interrupted tracking. New checkpoints continue to be written
+        in the same directory.
+
+        Parameters
+        ----------
+        checkpoint_path: str or Path
+            Checkpoint file or directory containing the checkpoints, in which
+            case the most recent one is used.
+        **kwargs:
+            Tracking options overriding those stored in the checkpoint (for
+            example a callable `stop_condition` or `log`, which are not
+            stored).
+
+        Returns
+        -------
+        particles: xtrack.Particles
+            The tracked particles.
+        """
+        self._check_invalidated()
+
+        state = load_checkpoint(checkpoint_path)
+
+        particles = xt.Particles.from_dict(state['particles'],
+                                           _context=self._context)
+
+        line_state = state['line_state']
+        if 't_turn_s' in line_state:
+            self.line.vars['t_turn_s'] = line_state['t_turn_s']
+        if self._time_dependent_vars_table is not None:
+            self._time_dependent_vars_table.reset()
+        self.line._t_last_update_time_dependent_vars = line_state[
+                                        '_t_last_update_time_dependent_vars']
+
+        monitor = None
+        if state['monitor'] is not None:
+            monitor = self.particles_monitor_class.from_dict(
+                state['monitor'], _context=self._context)
+
+        checkpoint_path = pathlib.Path(checkpoint_path)
+        if not checkpoint_path.is_dir():
+            checkpoint_path = checkpoint_path.parent
+
+        track_kwargs = state['track_kwargs'].copy()
+        track_kwargs['checkpoint_path'] = checkpoint_path
+        track_kwargs.update(kwargs)
+
+        self._track(particles, ele_start=0,
+                    num_turns=state['num_turns_remaining'],
+                    turn_by_turn_monitor=monitor,
+                    _checkpoint_turn_offset=state['num_turns_done'],
+                    **track_kwargs)
+
+        return particles
+
     @property
     def particle_ref(self) -> xt.Particles:
         self._check_invalidated()
@@ -427,11 +768,16 @@ class Tracker:
             containing_dir='.',
             extra_classes=[],
             extra_kernels={},
+            allow_prebuilt_kernels=True,
     ):
         if compile == 'force':
             use_prebuilt_kernels = False
+        elif not allow_prebuilt_kernels:
+            use_prebuilt_kernels = False
         elif not self._context.allow_prebuilt_kernels:  # only CPU serial
             use_prebuilt_kernels = False
+        elif self._is_specialized_kernel():
+            use_prebuilt_kernels = False
         else:
             use_prebuilt_kernels = self.use_prebuilt_kernels
 
@@ -458,8 +804,15 @@ class Tracker:
                     containing_dir=XSK_PREBUILT_KERNELS_LOCATION,
                     kernel_descriptions={'track_line': kernel_description},
                 )
+                kernels['track_line']._xtrack_prebuilt = True
                 return kernels['track_line']
 
+        if (compile is True and module_name is None and not extra_classes
+                and not extra_kernels and self._context.allow_prebuilt_kernels
+                and not getattr(self._context, 'openmp_enabled', False)
+                and get_kernel_cache_directory() is not None):
+            return self._build_kernel_using_cache()
+
         context = self._tracker_data_base._buffer.context
 
         kernel_element_classes = self._tracker_data_base.kernel_element_classes
@@ -470,6 +823,8 @@ class Tracker:
         headers.append(_pkg_root.joinpath("headers/constants.h"))
 
         src_lines = []
+        if self.config.get('XTRACK_PROFILE_ELEMENTS', False):
+            src_lines.append(_ELEMENT_PROFILE_HELPERS_SOURCE)
         src_lines.append(
             r"""
             /*gpukern*/
@@ -487,7 +842,11 @@ class Tracker:
                              double line_length,
                 /*gpuglmem*/ int8_t* buffer_tbt_monitor,
                              int64_t offset_tbt_monitor,
-                /*gpuglmem*/ int8_t* io_buffer){
+                /*gpuglmem*/ int8_t* io_buffer
+            #ifdef XTRACK_PROFILE_ELEMENTS
+                           , int64_t offset_profile_record
+            #endif
+                ){
 
             #define CONTEXT_OPENMP  //only_for_context cpu_openmp
             #ifdef CONTEXT_OPENMP
@@ -531,6 +890,13 @@ class Tracker:
             ParticlesMonitorData tbt_monitor =
                             (ParticlesMonitorData) tbt_mon_pointer;
 
+            #ifdef XTRACK_PROFILE_ELEMENTS
+            ElementProfileRecord profile_record = (ElementProfileRecord)
+                            (io_buffer + offset_profile_record);
+            double t_profile;
+            int64_t num_profile;
+            #endif
+
             int64_t part_capacity = ParticlesData_get__capacity(particles);
             if (part_id<part_capacity){
             Particles_to_LocalParticle(particles, &lpart, part_id, end_id);
@@ -559,7 +925,15 @@ class Tracker:
                 int64_t elem_idx = ele_start;
                 int64_t const increm = 1;
                 #endif
+        """
+        )
 
+        if self._is_specialized_kernel():
+            src_lines.extend(
+                self._specialized_element_sequence_source(kernel_element_classes))
+        else:
+            src_lines.append(
+            r"""
                 for (; ((elem_idx >= ele_start) && (elem_idx < ele_stop)); elem_idx+=increm){
                         if (flag_monitor==2){
                             ParticlesMonitor_track_local_particle(tbt_monitor, &lpart);
@@ -569,36 +943,25 @@ class Tracker:
                         // element in `element_ref_data.elements`:
                         /*gpuglmem*/ void* el = ElementRefData_member_elements(elem_ref_data, elem_idx);
                         int64_t elem_type = ElementRefData_typeid_elements(elem_ref_data, elem_idx);
-
-                        switch(elem_type){
-        """
-        )
-
-        for ii, cc in enumerate(kernel_element_classes):
-            ccnn = cc.__name__.replace("Data", "")
-            src_lines.append(
-                f"""
-                        case {ii}:
-"""
+            """
             )
-            if ccnn == "Drift":
-                src_lines.append(
-                    """
-                            #ifdef XTRACK_GLOBAL_XY_LIMIT
-                            global_aperture_check(&lpart);
-                            #endif
-
-                            """
-                )
+            src_lines.append(_ELEMENT_PROFILE_START_SOURCE)
             src_lines.append(
-                f"""
-                            {ccnn}_track_local_particle_with_transformations(({ccnn}Data) el, &lpart);
-                            break;"""
+            r"""
+                        switch(elem_type){
+            """
             )
 
-        src_lines.append(
+            src_lines.extend(_element_switch_cases_source(kernel_element_classes))
+
+            src_lines.append(
             r"""
                         } //switch
+            """
+            )
+            src_lines.append(_element_profile_stop_source('elem_idx'))
+            src_lines.append(
+            r"""
 
                     // Setting the below flag will break particle losses
                     #ifndef DANGER_SKIP_ACTIVE_CHECK_AND_SWAPS
@@ -617,7 +980,11 @@ class Tracker:
                     #endif //DANGER_SKIP_ACTIVE_CHECK_AND_SWAPS
 
                 } // for elements
+            """
+            )
 
+        src_lines.append(
+            r"""
                 if (flag_monitor==2){
                     // End of turn (element-by-element mode)
                     ParticlesMonitor_track_local_particle(tbt_monitor, &lpart);
@@ -631,6 +998,12 @@ class Tracker:
                 if (flag_end_turn_actions>0){
                     if (isactive){
                         increment_at_turn(&lpart, flag_reset_s_at_end_turn);
+                        #ifdef XTRACK_PROFILE_ELEMENTS
+                        num_profile = ElementProfile_num_active(&lpart);
+                        #pragma omp atomic //only_for_context cpu_openmp
+                        *ElementProfileRecord_getp_num_particle_turns(
+                                                profile_record) += num_profile;
+                        #endif
                     }
                 }
                 #endif
@@ -675,7 +1048,8 @@ class Tracker:
             sources=[source_track],
             kernel_descriptions=kernels,
             extra_headers=self._config_to_headers() + headers,
-            extra_classes=kernel_element_classes + extra_classes,
+            extra_classes=(kernel_element_classes + extra_classes
+                           + self._element_profile_classes()),
             apply_to_source=[
                 partial(_handle_per_particle_blocks,
                         local_particle_src=self.local_particle_src)],
@@ -686,6 +1060,111 @@ class Tracker:
         )
         return out_kernels['track_line']
 
+    def _build_kernel_using_cache(self):
+        kernel_element_classes = self._tracker_data_base.kernel_element_classes
+        cache_key = kernel_cache_key(
+            element_classes=kernel_element_classes,
+            hashable_config=self._hashable_config(),
+            local_particle_src=self.local_particle_src,
+            context=self._context,
+            extra_headers=self.extra_headers,
+            specialization=(self._specialized_kernel_hash()
+                            if self._is_specialized_kernel() else None))
+        module_name = kernel_cache_module_name(cache_key)
+        containing_dir = str(get_kernel_cache_directory())
+
+        # The lock makes sure that concurrent processes compile only once
+        with kernel_cache_lock(cache_key):
+            so_file = find_cached_kernel(cache_key)
+            if so_file is None:
+                kernel = self._build_kernel(
+                    compile=True,
+                    module_name=module_name,
+                    containing_dir=containing_dir)
+            else:
+                touch_cached_kernel(so_file)
+                kernel_description = self.get_kernel_descriptions(
+                                    kernel_element_classes)['track_line']
+                kernel = self._context.kernels_from_file(
+                    module_name=module_name,
+                    containing_dir=containing_dir,
+                    kernel_descriptions={'track_line': kernel_description},
+                )['track_line']
+
+        evict_kernel_cache()
+
+        return kernel
+
+    def _is_specialized_kernel(self):
+        return bool(self.config.get('XTRACK_SPECIALIZED_KERNEL', False)
+                    and not self.config.get('XSUITE_BACKTRACK', False)
+                    and not self.config.get('XSUITE_MIRROR', False)
+                    and (len(self._tracker_data_base.elements)
+                         <= SPECIALIZED_KERNEL_MAX_ELEMENTS))
+
+    def _specialized_kernel_hash(self):
+        # The specialized kernel depends only on the sequence of element
+        # classes and on the location of the elements in the buffer
+        hh = hashlib.sha256()
+        for ee in self._tracker_data_base.elements:
+            hh.update(f'{ee._XoStruct.__name__}:{ee._xobject._offset};'.encode())
+        return hh.hexdigest()
+
+    def _build_specialized_kernel(self):
+        key = (self._hashable_config(), self._specialized_kernel_hash())
+        kernels = _specialized_kernel_cache.setdefault(self._context, {})
+        if key not in kernels:
+            kernels[key] = self._build_kernel(compile=True)
+        return kernels[key]
+
+    def _specialized_element_sequence_source(self, kernel_element_classes):
+        """
+        Straight-line sequence of element calls for this specific line, with
+        the element locations in the buffer baked in. The switch on
+        ele_start is used only to jump to the first element to be tracked.
+
+        Only the dispatch on the element type is removed: the element
+        parameters are still read from the buffer at run time, so no constant
+        folding of the element properties takes place. Lines longer than
+        `SPECIALIZED_KERNEL_MAX_ELEMENTS` use the generic kernel.
+        """
+        src_lines = [r"""
+                switch (ele_start){"""]
+
+        for ii, ee in enumerate(self._tracker_data_base.elements):
+            ccnn = ee._XoStruct.__name__.replace('Data', '')
+            src_lines.append(f"""
+                    case {ii}:
+                        if ({ii} >= ele_stop) goto end_of_elements;
+                        if (flag_monitor==2){{
+                            ParticlesMonitor_track_local_particle(tbt_monitor, &lpart);
+                        }}""")
+            if ccnn == 'Drift':
+                src_lines.append("""
+                        #ifdef XTRACK_GLOBAL_XY_LIMIT
+                        global_aperture_check(&lpart);
+                        #endif""")
+            src_lines.append(_ELEMENT_PROFILE_START_SOURCE)
+            src_lines.append(f"""
+                        {ccnn}_track_local_particle_with_transformations(
+                            ({ccnn}Data) (buffer + {ee._xobject._offset}), &lpart);""")
+            src_lines.append(_element_profile_stop_source(ii))
+            src_lines.append(f"""
+                        #ifndef DANGER_SKIP_ACTIVE_CHECK_AND_SWAPS
+                        isactive = check_is_active(&lpart);
+                        if (!isactive) goto end_of_elements;
+                        increment_at_element(&lpart, 1);
+                        #endif""")
+
+        src_lines.append(r"""
+                } // switch
+                end_of_elements: ;
+                (void) elem_idx;
+                (void) increm;
+        """)
+
+        return src_lines
+
     def get_kernel_descriptions(self, kernel_element_classes):
 
         tdata_type = _element_ref_data_class_from_element_classes(
@@ -713,6 +1192,11 @@ class Tracker:
             )
         }
 
+        if self.config.get('XTRACK_PROFILE_ELEMENTS', False):
+            # Only profiling kernels take the location of the profile record
+            kernel_descriptions['track_line'].args.append(
+                xo.Arg(xo.Int64, name="offset_profile_record"))
+
         # Random number generator init kernel
         kernel_descriptions.update(xt.Particles._kernels)
 
@@ -993,7 +1477,7 @@ class Tracker:
                                             moveback_to_buffer, moveback_to_offset,
                                             _context_needs_clean_active_lost_state)
 
-                if monitor is not None and monitor.ebe_mode == 1:
+                if monitor is not None and monitor.ebe_mode > 0:
                     monitor_part = monitor
                 else:
                     monitor_part = None
@@ -1086,6 +1570,7 @@ class Tracker:
         log=None,
         _force_no_end_turn_actions=False,
         _reset_log=True,
+        _num_threads=None,
     ):
 
         self._check_invalidated()
@@ -1230,58 +1715,29 @@ class Tracker:
             particles._init_random_number_generator()
 
         track_kernel, tracker_data = self.get_track_kernel_and_data_for_present_config()
-        track_kernel.description.n_threads = particles._capacity
-
-        # First turn
-        assert num_elements_first_turn >= 0
-        track_kernel(
-            buffer=tracker_data._buffer.buffer,
-            tracker_data=tracker_data._element_ref_data,
-            particles=particles._xobject,
-            num_turns=1,
-            ele_start=ele_start,
-            num_ele_track=num_elements_first_turn,
-            flag_end_turn_actions=flag_end_first_turn_actions,
-            flag_reset_s_at_end_turn=self.reset_s_at_end_turn,
-            flag_monitor=flag_monitor,
-            num_ele_line=len(tracker_data.element_names),
-            line_length=tracker_data.line_length,
-            buffer_tbt_monitor=buffer_monitor,
-            offset_tbt_monitor=offset_monitor,
-            io_buffer=self.io_buffer.buffer,
-        )
-
-        # Middle turns
-        if num_middle_turns > 0:
-            assert self.num_elements > 0
-            track_kernel(
-                buffer=tracker_data._buffer.buffer,
-                tracker_data=tracker_data._element_ref_data,
-                particles=particles._xobject,
-                num_turns=num_middle_turns,
-                ele_start=0, # always full turn
-                num_ele_track=self.num_elements, # always full turn
-                flag_end_turn_actions=flag_end_middle_turn_actions,
-                flag_reset_s_at_end_turn=self.reset_s_at_end_turn,
-                flag_monitor=flag_monitor,
-                num_ele_line=len(tracker_data.element_names),
-                line_length=tracker_data.line_length,
-                buffer_tbt_monitor=buffer_monitor,
-                offset_tbt_monitor=offset_monitor,
-                io_buffer=self.io_buffer.buffer,
-            )
+        profile_kwargs = self._element_profile_kernel_kwargs()
+        if _num_threads is None:
+            _num_threads = particles._capacity
+        # The number of threads is stored in the kernel object, which can be
+        # shared with other lines, and is used at launch on GPU contexts. The
+        # CPU kernels do not use it and run without holding the kernel lock.
+        if isinstance(self._context, xo.ContextCpu):
+            kernel_lock = nullcontext()
+        else:
+            kernel_lock = _kernel_lock
+        with kernel_lock:
+            track_kernel.description.n_threads = _num_threads
 
-        # Last turn, only if incomplete
-        if num_elements_last_turn > 0:
-            assert num_elements_last_turn > 0
+            # First turn
+            assert num_elements_first_turn >= 0
             track_kernel(
                 buffer=tracker_data._buffer.buffer,
                 tracker_data=tracker_data._element_ref_data,
                 particles=particles._xobject,
                 num_turns=1,
-                ele_start=0,
-                num_ele_track=num_elements_last_turn,
-                flag_end_turn_actions=False,
+                ele_start=ele_start,
+                num_ele_track=num_elements_first_turn,
+                flag_end_turn_actions=flag_end_first_turn_actions,
                 flag_reset_s_at_end_turn=self.reset_s_at_end_turn,
                 flag_monitor=flag_monitor,
                 num_ele_line=len(tracker_data.element_names),
@@ -1289,8 +1745,51 @@ class Tracker:
                 buffer_tbt_monitor=buffer_monitor,
                 offset_tbt_monitor=offset_monitor,
                 io_buffer=self.io_buffer.buffer,
+                **profile_kwargs,
             )
 
+            # Middle turns
+            if num_middle_turns > 0:
+                assert self.num_elements > 0
+                track_kernel(
+                    buffer=tracker_data._buffer.buffer,
+                    tracker_data=tracker_data._element_ref_data,
+                    particles=particles._xobject,
+                    num_turns=num_middle_turns,
+                    ele_start=0, # always full turn
+                    num_ele_track=self.num_elements, # always full turn
+                    flag_end_turn_actions=flag_end_middle_turn_actions,
+                    flag_reset_s_at_end_turn=self.reset_s_at_end_turn,
+                    flag_monitor=flag_monitor,
+                    num_ele_line=len(tracker_data.element_names),
+                    line_length=tracker_data.line_length,
+                    buffer_tbt_monitor=buffer_monitor,
+                    offset_tbt_monitor=offset_monitor,
+                    io_buffer=self.io_buffer.buffer,
+                    **profile_kwargs,
+                )
+
+            # Last turn, only if incomplete
+            if num_elements_last_turn > 0:
+                assert num_elements_last_turn > 0
+                track_kernel(
+                    buffer=tracker_data._buffer.buffer,
+                    tracker_data=tracker_data._element_ref_data,
+                    particles=particles._xobject,
+                    num_turns=1,
+                    ele_start=0,
+                    num_ele_track=num_elements_last_turn,
+                    flag_end_turn_actions=False,
+                    flag_reset_s_at_end_turn=self.reset_s_at_end_turn,
+                    flag_monitor=flag_monitor,
+                    num_ele_line=len(tracker_data.element_names),
+                    line_length=tracker_data.line_length,
+                    buffer_tbt_monitor=buffer_monitor,
+                    offset_tbt_monitor=offset_monitor,
+                    io_buffer=self.io_buffer.buffer,
+                    **profile_kwargs,
+                )
+
         self.record_last_track = monitor
 
     @staticmethod
@@ -1322,7 +1821,7 @@ class Tracker:
             monitor.ebe_mode = 1
             flag_monitor = 2
         elif isinstance(turn_by_turn_monitor, self.particles_monitor_class):
-            if turn_by_turn_monitor.ebe_mode == 1:
+            if turn_by_turn_monitor.ebe_mode > 0:
                 flag_monitor = 2
             else:
                 flag_monitor = 1
@@ -1347,15 +1846,7 @@ class Tracker:
         return tuple(sorted(items))
 
     def _config_to_headers(self):
-        headers = []
-        for k, v in self.config.items():
-            if not isinstance(v, bool):
-                headers.append(f'#define {k} {v}')
-            elif v is True:
-                headers.append(f'#define {k}')
-            else:
-                headers.append(f'#undef {k}')
-        return headers
+        return _config_to_headers(self.config)
 
     def _get_twiss_mask_markers(self):
         if hasattr(self._tracker_data_base, 'mask_markers_for_twiss'):
@@ -1367,15 +1858,125 @@ class Tracker:
         self._tracker_data_base.mask_markers_for_twiss = mask_twiss
         return mask_twiss
 
+    def _prepare_element_profiling(self):
+        if not self.config.get('XTRACK_PROFILE_ELEMENTS', False):
+            return
+
+        if not isinstance(self._context, xo.ContextCpu):
+            raise NotImplementedError(
+                'Element profiling is only available on CPU contexts')
+
+        record = getattr(self, '_element_profile_record', None)
+        if (record is None or record._buffer is not self.io_buffer
+                or len(record.time) != self.num_elements):
+            record = ElementProfileRecord(_buffer=self.io_buffer,
+                                          time=self.num_elements,
+                                          num_particles=self.num_elements)
+            self._element_profile_record = record
+
+    def _element_profile_kernel_kwargs(self):
+        # Location of the profile record, passed only to profiling kernels
+        if not self.config.get('XTRACK_PROFILE_ELEMENTS', False):
+            return {}
+        return {'offset_profile_record': self._element_profile_record._offset}
+
+    def _element_profile_classes(self):
+        if self.config.get('XTRACK_PROFILE_ELEMENTS', False):
+            return [ElementProfileRecord]
+        return []
+
+    def get_profile_table(self, by_class=False):
+        """
+        Get the time spent in the elements of the line, as recorded by the
+        track kernel when the tracker config flag `XTRACK_PROFILE_ELEMENTS`
+        is set (`line.config.XTRACK_PROFILE_ELEMENTS = True`). The data
+        accumulate over the tracking calls until `reset_profile` is called.
+
+        Parameters
+        ----------
+        by_class : bool
+            If True, the time is aggregated per element class.
+
+        Returns
+        -------
+        table : Table
+            Table with columns `name`, `element_type`, `time` (s),
+            `num_particles` (particles tracked through the element),
+            `time_per_particle` (s) and `fraction` (of the total time). The
+            attributes `total_time`, `num_particle_turns` and
+            `particle_turns_per_second` are also provided. On OpenMP contexts,
+            times are summed over the threads.
+        """
+
+        record = getattr(self, '_element_profile_record', None)
+        if record is None:
+            raise RuntimeError('No profile data available. Set '
+                               '`line.config.XTRACK_PROFILE_ELEMENTS = True` '
+                               'and track before calling this method.')
+
+        time = record.time.to_nparray().copy()
+        num_particles = record.num_particles.to_nparray().copy()
+        names = np.array(self.line.element_names)
+        element_type = np.array([
+            self.line.element_dict[nn].__class__.__name__ for nn in names])
+
+        if by_class:
+            names = np.array(sorted(set(element_type)))
+            time = np.array([np.sum(time[element_type == nn]) for nn in names])
+            num_particles = np.array([
+                np.sum(num_particles[element_type == nn]) for nn in names])
+            element_type = names.copy()
+
+        total_time = np.sum(time)
+        num_particle_turns = int(record.num_particle_turns)
+
+        data = {
+            'name': names,
+            'element_type': element_type,
+            'time': time,
+            'num_particles': num_particles,
+            'time_per_particle': time / np.maximum(num_particles, 1),
+            'fraction': time / (total_time if total_time > 0 else 1.),
+        }
+        out = xt.Table(data=data)
+        out._data['total_time'] = total_time
+        out._data['num_particle_turns'] = num_particle_turns
+        out._data['particle_turns_per_second'] = (
+            num_particle_turns / total_time if total_time > 0 else 0.)
+        return out
+
+    def reset_profile(self):
+        """
+        Reset the time and the particle counts recorded by the element
+        profiling, which otherwise accumulate over the tracking calls.
+        """
+        record = getattr(self, '_element_profile_record', None)
+        if record is None:
+            return
+        record.num_particle_turns = 0
+        record.time = np.zeros(len(record.time))
+        record.num_particles = np.zeros(len(record.num_particles),
+                                        dtype=np.int64)
+
     def get_track_kernel_and_data_for_present_config(self):
+        with _kernel_lock:
+            return self._get_track_kernel_and_data_for_present_config()
 
-        hash_config = self._hashable_config()
+    def _get_track_kernel_and_data_for_present_config(self):
 
-        if hash_config not in self.track_kernel:
-            new_kernel = self._build_kernel(compile=True)
-            self.track_kernel[hash_config] = new_kernel
+        self._prepare_element_profiling()
 
-        out_kernel = self.track_kernel[hash_config]
+        hash_config = self._hashable_config()
+
+        if self._is_specialized_kernel():
+            # Not stored in self.track_kernel, which can be shared with
+            # trackers of other lines
+            out_kernel = self._build_specialized_kernel()
+        else:
+            if hash_config not in self.track_kernel:
+                new_kernel = self._build_kernel(compile=True)
+                self.track_kernel[hash_config] = new_kernel
+            out_kernel = self.track_kernel[hash_config]
 
         if hash_config not in self._tracker_data_cache:
             kernel_element_classes = _element_classes_from_track_kernel(out_kernel)
@@ -1401,6 +2002,27 @@ class Tracker:
 
         return out_kernel, out_tracker_data
 
+    def _rebuild_prebuilt_kernel_for_present_config(self):
+        """
+        Make sure that the kernel of the present configuration is compiled
+        from the sources of the installed xtrack and not taken from the
+        prebuilt kernels, which can lag behind them (e.g. the
+        element-by-element modes of the particles monitor).
+        """
+        with _kernel_lock:
+            if self._is_specialized_kernel(): # never prebuilt
+                return
+            hash_config = self._hashable_config()
+            kernel = self.track_kernel.get(hash_config, None)
+            if (kernel is not None
+                    and not getattr(kernel, '_xtrack_prebuilt', False)):
+                return
+            # The kernel dictionary can be shared with other trackers
+            self._track_kernel = dict(self._track_kernel)
+            self._track_kernel[hash_config] = self._build_kernel(
+                compile=True, allow_prebuilt_kernels=False)
+            self._tracker_data_cache.pop(hash_config, None)
+
     @property
     def reset_s_at_end_turn(self):
         return self.line.reset_s_at_end_turn
@@ -1427,8 +2049,14 @@ class Tracker:
         # Remove the compiled kernels from the state
         state = self.__dict__.copy()
         state['_track_kernel'].clear()
+        state.pop('_track_lock', None)
+        state.pop('_last_track_info', None)
         return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_thread_state()
+
     def check_compatibility_with_prebuilt_kernels(self):
         from xsuite import get_suitable_kernel
         get_suitable_kernel(
@@ -1461,16 +2089,22 @@ class Tracker:
             t_turn < self.line._t_last_update_time_dependent_vars):
             self.line._t_last_update_time_dependent_vars = None
 
-        if (self.line._t_last_update_time_dependent_vars is None
+        if self._time_dependent_vars_table is not None:
+            # Precomputed values, no evaluation of the dependency graph
+            self.line._t_last_update_time_dependent_vars = t_turn
+            self._time_dependent_vars_table.apply(t_turn)
+        elif (self.line._t_last_update_time_dependent_vars is None
             or self.line.dt_update_time_dependent_vars is None
             or t_turn > self.line._t_last_update_time_dependent_vars
                         + self.line.dt_update_time_dependent_vars):
             self.line._t_last_update_time_dependent_vars = t_turn
             self.vars['t_turn_s'] = t_turn
+        else:
+            return
 
-            if self.line.energy_program is not None:
-                p0c = self.line.particle_ref._xobject.p0c[0]
-                particles.update_p0c_and_energy_deviations(p0c)
+        if self.line.energy_program is not None:
+            p0c = self.line.particle_ref._xobject.p0c[0]
+            particles.update_p0c_and_energy_deviations(p0c)
 
     def _handle_log(self, _session_to_resume, particles, log):
         if _session_to_resume is not None:
@@ -1558,6 +2192,94 @@ class TrackerPartNonCollective:
                 f'{self.ele_stop_in_tracker})')
 
 
+def _compact_lost_particles(particles, num_tracked, threshold):
+    # Move the active particles at the beginning of the arrays (together with
+    # their random generator state) if the fraction of lost particles among
+    # the tracked ones exceeds the threshold. Returns the number of particles
+    # that need to be tracked from now on.
+    ctx2np = particles._context.nparray_from_context_array
+    n_active = int(np.sum(ctx2np(particles.state) > 0))
+    if num_tracked > 0 and 1 - n_active / num_tracked >= threshold:
+        particles.reorganize(include_rng_state=True)
+        num_tracked = n_active
+    return num_tracked
+
+def _stop_condition_fired(particles, stop_condition):
+    if callable(stop_condition):
+        return bool(stop_condition(particles))
+
+    ctx2np = particles._context.nparray_from_context_array
+    state = ctx2np(particles.state)
+    n_active = int(np.sum(state > 0))
+    if stop_condition == 'all_lost':
+        return n_active == 0
+
+    if isinstance(stop_condition, str):
+        raise ValueError(f'Invalid stop condition `{stop_condition}`')
+
+    n_used = int(np.sum(state > xt.particles.LAST_INVALID_STATE))
+    if n_used == 0:
+        return True
+    return 1 - n_active / n_used >= float(stop_condition)
+
+def _truncate_monitor(monitor, num_turns):
+    # Return a copy of the monitor containing only the first `num_turns`
+    # recorded turns
+    num_turns = min(num_turns, monitor.stop_at_turn - monitor.start_at_turn)
+    new_monitor = monitor.__class__(
+        _context=monitor._buffer.context,
+        start_at_turn=monitor.start_at_turn,
+        stop_at_turn=monitor.start_at_turn + num_turns,
+        particle_id_range=(monitor.part_id_start, monitor.part_id_end),
+    )
+    new_monitor.ebe_mode = monitor.ebe_mode
+    ctx = monitor._buffer.context
+    n_cols_old = monitor.stop_at_turn - monitor.start_at_turn
+    n_rows = monitor.part_id_end - monitor.part_id_start
+    with new_monitor.data._bypass_linked_vars():
+        for _, nn in monitor._ParticlesClass.per_particle_vars:
+            vv = ctx.nparray_from_context_array(getattr(monitor.data, nn))
+            vv = vv.reshape(n_rows, n_cols_old)[:, :num_turns].flatten()
+            getattr(new_monitor.data, nn)[:] = ctx.nparray_to_context_array(vv)
+    return new_monitor
+
+def _config_to_headers(config):
+    headers = []
+    for k, v in config.items():
+        if not isinstance(v, bool):
+            headers.append(f'#define {k} {v}')
+        elif v is True:
+            headers.append(f'#define {k}')
+        else:
+            headers.append(f'#undef {k}')
+    return headers
+
+def _element_switch_cases_source(kernel_element_classes):
+    # Cases of the switch on the element type id used in the track kernels
+    src_lines = []
+    for ii, cc in enumerate(kernel_element_classes):
+        ccnn = cc.__name__.replace("Data", "")
+        src_lines.append(
+            f"""
+                        case {ii}:
+"""
+        )
+        if ccnn == "Drift":
+            src_lines.append(
+                """
+                            #ifdef XTRACK_GLOBAL_XY_LIMIT
+                            global_aperture_check(&lpart);
+                            #endif
+
+                            """
+            )
+        src_lines.append(
+            f"""
+                            {ccnn}_track_local_particle_with_transformations(({ccnn}Data) el, &lpart);
+                            break;"""
+        )
+    return src_lines
+
 def _element_classes_from_track_kernel(kernel):
     assert kernel.description.args[1].name == 'tracker_data'
     kernel_tracker_data_type = kernel.description.args[1].atype
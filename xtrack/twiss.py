@@ -3,10 +3,12 @@
 # Copyright (c) CERN, 2021.                 #
 # ######################################### #
 
+import hashlib
 import logging
 
 import io
 import json
+from collections import OrderedDict
 from functools import partial
 import numpy as np
 from scipy.constants import c as clight
@@ -24,6 +26,8 @@ import xobjects as xo
 from xdeps import Table
 
 from . import linear_normal_form as lnf
+from .linear_maps import (compute_element_linear_maps, cumulative_matrix_products,
+                          get_element_map_params)
 from .general import _print
 from .twissplot import TwissPlot
 
@@ -36,8 +40,12 @@ DEFAULT_STEPS_R_MATRIX = {
 }
 
 DEFAULT_CO_SEARCH_TOL = [1e-11, 1e-11, 1e-11, 1e-11, 1e-5, 1e-9]
+DEFAULT_CO_SEARCH_NEWTON_TOL = [1e-12, 1e-12, 1e-12, 1e-12, 1e-12, 1e-12]
+DEFAULT_CO_SEARCH_NEWTON_MAX_ITERATIONS = 20
 
 DEFAULT_MATRIX_RESPONSIVENESS_TOL = 1e-15
+
+DEFAULT_STREAMING_CHUNK_SIZE = 10000
 DEFAULT_MATRIX_STABILITY_TOL = 2e-3
 DEFAULT_NUM_TURNS_SEARCH_T_REV = 10
 
@@ -54,10 +62,22 @@ VARS_FOR_TWISS_INIT_GENERATION = [
 
 CYCLICAL_QUANTITIES = ['mux', 'muy', 'dzeta', 's']
 
+VARS_HIDDEN_IN_THIN_GROUPS = [
+    'x', 'px', 'y', 'py', 'zeta', 'delta', 'ptau',
+    'betx', 'bety', 'alfx', 'alfy', 'gamx', 'gamy',
+    'betx1', 'bety1', 'betx2', 'bety2',
+    'dx', 'dpx', 'dy', 'dzeta', 'dpy',
+]
+
 NORMAL_STRENGTHS_FROM_ATTR=['k0l', 'k1l', 'k2l', 'k3l', 'k4l', 'k5l']
 SKEW_STRENGTHS_FROM_ATTR=['k0sl', 'k1sl', 'k2sl', 'k3sl', 'k4sl', 'k5sl']
 OTHER_FIELDS_FROM_ATTR=['angle_rad', 'rot_s_rad', 'hkick', 'vkick', 'ks', 'length']
 OTHER_FIELDS_FROM_TABLE=['element_type', 'isthick', 'parent_name']
+STRENGTHS_COLUMNS=(NORMAL_STRENGTHS_FROM_ATTR + SKEW_STRENGTHS_FROM_ATTR
+                   + OTHER_FIELDS_FROM_ATTR + OTHER_FIELDS_FROM_TABLE)
+CHROMATIC_COLUMNS=['dmux', 'dmuy', 'bx_chrom', 'by_chrom', 'ax_chrom', 'ay_chrom',
+                   'wx_chrom', 'wy_chrom', 'ddx', 'ddpx', 'ddy', 'ddpy']
+CHROMATIC_SCALARS=['dqx', 'dqy', 'ddqx', 'ddqy']
 SIGN_FLIP_FOR_ATTR_REVERSE=['k0l', 'k2l', 'k4l', 'k1sl', 'k3sl', 'k5sl', 'vkick', 'angle_rad']
 
 
@@ -107,7 +127,12 @@ def twiss_line(line, particle_ref=None, method=None,
         _keep_initial_particles=None,
         _initial_particles=None,
         _ebe_monitor=None,
+        _co_search_R_matrix=None,
         only_markers=None,
+        incremental=None,
+        engine=None,
+        co_search_method=None,
+        lazy_columns=None,
         ):
 
     """
@@ -172,6 +197,30 @@ def twiss_line(line, particle_ref=None, method=None,
     symplectify : bool, optional
         If True, the R matrix is symplectified before computing the linear normal
         form. Dafault is False.
+    incremental : bool, optional
+        If True, for twiss computations on a range with initial conditions
+        given at the start, the element-by-element state of the probe
+        particles is kept and, in the following calls with the same initial
+        conditions, the tracking is restarted from the first element whose
+        data have changed. Default is False.
+    engine : {'tracking', 'matrix'}, optional
+        Engine used to propagate the lattice functions. With 'tracking' the
+        probe particles are tracked through the line. With 'matrix' only the
+        closed orbit is tracked and the lattice functions are obtained from
+        the products of the linear maps of the elements around it (computed
+        analytically for the most common elements and by finite differences
+        for the others). Default is 'tracking'.
+    co_search_method : {'optimize', 'newton'}, optional
+        Method used for the closed orbit search. With 'newton' the orbit guess
+        is tracked together with the finite-difference probes, so that each
+        iteration also provides the one-turn matrix, which is then used
+        directly for the twiss. Default is 'optimize'.
+    lazy_columns : bool, optional
+        If True, the chromatic functions and the element strengths are
+        computed only when one of their columns (or of the related scalars,
+        e.g. `dqx`) is first accessed. The line must not be modified in the
+        meantime, otherwise an error is raised at the first access. Default is
+        False.
 
 
     Returns
@@ -316,6 +365,10 @@ def twiss_line(line, particle_ref=None, method=None,
     only_twiss_init=(only_twiss_init or False)
     only_markers=(only_markers or False)
     only_orbit=(only_orbit or False)
+    incremental=(incremental or False)
+    engine=(engine or 'tracking')
+    co_search_method=(co_search_method or 'optimize')
+    lazy_columns=(lazy_columns or False)
     compute_R_element_by_element=(compute_R_element_by_element or False)
     compute_lattice_functions=(compute_lattice_functions
                         if compute_lattice_functions is not None else True)
@@ -592,6 +645,8 @@ def twiss_line(line, particle_ref=None, method=None,
         method = '6d'
 
     assert method in ['6d', '4d'], 'Method must be `6d` or `4d`'
+    assert engine in ['tracking', 'matrix'], (
+        'Engine must be `tracking` or `matrix`')
 
     if isinstance(init, str):
         if init in ['preserve', 'preserve_start', 'preserve_end']:
@@ -624,7 +679,9 @@ def twiss_line(line, particle_ref=None, method=None,
             compute_R_element_by_element=compute_R_element_by_element,
             only_markers=only_markers,
             only_orbit=only_orbit,
-            periodic_mode=periodic_mode
+            periodic_mode=periodic_mode,
+            co_search_method=co_search_method,
+            co_search_R_matrix=_co_search_R_matrix,
             )
     else:
         # force
@@ -659,7 +716,9 @@ def twiss_line(line, particle_ref=None, method=None,
         _keep_tracking_data=_keep_tracking_data,
         _keep_initial_particles=_keep_initial_particles,
         _initial_particles=_initial_particles,
-        _ebe_monitor=_ebe_monitor)
+        _ebe_monitor=_ebe_monitor,
+        incremental=incremental,
+        engine=engine)
 
     if not skip_global_quantities and not only_orbit:
         twiss_res._data['R_matrix'] = R_matrix
@@ -672,11 +731,20 @@ def twiss_line(line, particle_ref=None, method=None,
         twiss_res._data['eigenvalues'] = eigenvalues.copy()
         twiss_res._data['rotation_matrix'] = Rot.copy()
 
+    if lazy_columns and (num_turns > 1 or reverse or at_elements is not None):
+        # The table is post-processed as a whole
+        lazy_columns = False
+
     if (not only_orbit and (
         (compute_chromatic_properties is True)
         or (compute_chromatic_properties is None and periodic))):
 
-        cols_chrom, scalars_chrom = _compute_chromatic_functions(
+        on_momentum_twiss_res = twiss_res
+        if lazy_columns:
+            # The table is modified in place below
+            on_momentum_twiss_res = _OnMomentumTwissData(twiss_res)
+
+        compute_chrom = lambda: _compute_chromatic_functions(
             line=line,
             init=init,
             delta_chrom=delta_chrom,
@@ -688,7 +756,7 @@ def twiss_line(line, particle_ref=None, method=None,
             use_full_inverse=use_full_inverse,
             nemitt_x=nemitt_x,
             nemitt_y=nemitt_y,
-            on_momentum_twiss_res=twiss_res,
+            on_momentum_twiss_res=on_momentum_twiss_res,
             r_sigma=r_sigma,
             delta_disp=delta_disp,
             zeta_disp=zeta_disp,
@@ -698,10 +766,13 @@ def twiss_line(line, particle_ref=None, method=None,
             hide_thin_groups=hide_thin_groups,
             only_markers=only_markers,
             periodic=periodic,
-            periodic_mode=periodic_mode)
-        twiss_res._data.update(cols_chrom)
-        twiss_res._data.update(scalars_chrom)
-        twiss_res._col_names += list(cols_chrom.keys())
+            periodic_mode=periodic_mode,
+            incremental=incremental,
+            engine=engine)
+        _add_columns_to_twiss_res(twiss_res, line, compute_chrom,
+                                  columns=CHROMATIC_COLUMNS,
+                                  scalars=CHROMATIC_SCALARS,
+                                  lazy=lazy_columns)
 
     if eneloss_and_damping and not only_orbit:
         assert 'R_matrix' in twiss_res._data
@@ -770,7 +841,10 @@ def twiss_line(line, particle_ref=None, method=None,
         twiss_res._data['values_at'] = 'entry'
 
     if strengths:
-        _add_strengths_to_twiss_res(twiss_res, line)
+        names = list(twiss_res.name)
+        _add_columns_to_twiss_res(twiss_res, line,
+            lambda: (_get_strengths_for_names(line, names), {}),
+            columns=STRENGTHS_COLUMNS, scalars=[], lazy=lazy_columns)
 
     twiss_res._data['method'] = method
     twiss_res._data['radiation_method'] = radiation_method
@@ -837,7 +911,9 @@ def _twiss_open(line, init,
                       _keep_tracking_data=False,
                       _keep_initial_particles=False,
                       _initial_particles=None,
-                      _ebe_monitor=None):
+                      _ebe_monitor=None,
+                      incremental=False,
+                      engine='tracking'):
 
     if init.reference_frame == 'reverse':
         init = init.reverse()
@@ -874,27 +950,24 @@ def _twiss_open(line, init,
 
     ctx2np = line._context.nparray_from_context_array
 
-    gemitt_x = nemitt_x/particle_on_co._xobject.beta0[0]/particle_on_co._xobject.gamma0[0]
-    gemitt_y = nemitt_y/particle_on_co._xobject.beta0[0]/particle_on_co._xobject.gamma0[0]
-    scale_transverse_x = np.sqrt(gemitt_x)*r_sigma
-    scale_transverse_y = np.sqrt(gemitt_y)*r_sigma
-    scale_longitudinal = delta_disp
-    scale_eigen = min(scale_transverse_x, scale_transverse_y, scale_longitudinal)
+    scale_eigen = _twiss_probes_scale_eigen(particle_on_co, nemitt_x, nemitt_y,
+                                            r_sigma, delta_disp)
+
+    # The matrix engine tracks only the closed orbit
+    use_matrix_engine = (engine == 'matrix' and twiss_orientation == 'forward'
+                         and _initial_particles is None and _ebe_monitor is None)
 
     context = line._context
     if _initial_particles is not None: # used in match
         part_for_twiss = _initial_particles.copy()
     else:
         import xpart
-        part_for_twiss = xpart.build_particles(_context=context,
-            particle_ref=particle_on_co, mode='shift',
-            x     = [0] + list(W_matrix[0, :] * -scale_eigen) + list(W_matrix[0, :] * scale_eigen),
-            px    = [0] + list(W_matrix[1, :] * -scale_eigen) + list(W_matrix[1, :] * scale_eigen),
-            y     = [0] + list(W_matrix[2, :] * -scale_eigen) + list(W_matrix[2, :] * scale_eigen),
-            py    = [0] + list(W_matrix[3, :] * -scale_eigen) + list(W_matrix[3, :] * scale_eigen),
-            zeta  = [0] + list(W_matrix[4, :] * -scale_eigen) + list(W_matrix[4, :] * scale_eigen),
-            pzeta = [0] + list(W_matrix[5, :] * -scale_eigen) + list(W_matrix[5, :] * scale_eigen),
-            )
+        if use_matrix_engine:
+            part_for_twiss = xpart.build_particles(_context=context,
+                particle_ref=particle_on_co, mode='shift', x=[0])
+        else:
+            part_for_twiss = _build_twiss_probes(context, particle_on_co,
+                                                 W_matrix, scale_eigen)
 
         if twiss_orientation == 'forward':
             part_for_twiss.at_element = start
@@ -922,14 +995,27 @@ def _twiss_open(line, init,
     else:
         ele_stop_track = end + 1 # to include the last element
 
-    line.track(part_for_twiss, turn_by_turn_monitor=_monitor,
-                ele_start=start,
-                ele_stop=ele_stop_track,
-                backtrack=(twiss_orientation == 'backward'))
+    if use_matrix_engine:
+        td_base = line.tracker._tracker_data_base
+        line.track(part_for_twiss,
+                   turn_by_turn_monitor=getattr(td_base,
+                        '_reusable_ebe_monitor_for_matrix_twiss', 'ONE_TURN_EBE'),
+                   ele_start=start,
+                   ele_stop=ele_stop_track)
+        td_base._reusable_ebe_monitor_for_matrix_twiss = line.record_last_track
+    elif (incremental and twiss_orientation == 'forward'
+            and _ebe_monitor is None):
+        part_for_twiss = _track_twiss_probes_incremental(
+            line, part_for_twiss, ele_start=start, ele_stop=ele_stop_track)
+    else:
+        line.track(part_for_twiss, turn_by_turn_monitor=_monitor,
+                    ele_start=start,
+                    ele_stop=ele_stop_track,
+                    backtrack=(twiss_orientation == 'backward'))
 
-    # We keep the monitor to speed up future calls (attached to tracker data
-    # so that it is trashed if number of elements changes)
-    line.tracker._tracker_data_base._reusable_ebe_monitor_for_twiss = line.record_last_track
+        # We keep the monitor to speed up future calls (attached to tracker data
+        # so that it is trashed if number of elements changes)
+        line.tracker._tracker_data_base._reusable_ebe_monitor_for_twiss = line.record_last_track
 
     if not _continue_if_lost:
         assert np.all(ctx2np(part_for_twiss.state) == 1), (
@@ -956,42 +1042,29 @@ def _twiss_open(line, init,
           + f'(state {np.unique(recorded_state)}, '
           + f'at element {np.unique(line.record_last_track.at_element[:, i_start:i_stop+1].copy())})')
 
-    x_co = line.record_last_track.x[0, i_start:i_stop+1].copy()
-    y_co = line.record_last_track.y[0, i_start:i_stop+1].copy()
-    px_co = line.record_last_track.px[0, i_start:i_stop+1].copy()
-    py_co = line.record_last_track.py[0, i_start:i_stop+1].copy()
-    zeta_co = line.record_last_track.zeta[0, i_start:i_stop+1].copy()
-    delta_co = np.array(line.record_last_track.delta[0, i_start:i_stop+1].copy())
-    ptau_co = np.array(line.record_last_track.ptau[0, i_start:i_stop+1].copy())
-    s_co = line.record_last_track.s[0, i_start:i_stop+1].copy()
-    kin_px_co = line.record_last_track.kin_px[0, i_start:i_stop+1].copy()
-    kin_py_co = line.record_last_track.kin_py[0, i_start:i_stop+1].copy()
-    kin_ps_co = line.record_last_track.kin_ps[0, i_start:i_stop+1].copy()
-    kin_xprime_co = line.record_last_track.kin_xprime[0, i_start:i_stop+1].copy()
-    kin_yprime_co = line.record_last_track.kin_yprime[0, i_start:i_stop+1].copy()
-
-    Ws = np.zeros(shape=(len(s_co), 6, 6), dtype=np.float64)
-    Ws[:, 0, :] = 0.5 * (line.record_last_track.x[1:7, i_start:i_stop+1] - x_co).T / scale_eigen
-    Ws[:, 1, :] = 0.5 * (line.record_last_track.px[1:7, i_start:i_stop+1] - px_co).T / scale_eigen
-    Ws[:, 2, :] = 0.5 * (line.record_last_track.y[1:7, i_start:i_stop+1] - y_co).T / scale_eigen
-    Ws[:, 3, :] = 0.5 * (line.record_last_track.py[1:7, i_start:i_stop+1] - py_co).T / scale_eigen
-    Ws[:, 4, :] = 0.5 * (line.record_last_track.zeta[1:7, i_start:i_stop+1] - zeta_co).T / scale_eigen
-    Ws[:, 5, :] = 0.5 * (line.record_last_track.ptau[1:7, i_start:i_stop+1] - ptau_co).T / particle_on_co._xobject.beta0[0] / scale_eigen
-
-    Ws[:, 0, :] -= 0.5 * (line.record_last_track.x[7:13, i_start:i_stop+1] - x_co).T / scale_eigen
-    Ws[:, 1, :] -= 0.5 * (line.record_last_track.px[7:13, i_start:i_stop+1] - px_co).T / scale_eigen
-    Ws[:, 2, :] -= 0.5 * (line.record_last_track.y[7:13, i_start:i_stop+1] - y_co).T / scale_eigen
-    Ws[:, 3, :] -= 0.5 * (line.record_last_track.py[7:13, i_start:i_stop+1] - py_co).T / scale_eigen
-    Ws[:, 4, :] -= 0.5 * (line.record_last_track.zeta[7:13, i_start:i_stop+1] - zeta_co).T / scale_eigen
-    Ws[:, 5, :] -= 0.5 * (line.record_last_track.ptau[7:13, i_start:i_stop+1] - ptau_co).T / particle_on_co._xobject.beta0[0] / scale_eigen
-
-    dzeta = (((line.record_last_track.zeta[6, i_start:i_stop+1] - zeta_co).T
-            - (line.record_last_track.zeta[12, i_start:i_stop+1] - zeta_co).T )
-            / ((line.record_last_track.delta[6, i_start:i_stop+1] - delta_co).T
-            - (line.record_last_track.delta[12, i_start:i_stop+1] - delta_co).T))
-
-    dzeta -= dzeta[0]
-    dzeta = np.array(dzeta)
+    orbit_co = _twiss_orbit_from_record(line.record_last_track,
+                                        slice(i_start, i_stop + 1))
+    x_co = orbit_co['x']
+    y_co = orbit_co['y']
+    px_co = orbit_co['px']
+    py_co = orbit_co['py']
+    zeta_co = orbit_co['zeta']
+    delta_co = orbit_co['delta']
+    ptau_co = orbit_co['ptau']
+    s_co = orbit_co['s']
+    kin_px_co = orbit_co['kin_px']
+    kin_py_co = orbit_co['kin_py']
+    kin_ps_co = orbit_co['kin_ps']
+    kin_xprime_co = orbit_co['kin_xprime']
+    kin_yprime_co = orbit_co['kin_yprime']
+
+    if use_matrix_engine:
+        Ws, dzeta = _propagate_twiss_matrix(line, particle_on_co, W_matrix,
+                                            i_start, i_stop, ptau_co, delta_co)
+    else:
+        Ws, dzeta = _W_matrices_from_record(line.record_last_track,
+                        slice(i_start, i_stop + 1), orbit_co,
+                        particle_on_co._xobject.beta0[0], scale_eigen)
 
     name_co = np.array(line._element_names_unique[i_start:i_stop] + ('_end_point',))
 
@@ -1033,14 +1106,7 @@ def _twiss_open(line, init,
         extra_data['_initial_particles'] = part_for_twiss0.copy()
 
     if hide_thin_groups:
-        _vars_hide_changes = [
-        'x', 'px', 'y', 'py', 'zeta', 'delta', 'ptau',
-        'betx', 'bety', 'alfx', 'alfy', 'gamx', 'gamy',
-        'betx1', 'bety1', 'betx2', 'bety2',
-        'dx', 'dpx', 'dy', 'dzeta', 'dpy',
-        ]
-
-        for key in _vars_hide_changes:
+        for key in VARS_HIDDEN_IN_THIN_GROUPS:
             if key in twiss_res_element_by_element:
                 twiss_res_element_by_element[key][i_replace] = np.nan
 
@@ -1058,6 +1124,139 @@ def _twiss_open(line, init,
     return twiss_res
 
 
+def _twiss_probes_scale_eigen(particle_on_co, nemitt_x, nemitt_y, r_sigma,
+                              delta_disp):
+    gemitt_x = nemitt_x/particle_on_co._xobject.beta0[0]/particle_on_co._xobject.gamma0[0]
+    gemitt_y = nemitt_y/particle_on_co._xobject.beta0[0]/particle_on_co._xobject.gamma0[0]
+    scale_transverse_x = np.sqrt(gemitt_x)*r_sigma
+    scale_transverse_y = np.sqrt(gemitt_y)*r_sigma
+    scale_longitudinal = delta_disp
+    return min(scale_transverse_x, scale_transverse_y, scale_longitudinal)
+
+def _build_twiss_probes(context, particle_on_co, W_matrix, scale_eigen):
+    # Particle on the closed orbit followed by the probes along the
+    # eigenvectors (W_matrix columns) with negative and positive amplitude
+    import xpart
+    return xpart.build_particles(_context=context,
+        particle_ref=particle_on_co, mode='shift',
+        x     = [0] + list(W_matrix[0, :] * -scale_eigen) + list(W_matrix[0, :] * scale_eigen),
+        px    = [0] + list(W_matrix[1, :] * -scale_eigen) + list(W_matrix[1, :] * scale_eigen),
+        y     = [0] + list(W_matrix[2, :] * -scale_eigen) + list(W_matrix[2, :] * scale_eigen),
+        py    = [0] + list(W_matrix[3, :] * -scale_eigen) + list(W_matrix[3, :] * scale_eigen),
+        zeta  = [0] + list(W_matrix[4, :] * -scale_eigen) + list(W_matrix[4, :] * scale_eigen),
+        pzeta = [0] + list(W_matrix[5, :] * -scale_eigen) + list(W_matrix[5, :] * scale_eigen),
+        )
+
+def _twiss_orbit_from_record(record, cols, i_part=0):
+    # Orbit of the particle i_part (first particle of a set of twiss probes,
+    # on the closed orbit) from an element-by-element monitor, at the records
+    # selected by cols
+    out = {}
+    for nn in ['x', 'px', 'y', 'py', 'zeta', 'delta', 'ptau', 's',
+               'kin_px', 'kin_py', 'kin_ps', 'kin_xprime', 'kin_yprime']:
+        out[nn] = np.array(getattr(record, nn)[i_part, cols].copy())
+    return out
+
+def _W_matrices_from_record(record, cols, orbit_co, beta0, scale_eigen,
+                            i_part=0):
+    # W matrices and dzeta from the probes built by _build_twiss_probes
+    # (starting at particle i_part)
+
+    x_co = orbit_co['x']
+    px_co = orbit_co['px']
+    y_co = orbit_co['y']
+    py_co = orbit_co['py']
+    zeta_co = orbit_co['zeta']
+    delta_co = orbit_co['delta']
+    ptau_co = orbit_co['ptau']
+
+    probes = slice(i_part, i_part + 13)
+    rec_x = record.x[probes, cols]
+    rec_px = record.px[probes, cols]
+    rec_y = record.y[probes, cols]
+    rec_py = record.py[probes, cols]
+    rec_zeta = record.zeta[probes, cols]
+    rec_delta = record.delta[probes, cols]
+    rec_ptau = record.ptau[probes, cols]
+
+    Ws = np.zeros(shape=(len(x_co), 6, 6), dtype=np.float64)
+    Ws[:, 0, :] = 0.5 * (rec_x[1:7] - x_co).T / scale_eigen
+    Ws[:, 1, :] = 0.5 * (rec_px[1:7] - px_co).T / scale_eigen
+    Ws[:, 2, :] = 0.5 * (rec_y[1:7] - y_co).T / scale_eigen
+    Ws[:, 3, :] = 0.5 * (rec_py[1:7] - py_co).T / scale_eigen
+    Ws[:, 4, :] = 0.5 * (rec_zeta[1:7] - zeta_co).T / scale_eigen
+    Ws[:, 5, :] = 0.5 * (rec_ptau[1:7] - ptau_co).T / beta0 / scale_eigen
+
+    Ws[:, 0, :] -= 0.5 * (rec_x[7:13] - x_co).T / scale_eigen
+    Ws[:, 1, :] -= 0.5 * (rec_px[7:13] - px_co).T / scale_eigen
+    Ws[:, 2, :] -= 0.5 * (rec_y[7:13] - y_co).T / scale_eigen
+    Ws[:, 3, :] -= 0.5 * (rec_py[7:13] - py_co).T / scale_eigen
+    Ws[:, 4, :] -= 0.5 * (rec_zeta[7:13] - zeta_co).T / scale_eigen
+    Ws[:, 5, :] -= 0.5 * (rec_ptau[7:13] - ptau_co).T / beta0 / scale_eigen
+
+    dzeta = (((rec_zeta[6] - zeta_co).T
+            - (rec_zeta[12] - zeta_co).T )
+            / ((rec_delta[6] - delta_co).T
+            - (rec_delta[12] - delta_co).T))
+
+    dzeta -= dzeta[0]
+    dzeta = np.array(dzeta)
+
+    return Ws, dzeta
+
+def _propagate_twiss_matrix(line, particle_on_co, W_matrix, i_start, i_stop,
+                            ptau_co, delta_co):
+
+    monitor = line.record_last_track
+    element_maps = compute_element_linear_maps(line, monitor, i_start, i_stop,
+                        particle_template=particle_on_co,
+                        element_map_params=_get_element_map_params_cached(line))
+    line.tracker.record_last_track = monitor # might be reset by single element tracking
+
+    Ws = cumulative_matrix_products(element_maps, W_matrix)
+
+    # Derivative of zeta w.r.t. delta along the longitudinal eigenvector
+    beta0 = particle_on_co._xobject.beta0[0]
+    ddelta_dpzeta = (1 + beta0 * ptau_co) / (1 + delta_co)
+    dzeta = Ws[:, 4, 5] / (Ws[:, 5, 5] * ddelta_dpzeta)
+    dzeta -= dzeta[0]
+
+    return Ws, dzeta
+
+def _get_element_map_params_cached(line):
+
+    # The parameters are extracted again only for the elements whose data in
+    # the tracker buffer have changed since the previous call
+    tracker = line.tracker
+    td_base = tracker._tracker_data_base
+    element_hashes = _element_data_hashes(tracker)
+    if element_hashes is None:
+        return get_element_map_params(line)
+
+    config_key = tracker._hashable_config()
+
+    cached = getattr(td_base, '_element_map_params_for_twiss', None)
+    if cached is None or cached['config'] != config_key:
+        td_base._element_map_params_for_twiss = {
+            'config': config_key,
+            'element_hashes': element_hashes,
+            'params': get_element_map_params(line),
+        }
+        return td_base._element_map_params_for_twiss['params']
+
+    owners = _element_slices_in_buffer(tracker)[2]
+    changed = owners[cached['element_hashes'] != element_hashes]
+    if len(changed) > 0:
+        names = td_base._element_names
+        changed_names = set(names[ii] for ii in changed)
+        positions = [ii for ii, nn in enumerate(names) if nn in changed_names]
+        new_params = get_element_map_params(line, positions)
+        for ii, pp in zip(positions, new_params):
+            cached['params'][ii] = pp
+        cached['element_hashes'] = element_hashes
+
+    return cached['params']
+
 def _compute_lattice_functions(Ws, use_full_inverse, s_co):
 
     # For removal ot thin groups of elements
@@ -1083,20 +1282,10 @@ def _compute_lattice_functions(Ws, use_full_inverse, s_co):
     phiy = np.arctan2(Ws[:, 2, 3], Ws[:, 2, 2])
     phizeta = np.arctan2(Ws[:, 4, 5], Ws[:, 4, 4])
 
-    v1 = Ws[:, :, 0] + 1j * Ws[:, :, 1]
-    v2 = Ws[:, :, 2] + 1j * Ws[:, :, 3]
-    v3 = Ws[:, :, 4] + 1j * Ws[:, :, 5]
-
-    for ii in range(6):
-        v1[:, ii] *= np.exp(-1j * phix)
-        v2[:, ii] *= np.exp(-1j * phiy)
-        v3[:, ii] *= np.exp(-1j * phizeta)
-    Ws[:, :, 0] = np.real(v1)
-    Ws[:, :, 1] = np.imag(v1)
-    Ws[:, :, 2] = np.real(v2)
-    Ws[:, :, 3] = np.imag(v2)
-    Ws[:, :, 4] = np.real(v3)
-    Ws[:, :, 5] = np.imag(v3)
+    vv = Ws[:, :, 0::2] + 1j * Ws[:, :, 1::2]
+    vv *= np.exp(-1j * np.array([phix, phiy, phizeta]).T)[:, np.newaxis, :]
+    Ws[:, :, 0::2] = np.real(vv)
+    Ws[:, :, 1::2] = np.imag(vv)
 
     # Computation of twiss parameters
     if use_full_inverse:
@@ -1188,6 +1377,134 @@ def _compute_lattice_functions(Ws, use_full_inverse, s_co):
     return res, i_replace
 
 
+MAX_INCREMENTAL_TWISS_STATES = 4
+
+def _track_twiss_probes_incremental(line, part_for_twiss, ele_start, ele_stop):
+
+    # The element-by-element data of the probe particles are kept in a monitor
+    # owned by the incremental state. In the following calls with the same
+    # initial particles, the tracking is restarted from the first element
+    # whose data have changed (identified by comparing digests of the data of
+    # each element in the tracker buffer with those of the previous call).
+
+    tracker = line.tracker
+    context = line._context
+    td_base = tracker._tracker_data_base
+
+    # Attached to tracker data so that it is trashed if the tracker is rebuilt
+    if not hasattr(td_base, '_incremental_twiss_states'):
+        td_base._incremental_twiss_states = OrderedDict()
+    states = td_base._incremental_twiss_states
+
+    key = (ele_start, ele_stop, tracker._hashable_config(),
+           _particles_fingerprint(part_for_twiss))
+    hashes_now = _element_data_hashes(tracker)
+
+    state = states.get(key, None)
+    i_restart = ele_start
+    if state is not None:
+        i_changed = _first_changed_element(tracker, state['element_hashes'],
+                                           hashes_now)
+        if i_changed is not None:
+            i_restart = max(i_changed, ele_start)
+
+    num_elements = len(td_base._element_names)
+    i_end = num_elements if ele_stop is None else ele_stop
+
+    if state is not None and i_restart >= i_end:
+        # Nothing changed in the range
+        states.move_to_end(key)
+        tracker.record_last_track = state['monitor']
+        return state['part_out'].copy()
+
+    if state is not None and i_restart > ele_start:
+        monitor = state['monitor']
+        part = part_for_twiss.copy()
+        with part._bypass_linked_vars():
+            for _, nn in part.per_particle_vars:
+                if not hasattr(monitor.data, nn):
+                    continue
+                getattr(part, nn)[:] = context.nparray_to_context_array(
+                    np.array(getattr(monitor, nn)[:, i_restart]))
+        line.track(part, turn_by_turn_monitor=monitor,
+                   ele_start=i_restart, ele_stop=ele_stop)
+    else:
+        part = part_for_twiss
+        line.track(part, turn_by_turn_monitor='ONE_TURN_EBE',
+                   ele_start=ele_start, ele_stop=ele_stop)
+
+    states[key] = {
+        'monitor': line.record_last_track,
+        'element_hashes': hashes_now,
+        'part_out': part.copy(),
+    }
+    states.move_to_end(key)
+    while len(states) > MAX_INCREMENTAL_TWISS_STATES:
+        states.popitem(last=False)
+
+    return part
+
+def _particles_fingerprint(particles):
+    ctx2np = particles._context.nparray_from_context_array
+    hh = hashlib.blake2b()
+    for _, nn in particles.per_particle_vars:
+        hh.update(np.ascontiguousarray(ctx2np(getattr(particles, nn))).data)
+    return hh.hexdigest()
+
+def _element_slices_in_buffer(tracker):
+    # Offsets and sizes in the tracker buffer of the data of the elements
+    # (one entry per distinct element, sorted by offset), with the index of
+    # the first element of the line using them
+    td_base = tracker._tracker_data_base
+    if hasattr(td_base, '_element_slices_for_twiss'):
+        return td_base._element_slices_for_twiss
+
+    first_position = {}
+    for ii, nn in enumerate(td_base._element_names):
+        xobj = td_base._element_dict[nn]._xobject
+        if xobj._buffer is not tracker._buffer:
+            td_base._element_slices_for_twiss = None
+            return None
+        if xobj._offset not in first_position:
+            first_position[xobj._offset] = (xobj._size, ii)
+
+    offsets = sorted(first_position.keys())
+    td_base._element_slices_for_twiss = (
+        np.array(offsets, dtype=np.int64),
+        np.array([first_position[oo][0] for oo in offsets], dtype=np.int64),
+        np.array([first_position[oo][1] for oo in offsets], dtype=np.int64))
+    return td_base._element_slices_for_twiss
+
+def _element_data_hashes(tracker):
+    # Digest of the data of each entry of _element_slices_in_buffer, None if
+    # the elements cannot be located in the tracker buffer
+    element_slices = _element_slices_in_buffer(tracker)
+    if element_slices is None:
+        return None
+
+    offsets, sizes, _ = element_slices
+    buffer = tracker._context.nparray_from_context_array(tracker._buffer.buffer)
+    if len(offsets) > 0 and offsets[-1] + sizes[-1] > len(buffer):
+        return None
+
+    data = memoryview(np.ascontiguousarray(buffer))
+    return np.frombuffer(b''.join(
+        hashlib.blake2b(data[oo:oo + ss], digest_size=8).digest()
+        for oo, ss in zip(offsets.tolist(), sizes.tolist())), dtype=np.uint64)
+
+def _first_changed_element(tracker, hashes_before, hashes_now):
+    # Returns the index of the first element whose data differ between the
+    # two sets of digests (the number of elements if no element changed) or
+    # None if the elements cannot be located in the buffer
+    if hashes_before is None or hashes_now is None:
+        return None
+
+    changed = hashes_before != hashes_now
+    if not np.any(changed):
+        return len(tracker._tracker_data_base._element_names)
+    owners = _element_slices_in_buffer(tracker)[2]
+    return int(np.min(owners[changed]))
+
 def _compute_global_quantities(line, twiss_res):
 
         s_vect = twiss_res['s']
@@ -1254,16 +1571,17 @@ def _compute_chromatic_functions(line, init, delta_chrom, steps_r_matrix,
                     hide_thin_groups=False,
                     only_markers=False,
                     periodic=False,
-                    periodic_mode=None):
+                    periodic_mode=None,
+                    incremental=False,
+                    engine='tracking'):
 
     if only_markers:
         raise NotImplementedError('only_markers not supported anymore')
 
     tw_chrom_res = []
     for dd in [-delta_chrom, delta_chrom]:
-        tw_init_chrom = init.copy()
-
         if periodic:
+            tw_init_chrom = init.copy()
             import xpart
             part_guess = xpart.build_particles(
                 _context=line._context,
@@ -1291,45 +1609,7 @@ def _compute_chromatic_functions(line, init, delta_chrom, steps_r_matrix,
                                     symplectify=symplectify)
             tw_init_chrom.W_matrix = WW_chrom
         else:
-            alfx = init.alfx
-            betx = init.betx
-            alfy = init.alfy
-            bety = init.bety
-            dx = init.dx
-            dy = init.dy
-            dpx = init.dpx
-            dpy = init.dpy
-            ddx = init.ddx
-            ddpx = init.ddpx
-            ddy = init.ddy
-            ddpy = init.ddpy
-            ax_chrom = init.ax_chrom
-            bx_chrom = init.bx_chrom
-            ay_chrom = init.ay_chrom
-            by_chrom = init.by_chrom
-
-            dbetx_dpzeta = bx_chrom * betx
-            dbety_dpzeta = by_chrom * bety
-            dalfx_dpzeta = ax_chrom + bx_chrom * alfx
-            dalfy_dpzeta = ay_chrom + by_chrom * alfy
-
-            tw_init_chrom.particle_on_co.x += dx * dd + 1/2 * ddx * dd**2
-            tw_init_chrom.particle_on_co.px += dpx * dd + 1/2 * ddpx * dd**2
-            tw_init_chrom.particle_on_co.y += dy * dd + 1/2 * ddy * dd**2
-            tw_init_chrom.particle_on_co.py += dpy * dd + 1/2 * ddpy * dd**2
-            tw_init_chrom.particle_on_co.delta += dd
-
-            twinit_aux = TwissInit(
-                alfx=alfx + dalfx_dpzeta * dd,
-                betx=betx + dbetx_dpzeta * dd,
-                alfy=alfy + dalfy_dpzeta * dd,
-                bety=bety + dbety_dpzeta * dd,
-                dx=dx + ddx * dd,
-                dpx=dpx + ddpx * dd,
-                dy=dy + ddy * dd,
-                dpy=dpy + ddpy * dd)
-            twinit_aux._complete(line, element_name=init.element_name)
-            tw_init_chrom.W_matrix = twinit_aux.W_matrix
+            tw_init_chrom = _off_momentum_twiss_init(line, init, dd)
 
         tw_chrom_res.append(
             _twiss_open(
@@ -1348,7 +1628,68 @@ def _compute_chromatic_functions(line, init, delta_chrom, steps_r_matrix,
                 _keep_tracking_data=False,
                 _keep_initial_particles=False,
                 _initial_particles=None,
-                _ebe_monitor=None))
+                _ebe_monitor=None,
+                incremental=incremental,
+                engine=engine))
+
+    return _chromatic_columns(tw_chrom_res, delta_chrom,
+                              on_momentum_twiss_res)
+
+
+def _off_momentum_twiss_init(line, init, dd):
+
+    # Initial conditions at momentum offset dd from the chromatic properties
+    # of an open twiss init
+
+    tw_init_chrom = init.copy()
+
+    alfx = init.alfx
+    betx = init.betx
+    alfy = init.alfy
+    bety = init.bety
+    dx = init.dx
+    dy = init.dy
+    dpx = init.dpx
+    dpy = init.dpy
+    ddx = init.ddx
+    ddpx = init.ddpx
+    ddy = init.ddy
+    ddpy = init.ddpy
+    ax_chrom = init.ax_chrom
+    bx_chrom = init.bx_chrom
+    ay_chrom = init.ay_chrom
+    by_chrom = init.by_chrom
+
+    dbetx_dpzeta = bx_chrom * betx
+    dbety_dpzeta = by_chrom * bety
+    dalfx_dpzeta = ax_chrom + bx_chrom * alfx
+    dalfy_dpzeta = ay_chrom + by_chrom * alfy
+
+    tw_init_chrom.particle_on_co.x += dx * dd + 1/2 * ddx * dd**2
+    tw_init_chrom.particle_on_co.px += dpx * dd + 1/2 * ddpx * dd**2
+    tw_init_chrom.particle_on_co.y += dy * dd + 1/2 * ddy * dd**2
+    tw_init_chrom.particle_on_co.py += dpy * dd + 1/2 * ddpy * dd**2
+    tw_init_chrom.particle_on_co.delta += dd
+
+    twinit_aux = TwissInit(
+        alfx=alfx + dalfx_dpzeta * dd,
+        betx=betx + dbetx_dpzeta * dd,
+        alfy=alfy + dalfy_dpzeta * dd,
+        bety=bety + dbety_dpzeta * dd,
+        dx=dx + ddx * dd,
+        dpx=dpx + ddpx * dd,
+        dy=dy + ddy * dd,
+        dpy=dpy + ddpy * dd)
+    twinit_aux._complete(line, element_name=init.element_name)
+    tw_init_chrom.W_matrix = twinit_aux.W_matrix
+
+    return tw_init_chrom
+
+
+def _chromatic_columns(tw_chrom_res, delta_chrom, on_momentum_twiss_res):
+
+    # Chromatic columns and scalars from the twiss at -delta_chrom and
+    # +delta_chrom
 
     dmux = (tw_chrom_res[1].mux - tw_chrom_res[0].mux)/(2*delta_chrom)
     dmuy = (tw_chrom_res[1].muy - tw_chrom_res[0].muy)/(2*delta_chrom)
@@ -1628,11 +1969,7 @@ def _compute_equilibrium_emittance_full(px_co, py_co, ptau_co, R_matrix_ebe,
     TT[:, 4, 4] = 1
     TT[:, 5, 5] = 1
 
-    TTinv = np.linalg.inv(TT)
-    TTinv0 = TTinv.copy()
-    for ii in range(6):
-        for jj in range(6):
-            TTinv0[:, ii, jj] = TTinv[0, ii, jj]
+    TTinv0 = np.linalg.inv(TT[0])
 
     RR_ebe_hat = TT @ RR_ebe @ TTinv0
     RR = RR_ebe_hat[-1, :, :]
@@ -1659,14 +1996,11 @@ def _compute_equilibrium_emittance_full(px_co, py_co, ptau_co, R_matrix_ebe,
 
     DSigma[:-1, 5, 5] = d_delta_sq_ave
 
-    RR_ebe_hat_inv = np.linalg.inv(RR_ebe_hat)
-
-    DSigma0 = np.zeros((6, 6))
-
     n_calc = d_delta_sq_ave.shape[0]
-    for ii in range(n_calc):
-        if d_delta_sq_ave[ii] > 0:
-            DSigma0 += RR_ebe_hat_inv[ii, :, :] @ DSigma[ii, :, :] @ RR_ebe_hat_inv[ii, :, :].T
+    mask_rad = d_delta_sq_ave > 0
+    RR_inv_rad = np.linalg.inv(RR_ebe_hat[:n_calc][mask_rad])
+    DSigma0 = np.einsum('nij,njk,nlk->il',
+                        RR_inv_rad, DSigma[:n_calc][mask_rad], RR_inv_rad)
 
     CC_split, _, RRR, reig = lnf.compute_linear_normal_form(Rot)
     reig_full = np.zeros_like(Rot, dtype=complex)
@@ -1710,10 +2044,8 @@ def _compute_equilibrium_emittance_full(px_co, py_co, ptau_co, R_matrix_ebe,
     eq_nemitt_y = float(eq_gemitt_y * (beta0 * gamma0))
     eq_nemitt_zeta = float(eq_gemitt_zeta * (beta0 * gamma0))
 
-    Sigma_norm = np.zeros_like(EE_norm, dtype=complex)
-    for ii in range(6):
-        for jj in range(6):
-            Sigma_norm[ii, jj] = EE_norm[ii, jj]/(1 - lam_eig_full[ii, ii]*lam_eig_full[jj, jj])
+    lam_eig_diag = np.diag(lam_eig_full)
+    Sigma_norm = EE_norm / (1 - np.outer(lam_eig_diag, lam_eig_diag))
 
     Sigma_at_start = (BB @ Sigma_norm @ BB.T).real
 
@@ -1740,6 +2072,114 @@ def _compute_equilibrium_emittance_full(px_co, py_co, ptau_co, R_matrix_ebe,
 class ClosedOrbitSearchError(Exception):
     pass
 
+
+class TwissCache:
+
+    '''
+    Cache of twiss results of a line with least-recently-used eviction. The
+    key is built from the twiss arguments, the values of the independent
+    variables, the tracker configuration, the reference particle and a hash of
+    the element data, so that any change of the element attributes (through
+    `element_refs`, knobs or direct writes) results in a new computation.
+    Twiss calls with arguments other than scalars, strings, sequences and
+    numpy arrays (e.g. particles or init objects) are not cached.
+
+    Each call returns a new table. The columns are shared with the cached
+    table and are read-only, the other objects (e.g. `particle_on_co`) are
+    copied, so that changes made by the caller do not affect later calls.
+    '''
+
+    def __init__(self, max_size=32):
+        assert max_size >= 1
+        self.max_size = max_size
+        self._tables = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __len__(self):
+        return len(self._tables)
+
+    def clear(self):
+        self._tables.clear()
+
+    def get(self, key):
+        if key is None or key not in self._tables:
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        self._tables.move_to_end(key)
+        return _copy_cached_table(self._tables[key])
+
+    def put(self, key, table):
+        if key is None:
+            return table
+        if isinstance(table, TwissTable):
+            table._compute_lazy_columns()
+        _make_table_read_only(table)
+        self._tables[key] = table
+        self._tables.move_to_end(key)
+        while len(self._tables) > self.max_size:
+            self._tables.popitem(last=False)
+        return _copy_cached_table(table)
+
+    @staticmethod
+    def key(line, twiss_kwargs):
+        kwargs_key = []
+        for kk in sorted(twiss_kwargs.keys()):
+            vv = _hashable_twiss_arg(twiss_kwargs[kk])
+            if vv is _NOT_HASHABLE:
+                return None
+            kwargs_key.append((kk, vv))
+
+        var_values = line._xdeps_vref._owner
+        vars_key = tuple((kk, _hashable_twiss_arg(var_values[kk]))
+                         for kk in line.vars.get_independent_vars())
+
+        tracker = line.tracker
+        ctx2np = tracker._context.nparray_from_context_array
+        element_data_hash = hashlib.blake2b(
+            ctx2np(tracker._buffer.buffer).data).hexdigest()
+
+        particle_ref_key = None
+        if line.particle_ref is not None:
+            particle_ref_key = tuple(
+                (kk, _hashable_twiss_arg(vv))
+                for kk, vv in line.particle_ref.to_dict().items())
+
+        return (tuple(kwargs_key), vars_key, tracker._hashable_config(),
+                particle_ref_key, element_data_hash)
+
+
+_NOT_HASHABLE = object()
+
+def _hashable_twiss_arg(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        return (value.dtype.str, value.shape, value.tobytes())
+    if isinstance(value, (list, tuple)):
+        out = tuple(_hashable_twiss_arg(vv) for vv in value)
+        if any(vv is _NOT_HASHABLE for vv in out):
+            return _NOT_HASHABLE
+        return out
+    return _NOT_HASHABLE
+
+def _make_table_read_only(table):
+    for vv in table._data.values():
+        if isinstance(vv, np.ndarray):
+            vv.flags.writeable = False
+
+def _copy_cached_table(table):
+    if not isinstance(table, Table):
+        return table
+    out = table._copy()
+    for kk, vv in out._data.items():
+        if not isinstance(vv, np.ndarray) and hasattr(vv, 'copy'):
+            out._data[kk] = vv.copy()
+    return out
+
 def _find_periodic_solution(line, particle_on_co, particle_ref, method,
                             co_search_settings, continue_on_closed_orbit_error,
                             delta0, zeta0, steps_r_matrix, W_matrix,
@@ -1756,7 +2196,13 @@ def _find_periodic_solution(line, particle_on_co, particle_ref, method,
                             compute_R_element_by_element=False,
                             only_markers=False,
                             only_orbit=False,
-                            periodic_mode='periodic'):
+                            periodic_mode='periodic',
+                            co_search_method='optimize',
+                            co_search_R_matrix=None):
+
+    # co_search_R_matrix: one-turn matrix computed at the closed orbit by
+    # the Newton search, reused only together with the particle_on_co found
+    # by that same search
 
     eigenvalues = None
     Rot = None
@@ -1783,7 +2229,11 @@ def _find_periodic_solution(line, particle_on_co, particle_ref, method,
     else:
         if search_for_t_rev:
             assert method == '6d', 'search_for_t_rev possible when `method` is "6d"'
-        part_on_co = line.find_closed_orbit(
+        if co_search_method == 'newton' and not search_for_t_rev:
+            # The probes used in the search provide the R matrix
+            co_search_settings = (co_search_settings or {}).copy()
+            co_search_settings.setdefault('steps_r_matrix', steps_r_matrix)
+        part_on_co, co_search_R_matrix = find_closed_orbit_line(line,
                                 co_guess=co_guess,
                                 particle_ref=particle_ref,
                                 co_search_settings=co_search_settings,
@@ -1797,6 +2247,8 @@ def _find_periodic_solution(line, particle_on_co, particle_ref, method,
                                 search_for_t_rev=search_for_t_rev,
                                 num_turns_search_t_rev=num_turns_search_t_rev,
                                 symmetrize=(periodic_mode == 'periodic_symmetric'),
+                                co_search_method=co_search_method,
+                                _return_co_search_R_matrix=True,
                                 )
     if only_orbit:
         W_matrix = np.eye(6)
@@ -1818,18 +2270,29 @@ def _find_periodic_solution(line, particle_on_co, particle_ref, method,
         else:
             steps_r_matrix['adapted'] = False
             for iter in range(2):
-                RR_out = line.compute_one_turn_matrix_finite_differences(
-                    steps_r_matrix=steps_r_matrix,
-                    particle_on_co=part_on_co,
-                    start=start,
-                    end=end,
-                    num_turns=num_turns,
-                    element_by_element=compute_R_element_by_element,
-                    only_markers=only_markers,
-                    symmetrize=(periodic_mode == 'periodic_symmetric'),
-                    )
-                RR = RR_out['R_matrix']
-                RR_ebe = RR_out['R_matrix_ebe']
+                RR_co_search = co_search_R_matrix
+                if (iter == 0 and RR_co_search is not None
+                        and not compute_R_element_by_element
+                        and all(RR_co_search['steps_r_matrix'][kk]
+                                == steps_r_matrix[kk]
+                                for kk in DEFAULT_STEPS_R_MATRIX)):
+                    # Already computed at the closed orbit by the Newton search
+                    RR = RR_co_search['R_matrix']
+                    RR_ebe = None
+                else:
+                    RR_out = line.compute_one_turn_matrix_finite_differences(
+                        steps_r_matrix=steps_r_matrix,
+                        particle_on_co=part_on_co,
+                        start=start,
+                        end=end,
+                        num_turns=num_turns,
+                        element_by_element=compute_R_element_by_element,
+                        only_markers=only_markers,
+                        symmetrize=(periodic_mode == 'periodic_symmetric'),
+                        streaming=compute_R_element_by_element,
+                        )
+                    RR = RR_out['R_matrix']
+                    RR_ebe = RR_out['R_matrix_ebe']
 
                 if matrix_responsiveness_tol is not None:
                     lnf._assert_matrix_responsiveness(RR,
@@ -2056,7 +2519,16 @@ def find_closed_orbit_line(line, co_guess=None, particle_ref=None,
                       search_for_t_rev=False,
                       continue_on_closed_orbit_error=False,
                       num_turns_search_t_rev=None,
-                      symmetrize=False):
+                      symmetrize=False,
+                      co_search_method='optimize',
+                      _return_co_search_R_matrix=False):
+
+    # With _return_co_search_R_matrix, the one-turn matrix computed by the
+    # Newton search at the closed orbit is also returned (None if not
+    # available)
+
+    assert co_search_method in ['optimize', 'newton'], (
+        '`co_search_method` must be `optimize` or `newton`')
 
     if search_for_t_rev:
         assert line.particle_ref is not None
@@ -2073,6 +2545,8 @@ def find_closed_orbit_line(line, co_guess=None, particle_ref=None,
         assert symmetrize is False, '`symmetrize` not supported when `search_for_t_rev` is True'
 
         out = _find_closed_orbit_search_t_rev(line, num_turns_search_t_rev)
+        if _return_co_search_R_matrix:
+            return out, None
         return out
 
     if line.enable_time_dependent_vars:
@@ -2088,10 +2562,14 @@ def find_closed_orbit_line(line, co_guess=None, particle_ref=None,
         kwargs.pop('start')
         kwargs.pop('end')
         kwargs.pop('co_search_at')
+        kwargs.pop('_return_co_search_R_matrix')
         p_co_at_ele_co_search = find_closed_orbit_line(
             start=co_search_at, end=co_search_at,
             **kwargs)
         line.track(p_co_at_ele_co_search, ele_start=co_search_at, ele_stop=0)
+        if _return_co_search_R_matrix:
+            # The matrix from the search refers to co_search_at
+            return p_co_at_ele_co_search, None
         return p_co_at_ele_co_search
 
     if isinstance(start, str):
@@ -2134,6 +2612,7 @@ def find_closed_orbit_line(line, co_guess=None, particle_ref=None,
     co_guess = co_guess.copy(
                         _context=line._buffer.context)
 
+    RR_co_search = None
     for shift_factor in [0, 1.]: # if not found at first attempt we shift slightly the starting point
         if shift_factor>0:
             _print('Warning! Need second attempt on closed orbit search')
@@ -2156,6 +2635,20 @@ def find_closed_orbit_line(line, co_guess=None, particle_ref=None,
             _error_for_co = _error_for_co_search_6d
         if zeta0 is not None:
             x0[4] = zeta0
+
+        if co_search_method == 'newton':
+            res, fsolve_info, RR_co_search = _find_closed_orbit_newton(
+                line, co_guess, x0, delta_zeta, delta0, zeta0,
+                start=start, end=end, num_turns=num_turns,
+                symmetrize=symmetrize,
+                steps_r_matrix=co_search_settings.get('steps_r_matrix', None),
+                tol=co_search_settings.get('tol', None),
+                max_iterations=co_search_settings.get('max_iterations', None))
+            ier = 1 if fsolve_info['converged'] else -1
+            if ier == 1:
+                break
+            continue
+
         if np.all(np.abs(_error_for_co(
                 x0, co_guess, line, delta_zeta, delta0, zeta0,
                 start=start, end=end,
@@ -2198,10 +2691,125 @@ def find_closed_orbit_line(line, co_guess=None, particle_ref=None,
 
     particle_on_co._fsolve_info = fsolve_info
 
+    if _return_co_search_R_matrix:
+        if (ier != 1 or delta_zeta != 0
+                or line.energy_program is not None):
+            RR_co_search = None
+        return particle_on_co, RR_co_search
+
     return particle_on_co
 
-def _one_turn_map(p, particle_ref, line, delta_zeta, start, end, num_turns, symmetrize):
-    part = particle_ref.copy()
+def _find_closed_orbit_newton(line, co_guess, x0, delta_zeta, delta0, zeta0,
+                              start, end, num_turns, symmetrize,
+                              steps_r_matrix=None, tol=None,
+                              max_iterations=None):
+
+    # Newton search of the closed orbit. The 12 finite-difference probes are
+    # tracked together with the orbit guess, hence each iteration provides the
+    # one-turn matrix without additional tracking. A backtracking line search
+    # is used when the full Newton step does not reduce the error.
+
+    steps_r_matrix = _complete_steps_r_matrix_with_default(
+                                            (steps_r_matrix or {}).copy())
+    if tol is None:
+        tol = DEFAULT_CO_SEARCH_NEWTON_TOL
+    if max_iterations is None:
+        max_iterations = DEFAULT_CO_SEARCH_NEWTON_MAX_ITERATIONS
+    tol = np.array(tol, dtype=np.float64)
+    tol_floor = np.maximum(tol, DEFAULT_CO_SEARCH_TOL)
+
+    probes_template = []
+    def _evaluate(p):
+        part_co = _co_search_particle(line, co_guess, p, delta_zeta)
+        if not probes_template:
+            # Built once, then shifted to the new guess at each evaluation
+            probes_template.extend(
+                _build_co_search_probes(line, part_co, steps_r_matrix))
+            part = probes_template[0].copy()
+        else:
+            part = _shift_co_search_probes(probes_template[0], part_co)
+        out = _track_co_with_probes(line, part,
+                    start=start, end=end, num_turns=num_turns,
+                    symmetrize=symmetrize, steps_r_matrix=steps_r_matrix,
+                    dpzeta=probes_template[1])
+        if out is None: # particles lost
+            return None
+        p_out, jac, RR = out
+        err, jac_err = _co_search_newton_error(p, p_out, jac, delta0, zeta0)
+        return err, jac_err, RR
+
+    info = {'method': 'newton', 'converged': False, 'n_iterations': 0,
+            'n_tracks': 0, 'residuals': [], 'step_lengths': [],
+            'message': None}
+
+    p = np.array(x0, dtype=np.float64)
+    evaluation = _evaluate(p)
+    info['n_tracks'] += 1
+    if evaluation is None:
+        info['message'] = 'Particles lost at the initial guess'
+        return p, info, None
+    err, jac_err, RR = evaluation
+
+    for _ in range(max_iterations + 1):
+        info['residuals'].append(np.max(np.abs(err) / tol))
+        if np.all(np.abs(err) < tol):
+            info['converged'] = True
+            break
+        if info['n_iterations'] == max_iterations:
+            info['message'] = 'Maximum number of iterations reached'
+            break
+
+        try:
+            dp = -np.linalg.solve(jac_err, err)
+        except np.linalg.LinAlgError:
+            info['message'] = 'Singular Jacobian'
+            break
+
+        merit = np.linalg.norm(err / tol)
+        alpha = 1.
+        accepted = False
+        while alpha >= 1 / 64:
+            evaluation = _evaluate(p + alpha * dp)
+            info['n_tracks'] += 1
+            if evaluation is not None:
+                new_merit = np.linalg.norm(evaluation[0] / tol)
+                if new_merit < (1 - 1e-4 * alpha) * merit:
+                    accepted = True
+                    break
+            alpha *= 0.5
+
+        if not accepted:
+            if np.all(np.abs(err) < tol_floor):
+                # Limited by the numerical noise of the tracking
+                info['converged'] = True
+                info['message'] = 'Tolerance limited by numerical noise'
+            else:
+                info['message'] = 'Line search failed'
+            break
+
+        p = p + alpha * dp
+        err, jac_err, RR = evaluation
+        info['n_iterations'] += 1
+        info['step_lengths'].append(alpha)
+
+    return p, info, {'R_matrix': RR, 'steps_r_matrix': steps_r_matrix}
+
+def _co_search_newton_error(p, p_out, jac, delta0, zeta0):
+
+    # Error of the closed orbit search and its Jacobian. Works on a single
+    # guess (p of shape (6,)) or on a stack of guesses (p of shape (n, 6)).
+
+    err = p - p_out
+    jac_err = np.eye(6) - jac
+    if delta0 is not None or zeta0 is not None:
+        # 4d search: the longitudinal coordinates are not iterated
+        err[..., 4] = (p[..., 4] - zeta0) if zeta0 is not None else 0
+        err[..., 5] = (p[..., 5] - delta0) if delta0 is not None else 0
+        jac_err[..., 4:, :] = np.eye(6)[4:, :]
+    return err, jac_err
+
+def _co_search_particle(line, co_guess, p, delta_zeta):
+    part = co_guess.copy()
     part.x = p[0]
     part.px = p[1]
     part.y = p[2]
@@ -2215,6 +2823,118 @@ def _one_turn_map(p, particle_ref, line, delta_zeta, start, end, num_turns, symm
                                                         line.vv['t_turn_s'])
         part.update_p0c_and_energy_deviations(p0c = part._xobject.p0c[0] + dp0c)
 
+    return part
+
+def _build_co_search_probes(line, part_co, steps_r_matrix):
+
+    # Particle part_co followed by the probes used in
+    # compute_one_turn_matrix_finite_differences
+
+    import xpart
+
+    context = line._buffer.context
+
+    dx = steps_r_matrix["dx"]
+    dpx = steps_r_matrix["dpx"]
+    dy = steps_r_matrix["dy"]
+    dpy = steps_r_matrix["dpy"]
+    dzeta = steps_r_matrix["dzeta"]
+    ddelta = steps_r_matrix["ddelta"]
+    probes = xpart.build_particles(_context=context,
+            particle_ref=part_co, mode='shift',
+            x  =    [dx,  0., 0.,  0.,    0.,     0., -dx,   0.,  0.,   0.,     0.,      0.],
+            px =    [0., dpx, 0.,  0.,    0.,     0.,  0., -dpx,  0.,   0.,     0.,      0.],
+            y  =    [0.,  0., dy,  0.,    0.,     0.,  0.,   0., -dy,   0.,     0.,      0.],
+            py =    [0.,  0., 0., dpy,    0.,     0.,  0.,   0.,  0., -dpy,     0.,      0.],
+            zeta =  [0.,  0., 0.,  0., dzeta,     0.,  0.,   0.,  0.,   0., -dzeta,      0.],
+            delta = [0.,  0., 0.,  0.,    0., ddelta,  0.,   0.,  0.,   0.,     0., -ddelta],
+            )
+    dpzeta = float(context.nparray_from_context_array(
+        (probes.ptau[5] - probes.ptau[11])/2/probes.beta0[0]))
+    probes.s[:] = part_co._xobject.s[0]
+    probes.at_element[:] = part_co._xobject.at_element[0]
+    probes.at_turn = AT_TURN_FOR_TWISS
+
+    return xt.Particles.merge([part_co, probes]), dpzeta
+
+def _shift_co_search_probes(template, part_co):
+
+    # Copy of the template with all particles shifted by the difference
+    # between part_co and the first particle of the template
+
+    ctx2np = template._context.nparray_from_context_array
+    part = template.copy()
+    for nn in ['x', 'px', 'y', 'py', 'zeta']:
+        vv = ctx2np(getattr(template, nn))
+        setattr(part, nn, vv - vv[0] + getattr(part_co._xobject, nn)[0])
+    ptau = ctx2np(template.ptau)
+    part.update_ptau(template._context.nparray_to_context_array(
+                                    ptau - ptau[0] + part_co._xobject.ptau[0]))
+    return part
+
+def _track_co_with_probes(line, part, start, end, num_turns, symmetrize,
+                          steps_r_matrix, dpzeta):
+
+    # Tracks the particles built by _build_co_search_probes. Returns the
+    # coordinates of the first particle after tracking, the one-turn Jacobian
+    # in (x, px, y, py, zeta, delta) and the R matrix in
+    # (x, px, y, py, zeta, pzeta), or None if particles are lost.
+
+    ctx2np = line._buffer.context.nparray_from_context_array
+
+    delta_in = ctx2np(part.delta).copy()
+
+    line.track(part, ele_start=start, ele_stop=end, num_turns=num_turns)
+    if symmetrize:
+        assert num_turns == 1
+        with xt.line._preserve_config(line):
+            line.config.XSUITE_MIRROR = True
+            line.track(part, ele_start=start, ele_stop=end, num_turns=1)
+
+    if np.any(ctx2np(part.state) <= 0):
+        return None
+
+    coords = np.array([ctx2np(part.x), ctx2np(part.px), ctx2np(part.y),
+                       ctx2np(part.py), ctx2np(part.zeta), ctx2np(part.delta),
+                       ctx2np(part.ptau / part.beta0)])
+
+    p_out, jac, RR = _co_search_probes_output(
+        coords[:, None, :], delta_in[None, :], steps_r_matrix, dpzeta)
+
+    return p_out[0], jac[0], RR[0]
+
+def _co_search_probes_output(coords, delta_in, steps_r_matrix, dpzeta):
+
+    # coords has shape (7, n, 13) with x, px, y, py, zeta, delta, pzeta of n
+    # sets of particles built by _build_co_search_probes, delta_in has shape
+    # (n, 13). Returns the tracked orbit guesses (n, 6), the Jacobians in
+    # delta (n, 6, 6) and the R matrices in pzeta (n, 6, 6).
+
+    p_out = coords[:6, :, 0].T
+
+    dx = steps_r_matrix["dx"]
+    dpx = steps_r_matrix["dpx"]
+    dy = steps_r_matrix["dy"]
+    dpy = steps_r_matrix["dpy"]
+    dzeta = steps_r_matrix["dzeta"]
+
+    # Jacobian with respect to delta (coordinate of the search)
+    steps_delta = [dx, dpx, dy, dpy, dzeta,
+                   (delta_in[:, 6] - delta_in[:, 12]) / 2]
+    jac = _r_matrices_from_probes(
+                np.moveaxis(coords[:6, :, 1:], 1, 2), steps_delta)
+
+    # R matrix with respect to pzeta, as in
+    # compute_one_turn_matrix_finite_differences
+    RR = _r_matrices_from_probes(
+                np.moveaxis(coords[[0, 1, 2, 3, 4, 6], :, 1:], 1, 2),
+                [dx, dpx, dy, dpy, dzeta, dpzeta])
+
+    return p_out, jac, RR
+
+def _one_turn_map(p, particle_ref, line, delta_zeta, start, end, num_turns, symmetrize):
+    part = _co_search_particle(line, particle_ref, p, delta_zeta)
+
     line.track(part, ele_start=start, ele_stop=end, num_turns=num_turns)
     if symmetrize:
         assert num_turns == 1
@@ -2273,7 +2993,10 @@ def compute_one_turn_matrix_finite_differences(
         num_turns=1,
         element_by_element=False,
         only_markers=False,
-        symmetrize=True):
+        symmetrize=True,
+        at_elements=None,
+        streaming=False,
+        chunk_size=None):
     import xpart
 
     if steps_r_matrix is None:
@@ -2343,9 +3066,16 @@ def compute_one_turn_matrix_finite_differences(
         assert particle_on_co._xobject.at_element[0] == 0
         if element_by_element and num_turns != 1:
             raise NotImplementedError
-        monitor_setting = 'ONE_TURN_EBE' if element_by_element else None
-        line.track(part_temp, num_turns=num_turns,
-                   turn_by_turn_monitor=monitor_setting)
+        if element_by_element and streaming:
+            RR_ebe, ebe_index = _track_r_matrix_ebe_streaming(line, part_temp,
+                                    steps=[dx, dpx, dy, dpy, dzeta, dpzeta],
+                                    at_elements=at_elements,
+                                    only_markers=only_markers,
+                                    chunk_size=chunk_size)
+        else:
+            monitor_setting = 'ONE_TURN_EBE' if element_by_element else None
+            line.track(part_temp, num_turns=num_turns,
+                       turn_by_turn_monitor=monitor_setting)
         if symmetrize:
             with xt.line._preserve_config(line):
                 line.config.XSUITE_MIRROR = True
@@ -2367,31 +3097,109 @@ def compute_one_turn_matrix_finite_differences(
 
     out = {'R_matrix': RR}
 
-    if element_by_element:
+    if element_by_element and streaming:
+        out['R_matrix_ebe'] = RR_ebe
+        out['R_matrix_ebe_index'] = ebe_index
+    elif element_by_element:
         mon = line.record_last_track
-        temp_mad_ebe = np.zeros(shape=(len(line._element_names_unique) + 1, 6, 12), dtype=np.float64)
-        temp_mad_ebe[:, 0, :] = mon.x.T
-        temp_mad_ebe[:, 1, :] = mon.px.T
-        temp_mad_ebe[:, 2, :] = mon.y.T
-        temp_mad_ebe[:, 3, :] = mon.py.T
-        temp_mad_ebe[:, 4, :] = mon.zeta.T
-        temp_mad_ebe[:, 5, :] = mon.ptau.T/mon.beta0.T
-
-        RR_ebe = np.zeros(shape=(len(line._element_names_unique) + 1, 6, 6), dtype=np.float64)
-        for jj, dd in enumerate([dx, dpx, dy, dpy, dzeta, dpzeta]):
-            RR_ebe[:, :, jj] = (temp_mad_ebe[:, :, jj] - temp_mad_ebe[:, :, jj+6])/(2*dd)
-
-        if only_markers:
-            mask_twiss = line.tracker._get_twiss_mask_markers()
-            mask_twiss[-1] = True # to include the "_end_point"
+        ebe_index = _r_matrix_ebe_index(line, at_elements, only_markers)
+        RR_ebe = _r_matrices_from_probes(
+            [mon.x[:, ebe_index], mon.px[:, ebe_index], mon.y[:, ebe_index],
+             mon.py[:, ebe_index], mon.zeta[:, ebe_index],
+             mon.ptau[:, ebe_index] / mon.beta0[:, ebe_index]],
+            steps=[dx, dpx, dy, dpy, dzeta, dpzeta])
 
         out['R_matrix_ebe'] = RR_ebe
+        out['R_matrix_ebe_index'] = ebe_index
     else:
         out['R_matrix_ebe'] = None
 
     return out
 
 
+def _r_matrices_from_probes(coords, steps):
+    # coords: x, px, y, py, zeta, pzeta of the 12 probes, each with shape
+    # (12, n_points). Returns the R matrices with shape (n_points, 6, 6).
+    coords = np.array(coords, dtype=np.float64) # (6, 12, n_points)
+    RR = np.zeros(shape=(coords.shape[2], 6, 6), dtype=np.float64)
+    for jj, dd in enumerate(steps):
+        RR[:, :, jj] = ((coords[:, jj, :] - coords[:, jj + 6, :]) / (2 * dd)).T
+    return RR
+
+def _r_matrix_ebe_index(line, at_elements, only_markers):
+    # Positions (in the element-by-element monitor) at which the R matrix is
+    # returned, the last one (len(elements)) being the "_end_point"
+    num_elements = len(line._element_names_unique)
+    if at_elements is not None:
+        assert not only_markers, '`at_elements` and `only_markers` are exclusive'
+        index = []
+        for ee in at_elements:
+            if isinstance(ee, str):
+                ee = (num_elements if ee == '_end_point'
+                      else line._element_names_unique.index(ee))
+            index.append(int(ee))
+        return np.array(index, dtype=np.int64)
+    if only_markers:
+        mask = np.ones(num_elements + 1, dtype=bool)
+        mask[:-1] = line.tracker._get_twiss_mask_markers()[:num_elements]
+        return np.where(mask)[0] # last one is the "_end_point"
+    return np.arange(num_elements + 1, dtype=np.int64)
+
+def _track_r_matrix_ebe_streaming(line, part_temp, steps, at_elements,
+                                  only_markers, chunk_size):
+
+    # The line is tracked in chunks of elements and the probes are recorded by
+    # a single element-by-element monitor covering one chunk, so that the
+    # memory needed does not depend on the length of the line (apart from the
+    # output)
+
+    if chunk_size is None:
+        chunk_size = DEFAULT_STREAMING_CHUNK_SIZE
+
+    context = line._context
+    num_elements = len(line._element_names_unique)
+    ebe_index = _r_matrix_ebe_index(line, at_elements, only_markers)
+    order = np.argsort(ebe_index, kind='stable')
+    sorted_index = ebe_index[order]
+
+    chunk_size = min(chunk_size, num_elements)
+    monitor = line.tracker.particles_monitor_class(_context=context,
+                start_at_turn=0, stop_at_turn=chunk_size,
+                particle_id_range=part_temp.get_active_particle_id_range())
+    monitor.ebe_mode = 1
+
+    RR_ebe = np.zeros(shape=(len(ebe_index), 6, 6), dtype=np.float64)
+    for i_chunk_start in range(0, num_elements, chunk_size):
+        i_chunk_end = min(i_chunk_start + chunk_size, num_elements)
+        monitor.start_at_turn = i_chunk_start
+        monitor.stop_at_turn = i_chunk_start + chunk_size
+        line.track(part_temp, ele_start=i_chunk_start,
+                   ele_stop=(i_chunk_end if i_chunk_end < num_elements else None),
+                   turn_by_turn_monitor=monitor)
+
+        i_sel = np.searchsorted(sorted_index, [i_chunk_start, i_chunk_end])
+        cols = sorted_index[i_sel[0]:i_sel[1]] - i_chunk_start
+        if len(cols) == 0:
+            continue
+        RR_ebe[order[i_sel[0]:i_sel[1]]] = _r_matrices_from_probes(
+            [monitor.x[:, cols], monitor.px[:, cols], monitor.y[:, cols],
+             monitor.py[:, cols], monitor.zeta[:, cols],
+             monitor.ptau[:, cols] / monitor.beta0[:, cols]],
+            steps=steps)
+
+    # End point
+    mask_end = sorted_index == num_elements
+    if np.any(mask_end):
+        ctx2np = context.nparray_from_context_array
+        RR_ebe[order[mask_end]] = _r_matrices_from_probes(
+            [ctx2np(part_temp.x)[:, None], ctx2np(part_temp.px)[:, None],
+             ctx2np(part_temp.y)[:, None], ctx2np(part_temp.py)[:, None],
+             ctx2np(part_temp.zeta)[:, None],
+             ctx2np(part_temp.ptau / part_temp.beta0)[:, None]],
+            steps=steps)[0]
+
+    return RR_ebe, ebe_index
+
 def _updated_kwargs_from_locals(kwargs, loc):
 
     out = kwargs.copy()
@@ -2875,10 +3683,129 @@ class TwissTable(Table):
     def __init__(self, *args, **kwargs):
         kwargs['sep_count'] = kwargs.get('sep_count', '::::')
         super().__init__(*args, **kwargs)
+        object.__setattr__(self, '_lazy_columns', [])
 
     _error_on_row_not_found = True
 
+    # Deferred columns: groups of columns and scalars computed by a provider
+    # at the first access to one of them (see `lazy_columns` in twiss). All
+    # pending groups are computed before any operation using the full table.
+
+    def _register_lazy_columns(self, provider, columns, scalars=()):
+        self._lazy_columns.append((provider, list(columns), list(scalars)))
+
+    def _lazy_names(self):
+        lazy = self.__dict__.get('_lazy_columns', None)
+        if not lazy:
+            return set()
+        return set(nn for _, cc, ss in lazy for nn in cc + ss)
+
+    def _compute_lazy_columns(self, names=None):
+        lazy = self.__dict__.get('_lazy_columns', None)
+        if not lazy:
+            return
+        for group in list(lazy):
+            provider, columns, scalars = group
+            if names is not None and not any(
+                    nn in columns or nn in scalars for nn in names):
+                continue
+            cols, scals = provider()
+            lazy.remove(group)
+            self._data.update(cols)
+            self._data.update(scals)
+            self._col_names.extend(
+                cc for cc in cols.keys() if cc not in self._col_names)
+
+    def _compute_lazy_columns_for_key(self, key):
+        if not self.__dict__.get('_lazy_columns', None):
+            return
+        if isinstance(key, str):
+            if key in self._lazy_names():
+                self._compute_lazy_columns([key])
+            elif key not in self._data:
+                # Might be an expression
+                self._compute_lazy_columns()
+        elif isinstance(key, tuple) and len(key) > 0:
+            self._compute_lazy_columns_for_key(key[0])
+        elif isinstance(key, list) and all(isinstance(kk, str) for kk in key):
+            for kk in key:
+                self._compute_lazy_columns_for_key(kk)
+        else:
+            self._compute_lazy_columns()
+
+    def __getattr__(self, key):
+        if key in self._lazy_names():
+            self._compute_lazy_columns([key])
+        return super().__getattr__(key)
+
+    def __getitem__(self, args):
+        self._compute_lazy_columns_for_key(args)
+        return super().__getitem__(args)
+
+    def __setitem__(self, key, val):
+        if key in self._lazy_names():
+            self._compute_lazy_columns([key])
+        super().__setitem__(key, val)
+
+    __setattr__ = __setitem__
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self._lazy_names()
+
+    def __getstate__(self):
+        self._compute_lazy_columns()
+        return super().__getstate__()
+
+    def __iter__(self):
+        self._compute_lazy_columns()
+        return super().__iter__()
+
+    def __dir__(self):
+        return super().__dir__() + list(self._lazy_names())
+
+    def keys(self, exclude_columns=False):
+        self._compute_lazy_columns()
+        return super().keys(exclude_columns=exclude_columns)
+
+    def items(self):
+        self._compute_lazy_columns()
+        return super().items()
+
+    def values(self):
+        self._compute_lazy_columns()
+        return super().values()
+
+    def pop(self, key):
+        self._compute_lazy_columns()
+        return super().pop(key)
+
+    def show(self, *args, **kwargs):
+        self._compute_lazy_columns()
+        return super().show(*args, **kwargs)
+
+    def _select(self, rows, cols):
+        self._compute_lazy_columns()
+        return super()._select(rows, cols)
+
+    def _select_rows(self, rows):
+        self._compute_lazy_columns()
+        return super()._select_rows(rows)
+
+    def _select_cols(self, cols):
+        self._compute_lazy_columns()
+        return super()._select_cols(cols)
+
+    def _copy(self):
+        self._compute_lazy_columns()
+        return super()._copy()
+
+    def _concatenate_table(self, table):
+        self._compute_lazy_columns()
+        table._compute_lazy_columns()
+        return super()._concatenate_table(table)
+
     def to_pandas(self, index=None, columns=None):
+        self._compute_lazy_columns()
         if columns is None:
             columns = self._col_names
 
@@ -2911,7 +3838,7 @@ class TwissTable(Table):
 
         W = self.W_matrix[at_element]
 
-        if 'ax_chrom' in self.keys():
+        if 'ax_chrom' in self:
             ax_chrom = self.ax_chrom[at_element]
             bx_chrom = self.bx_chrom[at_element]
             ay_chrom = self.ay_chrom[at_element]
@@ -2930,7 +3857,7 @@ class TwissTable(Table):
             ddy = None
             ddpy = None
 
-        if 'mux' in self.keys():
+        if 'mux' in self:
             mux = self.mux[at_element]
             muy = self.muy[at_element]
             muzeta = self.muzeta[at_element]
@@ -3176,6 +4103,8 @@ class TwissTable(Table):
         assert self.values_at == 'entry', 'Not yet implemented for exit'
         assert self.name[-1] == '_end_point' # Needed for the present implementation
 
+        self._compute_lazy_columns()
+
         new_data = {}
         for kk, vv in self._data.items():
             if hasattr(vv, 'copy'):
@@ -3299,6 +4228,9 @@ class TwissTable(Table):
     @classmethod
     def concatenate(cls, tables_to_concat):
 
+        for tt in tables_to_concat:
+            tt._compute_lazy_columns()
+
         # Check values_at compatibility
         assert len(set([tt.values_at for tt in tables_to_concat])) == 1, (
             'All tables must have the same values_at')
@@ -3425,7 +4357,7 @@ class TwissTable(Table):
         if not hasattr(self,"_action"):
             lattice=False
 
-        if lattice and 'length' not in self.keys():
+        if lattice and 'length' not in self:
             self.add_strengths()
 
         if mask is not None:
@@ -3545,46 +4477,18 @@ def _complete_steps_r_matrix_with_default(steps_r_matrix):
     return steps_r_matrix
 
 def _renormalize_eigenvectors(Ws):
-    # Re normalize eigenvectors
-    v1 = Ws[:, :, 0] + 1j * Ws[:, :, 1]
-    v2 = Ws[:, :, 2] + 1j * Ws[:, :, 3]
-    v3 = Ws[:, :, 4] + 1j * Ws[:, :, 5]
-
-    S = lnf.S
-    S_v1_imag = v1 * 0.0
-    S_v2_imag = v2 * 0.0
-    S_v3_imag = v3 * 0.0
-    for ii in range(6):
-        for jj in range(6):
-            if S[ii, jj] !=0:
-                S_v1_imag[:, ii] +=  S[ii, jj] * v1.imag[:, jj]
-                S_v2_imag[:, ii] +=  S[ii, jj] * v2.imag[:, jj]
-                S_v3_imag[:, ii] +=  S[ii, jj] * v3.imag[:, jj]
-
-    nux = np.squeeze(Ws[:, 0, 0]) * (0.0 + 0j)
-    nuy = nux * 0.0
-    nuzeta = nux * 0.0
-
-    for ii in range(6):
-        nux += v1.real[:, ii] * S_v1_imag[:, ii]
-        nuy += v2.real[:, ii] * S_v2_imag[:, ii]
-        nuzeta += v3.real[:, ii] * S_v3_imag[:, ii]
-
-    nux = np.sqrt(np.abs(nux)) # nux is always positive
-    nuy = np.sqrt(np.abs(nuy)) # nuy is always positive
-    nuzeta = np.sqrt(np.abs(nuzeta)) # nuzeta is always positive
-
-    for ii in range(6):
-        v1[:, ii] /= nux
-        v2[:, ii] /= nuy
-        v3[:, ii] /= nuzeta
-
-    Ws[:, :, 0] = np.real(v1)
-    Ws[:, :, 1] = np.imag(v1)
-    Ws[:, :, 2] = np.real(v2)
-    Ws[:, :, 3] = np.imag(v2)
-    Ws[:, :, 4] = np.real(v3)
-    Ws[:, :, 5] = np.imag(v3)
+    # Re normalize eigenvectors (a_k S b_k = 1 for each mode k)
+    aa = Ws[:, :, 0::2]
+    bb = Ws[:, :, 1::2]
+    nn = np.einsum('nim,ij,njm->nm', aa, lnf.S, bb)
+    nn = np.sqrt(np.abs(nn)) # always positive
+
+    Ws[:, :, 0::2] /= nn[:, np.newaxis, :]
+    Ws[:, :, 1::2] /= nn[:, np.newaxis, :]
+
+    nux = nn[:, 0]
+    nuy = nn[:, 1]
+    nuzeta = nn[:, 2]
 
     return nux, nuy, nuzeta
 
@@ -3596,15 +4500,15 @@ def _extract_twiss_parameters_with_inverse(Ws):
 
     EE = np.zeros(shape=(3, Ws.shape[0], 6, 6), dtype=np.float64)
 
+    Ws_inv_S = np.linalg.inv(Ws) @ lnf.S
+
     for ii in range(3):
         Iii = np.zeros(shape=(6, 6))
         Iii[2*ii, 2*ii] = 1
         Iii[2*ii+1, 2*ii+1] = 1
         Sii = lnf.S @ Iii
 
-        Ws_inv = np.linalg.inv(Ws)
-
-        EE[ii, :, :, :] = - Ws @ Sii @ Ws_inv @ lnf.S
+        EE[ii, :, :, :] = - Ws @ Sii @ Ws_inv_S
 
     betx = EE[0, :, 0, 0]
     bety = EE[1, :, 2, 2]
@@ -3731,30 +4635,206 @@ def compute_T_matrix_line(line, start, end, particle_on_co=None,
     return TT
 
 def _multiturn_twiss(tw0, num_turns, kwargs):
-    tw_curr = tw0
-    twisses_to_merge = []
-    line = kwargs['line']
 
-    for i_turn in range(num_turns):
+    # The turns following the first one are obtained by tracking the twiss
+    # probes from the end of the first turn for num_turns - 1 turns in a
+    # single call, with a monitor recording them element by element over all
+    # turns. Each turn starts with a row named `_turn_<i>`. The quantities
+    # depending on the initial conditions of each turn (dzeta and the
+    # chromatic columns) are computed per turn, as in a chain of open twisses
+    # each starting from the end of the previous turn.
 
-        tw_start_turn = tw_curr.rows[0]
-        tw_start_turn.name[0] = f'_turn_{i_turn}'
-        twisses_to_merge.append(tw_start_turn)
-        twisses_to_merge.append(tw_curr)
+    line = kwargs['line']
+    context = line._context
+    tw0._compute_lazy_columns()
 
-        if i_turn == num_turns - 1:
-            break # need n-1 twisses
+    num_elements = len(line._element_names_unique)
+    num_records_per_turn = num_elements + 1 # including the end point
+    num_turns_track = num_turns - 1
+    compute_chrom = CHROMATIC_COLUMNS[0] in tw0._col_names
+    use_full_inverse = kwargs['use_full_inverse']
 
-        tini1 = tw_curr.get_twiss_init(-1)
-        tini1.element_name = tw_curr.name[0]
-        tw_curr = twiss_line(**kwargs,
-            init=tini1, start=tw_curr.name[0],
-            end=line._element_names_unique[-1])
+    init = tw0.get_twiss_init(-1)
+    init.element_name = tw0.name[0]
+    particle_on_co = init.particle_on_co
+    beta0 = particle_on_co._xobject.beta0[0]
+    scale_eigen = _twiss_probes_scale_eigen(particle_on_co,
+                    nemitt_x=kwargs['nemitt_x'], nemitt_y=kwargs['nemitt_y'],
+                    r_sigma=kwargs['r_sigma'], delta_disp=kwargs['delta_disp'])
+
+    # On-momentum probes followed, for the chromatic columns, by the probes
+    # at -delta_chrom and +delta_chrom
+    probe_inits = [init]
+    if compute_chrom:
+        delta_chrom = kwargs['delta_chrom']
+        probe_inits += [_off_momentum_twiss_init(line, init, dd)
+                        for dd in [-delta_chrom, delta_chrom]]
+    part = xt.Particles.merge(
+        [_build_twiss_probes(context, ii.particle_on_co, ii.W_matrix,
+                             scale_eigen) for ii in probe_inits],
+        _context=context)
+    part.at_element = 0
+    part.s = 0
+    part.at_turn = AT_TURN_FOR_TWISS # To avoid writing in monitors
+
+    monitor = line.tracker.particles_monitor_class(_context=context,
+        start_at_turn=AT_TURN_FOR_TWISS * num_records_per_turn,
+        stop_at_turn=(AT_TURN_FOR_TWISS + num_turns_track) * num_records_per_turn,
+        particle_id_range=part.get_active_particle_id_range())
+    monitor.ebe_mode = 2
+    monitor.repetition_period = num_records_per_turn
+
+    # Prebuilt kernels may not implement the repeated element-by-element
+    # recording (ebe_mode = 2)
+    line.tracker._rebuild_prebuilt_kernel_for_present_config()
+    line.track(part, num_turns=num_turns_track, turn_by_turn_monitor=monitor)
+
+    if not kwargs.get('_continue_if_lost', False):
+        assert np.all(monitor.state == 1), (
+            'Some test particles were lost during twiss! '
+          + f'(state {np.unique(monitor.state)})')
+
+    # Records at the elements of all turns and at the final end point
+    i_turn_track = np.arange(num_turns_track)
+    cols = np.concatenate([
+        (i_turn_track[:, None] * num_records_per_turn
+         + np.arange(num_elements)[None, :]).ravel(),
+        [num_turns_track * num_records_per_turn - 1]])
+    turn_of_col = np.concatenate([np.repeat(i_turn_track, num_elements),
+                                  [num_turns_track - 1]])
+    cols_end = (i_turn_track + 1) * num_records_per_turn - 1
+    i_col_turn_start = turn_of_col * num_elements
+
+    tracked = _twiss_orbit_from_record(monitor, cols)
+    Ws, _ = _W_matrices_from_record(monitor, cols, tracked, beta0,
+                                    scale_eigen)
+    orbit_end = _twiss_orbit_from_record(monitor, cols_end)
+    Ws_end, _ = _W_matrices_from_record(monitor, cols_end, orbit_end, beta0,
+                                        scale_eigen)
+    tracked['dzeta'] = _multiturn_dzeta(monitor, cols, cols_end, turn_of_col,
+                            W_start=Ws[0], Ws_end=Ws_end,
+                            W_init=init.W_matrix, dzeta_init=tw0.dzeta[-1],
+                            use_full_inverse=use_full_inverse)
+    circumference = line.tracker._tracker_data_base.line_length
+    tracked['s'] = tracked['s'] + turn_of_col * circumference
+    tracked['W_matrix'] = Ws
+
+    if 'betx' in tw0._col_names:
+        lattice_functions, i_replace = _compute_lattice_functions(
+                                        Ws, use_full_inverse, tracked['s'])
+        tracked.update(lattice_functions)
+        if kwargs.get('hide_thin_groups', False):
+            for key in VARS_HIDDEN_IN_THIN_GROUPS:
+                if key in tracked:
+                    tracked[key][i_replace] = np.nan
+
+    # (dzeta already includes the value at the end of the first turn)
+    for kk in ['mux', 'muy', 's', 'muzeta']:
+        if kk in tracked and kk in tw0._col_names:
+            tracked[kk] = tracked[kk] + tw0[kk][-1]
+    if kwargs['method'] == '4d' and 'muzeta' in tracked:
+        tracked['muzeta'][:] = 0
+
+    i_element_of_col = np.concatenate([
+                np.tile(np.arange(num_elements), num_turns_track), [-1]])
+    names_cols = np.array(tw0.name)[i_element_of_col]
+
+    if compute_chrom:
+        # The off-momentum probes are not rebuilt at each turn (for uncoupled
+        # optics this is equivalent to starting from the chromatic functions
+        # at the end of the previous turn), only their phase advances are
+        # restarted
+        tw_chrom_res = []
+        for i_set in [1, 2]:
+            tw_chrom = _twiss_orbit_from_record(monitor, cols, i_part=13 * i_set)
+            Ws_chrom, _ = _W_matrices_from_record(monitor, cols, tw_chrom,
+                            beta0, scale_eigen, i_part=13 * i_set)
+            lattice_functions, i_replace = _compute_lattice_functions(
+                                    Ws_chrom, use_full_inverse, tracked['s'])
+            tw_chrom.update(lattice_functions)
+            if kwargs.get('hide_thin_groups', False):
+                for key in VARS_HIDDEN_IN_THIN_GROUPS:
+                    if key in tw_chrom:
+                        tw_chrom[key][i_replace] = np.nan
+            for kk in ['mux', 'muy']:
+                tw_chrom[kk] = tw_chrom[kk] - tw_chrom[kk][i_col_turn_start]
+            tw_chrom['name'] = names_cols
+            tw_chrom_res.append(TwissTable(tw_chrom))
+        on_momentum = {kk: tracked[kk]
+                       for kk in ['mux', 'muy', 'x', 'px', 'y', 'py']}
+        on_momentum['name'] = names_cols
+        on_momentum = TwissTable(on_momentum)
+        cols_chrom, _ = _chromatic_columns(tw_chrom_res, delta_chrom,
+                                           on_momentum)
+        tracked.update(cols_chrom)
+
+    # Rows of the output (turn marker, elements of the turn, final end point)
+    i_elements_turn = np.concatenate([[0], np.arange(num_elements)])
+    i_rows_tracked = np.concatenate([
+        (i_turn_track[:, None] * num_elements
+         + i_elements_turn[None, :]).ravel(), [num_turns_track * num_elements]])
+    i_rows_tw0 = np.concatenate([np.tile(i_elements_turn, num_turns),
+                                 [num_elements]])
+    num_rows_first_turn = len(i_elements_turn)
+
+    names = np.array(tw0.name[i_rows_tw0], dtype=object)
+    names[::num_rows_first_turn][:num_turns] = [
+                                f'_turn_{ii}' for ii in range(num_turns)]
+
+    new_data = {}
+    for kk in tw0._col_names:
+        if kk == 'name':
+            new_data[kk] = np.array(list(names))
+            continue
+        vv_first = tw0[kk][i_elements_turn]
+        if kk in tracked:
+            vv_next = tracked[kk][i_rows_tracked]
+        else:
+            # Element properties (e.g. strengths) are the same at every turn
+            vv_next = tw0[kk][i_rows_tw0[num_rows_first_turn:]]
+        new_data[kk] = np.concatenate([vv_first, vv_next])
 
-    tw_mt = xt.TwissTable.concatenate(twisses_to_merge)
+    tw_mt = TwissTable(new_data)
+    tw_mt._data['values_at'] = tw0.values_at
+    tw_mt._data['reference_frame'] = tw0.reference_frame
+    tw_mt._data['particle_on_co'] = tw0.particle_on_co
 
     return tw_mt
 
+def _multiturn_dzeta(record, cols, cols_end, turn_of_col, W_start, Ws_end,
+                     W_init, dzeta_init, use_full_inverse):
+
+    # dzeta is obtained from the probes built along the last column of the
+    # initial W matrix, which in a chain of open twisses is the (normalized)
+    # W matrix at the end of the previous turn. For each turn, the probe
+    # differences are recombined into the ones of these probes.
+
+    def probe_differences(cc):
+        return (record.zeta[1:7, cc] - record.zeta[7:13, cc],
+                record.delta[1:7, cc] - record.delta[7:13, cc])
+
+    zeta_diff, delta_diff = probe_differences(cols)
+    zeta_diff_end, delta_diff_end = probe_differences(cols_end)
+
+    dzeta = np.zeros(len(cols))
+    dzeta_turn_start = dzeta_init
+    TT = np.linalg.solve(W_start, W_init)
+    for i_turn in range(len(cols_end)):
+        mask = turn_of_col == i_turn
+        rr = (TT[:, 5] @ zeta_diff[:, mask]) / (TT[:, 5] @ delta_diff[:, mask])
+        dzeta[mask] = dzeta_turn_start + rr - rr[0]
+        rr_end = ((TT[:, 5] @ zeta_diff_end[:, i_turn])
+                  / (TT[:, 5] @ delta_diff_end[:, i_turn]))
+        dzeta_turn_start += rr_end - rr[0]
+
+        # W matrix of the probes of the next turn
+        W_end = Ws_end[i_turn] @ TT
+        lattice_functions, _ = _compute_lattice_functions(
+                    W_end[np.newaxis, :, :], use_full_inverse, np.zeros(1))
+        TT = np.linalg.solve(Ws_end[i_turn], lattice_functions['W_matrix'][0])
+
+    return dzeta
+
 def _add_action_in_res(res, kwargs):
     if isinstance(res, xt.TwissInit):
         return res
@@ -3763,22 +4843,28 @@ def _add_action_in_res(res, kwargs):
     res._data['_action'] = action
     return res
 
-def get_non_linear_chromaticity(line, delta0_range, num_delta, fit_order=3, **kwargs):
+def get_non_linear_chromaticity(line, delta0_range, num_delta, fit_order=3,
+                                batched=False, full_twiss=False, **kwargs):
 
     assert 'method' not in kwargs.keys()
     kwargs['method'] = '4d'
 
     delta0 = np.linspace(delta0_range[0], delta0_range[1], num_delta)
 
-    twiss = []
-    for dd in delta0:
-        tw = line.twiss(delta0=dd, **kwargs)
-        twiss.append(tw)
+    if batched:
+        qx, qy, momentum_compaction_factor, twiss = (
+            _non_linear_chromaticity_batched(line, delta0,
+                                             full_twiss=full_twiss, **kwargs))
+    else:
+        twiss = []
+        for dd in delta0:
+            tw = line.twiss(delta0=dd, **kwargs)
+            twiss.append(tw)
 
-    qx = np.array([tw.mux[-1] for tw in twiss])
-    qy = np.array([tw.muy[-1] for tw in twiss])
-    momentum_compaction_factor = np.array([
-        tw.momentum_compaction_factor for tw in twiss])
+        qx = np.array([tw.mux[-1] for tw in twiss])
+        qy = np.array([tw.muy[-1] for tw in twiss])
+        momentum_compaction_factor = np.array([
+            tw.momentum_compaction_factor for tw in twiss])
 
     poly_qx_fit = np.polyfit(delta0, qx, deg=fit_order)
     poly_qy_fit = np.polyfit(delta0, qy, deg=fit_order)
@@ -3807,13 +4893,157 @@ def get_non_linear_chromaticity(line, delta0_range, num_delta, fit_order=3, **kw
     out_data['qx'] = qx
     out_data['qy'] = qy
     out_data['momentum_compaction_factor'] = momentum_compaction_factor
-    out_data['twiss'] = twiss
+    if twiss is not None:
+        out_data['twiss'] = twiss
 
     out = xt.Table(data = out_data, index='delta0',
             col_names = ['delta0', 'qx', 'qy', 'momentum_compaction_factor'])
 
     return out
 
+# Twiss arguments accepted by get_non_linear_chromaticity with batched=True
+_NON_LINEAR_CHROM_BATCHED_TWISS_ARGS = ('method', 'freeze_energy')
+
+def _non_linear_chromaticity_batched(line, delta0, full_twiss=False,
+                                     steps_r_matrix=None, max_iterations=20,
+                                     **kwargs):
+
+    # The closed orbit search (4d Newton iterations) and the one-turn matrix
+    # computation are done for all momentum offsets at the same time, tracking
+    # one particles object containing the finite-difference probes of all
+    # the offsets (one kernel call per iteration).
+
+    unsupported = [kk for kk, vv in kwargs.items()
+                   if vv is not None
+                   and kk not in _NON_LINEAR_CHROM_BATCHED_TWISS_ARGS]
+    if unsupported:
+        raise ValueError(
+            f'Arguments {unsupported} are not supported with `batched=True`')
+
+    if line.enable_time_dependent_vars:
+        raise RuntimeError(
+            'Time-dependent vars not supported in non-linear chromaticity')
+
+    if line._radiation_model is not None:
+        raise NotImplementedError(
+            'Radiation is not supported with `batched=True`')
+
+    freeze_energy = kwargs.get('freeze_energy', None)
+    if freeze_energy is None:
+        freeze_energy = line.twiss_default.get('freeze_energy', None)
+    if (freeze_energy is False
+            or line.twiss_default.get('freeze_longitudinal', False)):
+        raise ValueError('Only the default energy freezing of the 4d twiss '
+                         'is supported with `batched=True`')
+
+    # Same configuration as twiss(method='4d')
+    if not line._energy_is_frozen():
+        with xt.line._preserve_config(line):
+            line.freeze_energy(force=True)
+            return _non_linear_chromaticity_batched(
+                line, delta0, full_twiss=full_twiss,
+                steps_r_matrix=steps_r_matrix, max_iterations=max_iterations,
+                **kwargs)
+
+    steps_r_matrix = _complete_steps_r_matrix_with_default(steps_r_matrix)
+    steps = np.array([steps_r_matrix[nn] for nn in
+                      ['dx', 'dpx', 'dy', 'dpy', 'dzeta', 'ddelta']])
+
+    context = line._context
+    ctx2np = context.nparray_from_context_array
+
+    num_delta = len(delta0)
+    num_probes = 13 # closed orbit, then +step and -step for each coordinate
+    shifts = np.zeros(shape=(num_probes, 6))
+    shifts[1:7, :] = np.diag(steps)
+    shifts[7:13, :] = -np.diag(steps)
+
+    co = np.zeros(shape=(num_delta, 6))
+    co[:, 5] = delta0
+
+    for _ in range(max_iterations):
+        coords = (co[:, np.newaxis, :] + shifts[np.newaxis, :, :]).reshape(-1, 6)
+        part = line.build_particles(
+            x=coords[:, 0], px=coords[:, 1], y=coords[:, 2], py=coords[:, 3],
+            zeta=coords[:, 4], delta=coords[:, 5], _context=context)
+        part.at_turn = AT_TURN_FOR_TWISS
+        pzeta_in = ctx2np(part.ptau / part.beta0).reshape(num_delta, num_probes)
+
+        line.track(part)
+
+        if np.any(ctx2np(part.state) < 1):
+            raise ClosedOrbitSearchError(
+                'Particles lost in non-linear chromaticity computation')
+
+        out = np.zeros(shape=(num_delta, num_probes, 6))
+        for ii, nn in enumerate(['x', 'px', 'y', 'py', 'zeta']):
+            out[:, :, ii] = ctx2np(getattr(part, nn)).reshape(
+                                                        num_delta, num_probes)
+        out[:, :, 5] = ctx2np(part.ptau / part.beta0).reshape(
+                                                        num_delta, num_probes)
+
+        # One-turn matrices in (x, px, y, py, zeta, pzeta)
+        dd = np.tile(steps, (num_delta, 1))
+        dd[:, 5] = (pzeta_in[:, 6] - pzeta_in[:, 12]) / 2
+        RR = np.zeros(shape=(num_delta, 6, 6))
+        for jj in range(6):
+            RR[:, :, jj] = (out[:, jj + 1, :] - out[:, jj + 7, :]) / (
+                                                        2 * dd[:, jj:jj+1])
+
+        # Residual and Newton step on the transverse coordinates
+        err = out[:, 0, :4] - co[:, :4]
+        if np.all(np.abs(err) < np.array(DEFAULT_CO_SEARCH_TOL[:4])):
+            break
+        co[:, :4] -= np.linalg.solve(RR[:, :4, :4] - np.eye(4),
+                                     err[:, :, np.newaxis])[:, :, 0]
+    else:
+        raise ClosedOrbitSearchError(
+            'Closed orbit search did not converge in non-linear chromaticity')
+
+    circumference = line.tracker._tracker_data_base.line_length
+    gamma0 = line.particle_ref._xobject.gamma0[0]
+
+    _, _, _, eigenvalues = lnf.compute_linear_normal_form(
+                                            RR, only_4d_block=True)
+    qx_frac = np.mod(np.angle(eigenvalues[:, 0]) / (2 * np.pi), 1)
+    qy_frac = np.mod(np.angle(eigenvalues[:, 1]) / (2 * np.pi), 1)
+
+    # Slip factor from the zeta advance along the periodic dispersion
+    disp = -np.linalg.solve(RR[:, :4, :4] - np.eye(4), RR[:, :4, 5:6])[:, :, 0]
+    dzeta_dpzeta = RR[:, 4, 5] + np.sum(RR[:, 4, :4] * disp, axis=1)
+    dpzeta_ddelta = dd[:, 5] / steps[5]
+    eta = -dzeta_dpzeta * dpzeta_ddelta / circumference
+    momentum_compaction_factor = eta + 1 / gamma0**2
+
+    def _twiss_at(ii):
+        particle_on_co = line.build_particles(
+            x=co[ii, 0], px=co[ii, 1], y=co[ii, 2], py=co[ii, 3],
+            zeta=co[ii, 4], delta=co[ii, 5])
+        return line.twiss(particle_on_co=particle_on_co, R_matrix=RR[ii],
+                          steps_r_matrix=steps_r_matrix, **kwargs)
+
+    # The integer part of the tunes is taken from a full twiss
+    if full_twiss:
+        twiss = [_twiss_at(ii) for ii in range(num_delta)]
+        qx = np.array([tw.mux[-1] for tw in twiss])
+        qy = np.array([tw.muy[-1] for tw in twiss])
+    else:
+        twiss = None
+        i_ref = num_delta // 2
+        tw_ref = _twiss_at(i_ref)
+        qx = _unwrap_tunes(qx_frac, i_ref, tw_ref.mux[-1])
+        qy = _unwrap_tunes(qy_frac, i_ref, tw_ref.muy[-1])
+
+    return qx, qy, momentum_compaction_factor, twiss
+
+def _unwrap_tunes(q_frac, i_ref, q_ref):
+    q = q_frac.copy()
+    q[i_ref] = q_ref
+    for ii in list(range(i_ref + 1, len(q))) + list(range(i_ref - 1, -1, -1)):
+        q_prev = q[ii - 1] if ii > i_ref else q[ii + 1]
+        q[ii] = q_frac[ii] + np.round(q_prev - q_frac[ii])
+    return q
+
 def _merit_function_co_t_rec(x, line, num_turns):
     p = line.build_particles(x=x[0], px=x[1], y=x[2], py=x[3], zeta=x[4], delta=x[5])
     line.track(p, num_turns=num_turns, turn_by_turn_monitor=True)
@@ -3894,9 +5124,62 @@ def _W_phys2norm(x, px, y, py, zeta, pzeta, W_matrix, co_dict, nemitt_x=None, ne
 
     return XX_norm
 
+def _get_strengths_for_names(line, names):
+    tt = line.get_table(attr=True).rows[names]
+    return {kk: tt[kk].copy() for kk in STRENGTHS_COLUMNS}
+
 def _add_strengths_to_twiss_res(twiss_res, line):
-    tt = line.get_table(attr=True).rows[list(twiss_res.name)]
-    for kk in (NORMAL_STRENGTHS_FROM_ATTR + SKEW_STRENGTHS_FROM_ATTR
-                + OTHER_FIELDS_FROM_ATTR + OTHER_FIELDS_FROM_TABLE):
+    cols = _get_strengths_for_names(line, list(twiss_res.name))
+    for kk in STRENGTHS_COLUMNS:
         twiss_res._col_names.append(kk)
-        twiss_res._data[kk] = tt[kk].copy()
+        twiss_res._data[kk] = cols[kk]
+
+class _OnMomentumTwissData:
+
+    # Copy of the quantities of the on-momentum twiss used by
+    # _compute_chromatic_functions, for deferred computations
+
+    def __init__(self, twiss_res):
+        for nn in ['mux', 'muy', 'x', 'px', 'y', 'py']:
+            setattr(self, nn, twiss_res[nn].copy())
+        self.particle_on_co = twiss_res.particle_on_co.copy()
+
+def _line_state_for_lazy_columns(line):
+    # Fingerprint of the data of the elements, None if they cannot be located
+    # in the tracker buffer
+    tracker = line.tracker
+    element_hashes = _element_data_hashes(tracker)
+    if element_hashes is None:
+        return None
+    element_data_hash = hashlib.blake2b(element_hashes.tobytes()).hexdigest()
+    return id(tracker), element_data_hash
+
+def _add_columns_to_twiss_res(twiss_res, line, compute, columns, scalars,
+                              lazy=False):
+
+    # compute() returns a dict of columns and a dict of scalars. If lazy, it
+    # is called at the first access to one of the given columns or scalars.
+
+    if lazy:
+        state = _line_state_for_lazy_columns(line)
+        if state is not None:
+            # The configuration might be temporarily modified by the twiss
+            config = line.config.copy()
+            def provider():
+                if (not line._has_valid_tracker()
+                        or _line_state_for_lazy_columns(line) != state):
+                    raise RuntimeError(
+                        'The line has been modified after the twiss, the '
+                        f'deferred columns {columns + scalars} cannot be '
+                        'computed anymore. Please repeat the twiss.')
+                with xt.line._preserve_config(line):
+                    line.config.clear()
+                    line.config.update(config)
+                    return compute()
+            twiss_res._register_lazy_columns(provider, columns, scalars)
+            return
+
+    cols, scals = compute()
+    twiss_res._data.update(cols)
+    twiss_res._data.update(scals)
+    twiss_res._col_names += list(cols.keys())